@@ -0,0 +1,224 @@
+"""
+Time the repo handling of ice_setup on synthetic package trees::
+
+    python benchmarks/bench_repos.py --sizes 100,1000 --latency 0.01
+
+Each case runs ``--repeat`` times on trees of every size, against the
+stand-in tools from ``synthetic.py``. Results are written as JSON to
+``benchmarks/results/<version>.json`` (or ``--output``), and ``--compare``
+prints how they changed against the results of an earlier version.
+"""
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import synthetic
+from synthetic import ice
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def fresh(path):
+    if os.path.islink(path):
+        os.remove(path)
+    elif os.path.exists(path):
+        shutil.rmtree(path)
+
+
+# Every case gets the sandbox directories, the trees for its size and the
+# options, and returns a callable that does the work being timed. What
+# happens before that is setup and is not part of the timing.
+
+def case_overwrite_dir(dirs, trees, options):
+    destination = os.path.join(dirs['REMOTE_REPO_DIR'], 'OSD')
+    fresh(destination)
+    return lambda: ice.overwrite_dir(trees['OSD'], destination=destination)
+
+
+def case_enumerate_repo_yum(dirs, trees, options):
+    return lambda: ice.Yum.enumerate_repo(trees['OSD'])
+
+
+def case_enumerate_repo_apt(dirs, trees, options):
+    return lambda: ice.Apt.enumerate_repo(trees['deb'])
+
+
+def case_configure_local(dirs, trees, options):
+    fresh(os.path.join(dirs['LOCAL_REPO_DIR'], 'Calamari'))
+    return lambda: ice.configure_local('Calamari', trees['root'])
+
+
+def case_configure_local_unchanged(dirs, trees, options):
+    ice.configure_local('Calamari', trees['root'])
+    return lambda: ice.configure_local('Calamari', trees['root'])
+
+
+def case_yum_sync(dirs, trees, options):
+    os.environ['ICE_BENCH_SYNC_PACKAGES'] = str(trees['size'])
+    for name in ['MON', 'OSD']:
+        fresh(os.path.join(dirs['REMOTE_REPO_DIR'], name))
+    distro = ice.get_distro()
+    return lambda: ice.Yum.sync(['ceph-mon', 'ceph-osd'], distro)
+
+
+def answers_file(dirs, trees):
+    path = os.path.join(dirs['CWD'], 'answers.ini')
+    with open(path, 'w') as f:
+        f.write(
+            '[ice_setup]\n'
+            'package_path = %s\n'
+            'fqdn = ice.example.com\n'
+            'protocol = http\n'
+            'use_gpg = yes\n' % trees['root']
+        )
+    return ice.Answers(path)
+
+
+def run_default(dirs, trees, options, force):
+    ice.default(
+        trees['root'], True, force=force, jobs=options.jobs,
+        answers=answers_file(dirs, trees),
+    )
+
+
+def case_default(dirs, trees, options):
+    for name in os.listdir(dirs['REMOTE_REPO_DIR']):
+        fresh(os.path.join(dirs['REMOTE_REPO_DIR'], name))
+    return lambda: run_default(dirs, trees, options, force=True)
+
+
+def case_default_unchanged(dirs, trees, options):
+    run_default(dirs, trees, options, force=False)
+    return lambda: run_default(dirs, trees, options, force=False)
+
+
+CASES = [
+    ('overwrite_dir', case_overwrite_dir),
+    ('enumerate_repo_yum', case_enumerate_repo_yum),
+    ('enumerate_repo_apt', case_enumerate_repo_apt),
+    ('configure_local', case_configure_local),
+    ('configure_local_unchanged', case_configure_local_unchanged),
+    ('yum_sync', case_yum_sync),
+    ('default', case_default),
+    ('default_unchanged', case_default_unchanged),
+]
+
+
+def make_trees(work_dir, size, scale):
+    """
+    A package path like the one shipped in the ICE tarball: small Calamari,
+    Installer and Tools repos, and MON/OSD repos of ``size`` packages each
+    """
+    root = os.path.join(work_dir, 'trees', '%s-%s' % (size, scale))
+    trees = dict(root=root, size=size)
+    total = 0
+    for name, count in [('Calamari', 20), ('Installer', 5), ('Tools', 10), ('MON', size), ('OSD', size)]:
+        trees[name] = os.path.join(root, name)
+        total += synthetic.generate_tree(trees[name], count, scale=scale)
+    trees['deb'] = os.path.join(work_dir, 'trees', '%s-%s-deb' % (size, scale))
+    synthetic.generate_tree(trees['deb'], size, kind='deb', scale=scale)
+    trees['bytes'] = total
+    return trees
+
+
+def time_case(func, dirs, trees, options):
+    timings = []
+    for i in range(options.repeat):
+        work = func(dirs, trees, options)
+        start = time.time()
+        work()
+        timings.append(time.time() - start)
+    return timings
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = json.load(f)
+    before = dict(
+        ((r['case'], r['size']), r['best']) for r in previous['results']
+    )
+    print
+    print 'compared to %s (%s):' % (previous['version'], path)
+    for result in results['results']:
+        old = before.get((result['case'], result['size']))
+        if old:
+            print '  %-28s %6s  %8.3fs -> %8.3fs  %+6.1f%%' % (
+                result['case'], result['size'], old, result['best'],
+                100 * (result['best'] - old) / old,
+            )
+
+
+def parse_args(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='100,1000,10000',
+                      help='packages in the MON and OSD trees, comma separated')
+    parser.add_option('--cases', default=','.join(name for name, _ in CASES),
+                      help='cases to run, comma separated')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds every stand-in tool sleeps before answering')
+    parser.add_option('--size-scale', type='float', default=1.0,
+                      help='multiply package sizes by this much')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--jobs', type='int', default=4,
+                      help='steps run at the same time by default()')
+    parser.add_option('--work-dir', default=os.path.join(tempfile.gettempdir(), 'ice-bench'),
+                      help='where trees are generated and kept between runs')
+    parser.add_option('--output', help='defaults to results/<version>.json')
+    parser.add_option('--compare', help='results of an earlier run to compare with')
+    return parser.parse_args(argv)[0]
+
+
+def main(argv=None):
+    options = parse_args(argv if argv is not None else sys.argv[1:])
+    # the benchmarks should time the work, not the console
+    ice.logger.disabled = True
+    cases = [(name, func) for name, func in CASES if name in options.cases.split(',')]
+
+    results = dict(
+        version=ice.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        timestamp=time.time(),
+        latency=options.latency,
+        size_scale=options.size_scale,
+        results=[],
+    )
+    for size in [int(s) for s in options.sizes.split(',')]:
+        trees = make_trees(options.work_dir, size, options.size_scale)
+        sandbox_dir = os.path.join(options.work_dir, 'sandbox')
+        fresh(sandbox_dir)
+        with synthetic.sandbox(sandbox_dir, latency=options.latency) as dirs:
+            os.environ.pop('SUDO_USER', None)
+            for name, func in cases:
+                timings = time_case(func, dirs, trees, options)
+                timings.sort()
+                results['results'].append(dict(
+                    case=name,
+                    size=size,
+                    bytes=trees['bytes'],
+                    timings=timings,
+                    best=timings[0],
+                    median=timings[len(timings) // 2],
+                ))
+                print '%-28s %6s  best %8.3fs  median %8.3fs' % (
+                    name, size, timings[0], timings[len(timings) // 2]
+                )
+        fresh(sandbox_dir)
+
+    output = options.output or os.path.join(RESULTS_DIR, '%s.json' % ice.__version__)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'results written to %s' % output
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+Stress ``run()``, ``run_get_stdout()`` and ``run_call()`` with children that
+write a lot, in awkward ways, to stdout and stderr::
+
+    python benchmarks/stress_subprocess.py --scale 0.1 --timeout 60
+
+Every scenario runs against every function in a worker process of its own,
+so that its peak memory can be measured, under a watchdog that kills it if
+it takes longer than ``--timeout`` seconds and reports it as a hang. The
+output that the function hands back (or logs, for ``run()``) is compared
+with what the child wrote.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from optparse import OptionParser, SUPPRESS_HELP
+
+from synthetic import ice
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+MB = 1024 * 1024
+
+# bytes written to each stream at --scale 1, the length of its lines (None
+# for random binary data) and how the child writes them out
+SCENARIOS = [
+    ('stdout-lines', dict(stdout=(64 * MB, 80), stderr=(0, 80), mode='sequential')),
+    ('stderr-lines', dict(stdout=(0, 80), stderr=(16 * MB, 80), mode='sequential')),
+    ('stderr-then-stdout', dict(stdout=(16 * MB, 80), stderr=(16 * MB, 80), mode='stderr-first')),
+    ('interleaved', dict(stdout=(16 * MB, 120), stderr=(16 * MB, 120), mode='interleaved')),
+    ('bursty', dict(stdout=(16 * MB, 200), stderr=(4 * MB, 200), mode='bursty')),
+    ('binary', dict(stdout=(32 * MB, None), stderr=(2 * MB, None), mode='interleaved')),
+    ('long-lines', dict(stdout=(32 * MB, 8 * MB), stderr=(8 * MB, 8 * MB), mode='interleaved')),
+]
+
+FUNCTIONS = ['run', 'run_get_stdout', 'run_call']
+
+BURST = 256 * 1024
+BURST_PAUSE = 0.02
+
+
+def pieces(spec, stream, scale):
+    """what the child writes to ``stream``, in the pieces it writes them"""
+    total, line_length = spec[stream]
+    total = int(total * scale)
+    written = 0
+    index = 0
+    if line_length is None:
+        rand = random.Random(stream)
+        block = str(bytearray(rand.getrandbits(8) for i in range(65536)))
+        while written < total:
+            piece = block[:total - written]
+            written += len(piece)
+            # always end in a newline so every function sees the same lines
+            if written >= total:
+                piece = piece[:-1] + '\n'
+            yield piece
+        return
+    while written < total:
+        prefix = '%s %010d ' % (stream, index)
+        line = (prefix + 'x' * line_length)[:max(line_length, len(prefix)) - 1] + '\n'
+        written += len(line)
+        index += 1
+        yield line
+
+
+def generate(spec, scale):
+    """body of the child process"""
+    out = pieces(spec, 'stdout', scale)
+    err = pieces(spec, 'stderr', scale)
+    mode = spec['mode']
+    if mode == 'sequential':
+        streams = [(1, out), (2, err)]
+    elif mode == 'stderr-first':
+        streams = [(2, err), (1, out)]
+    else:
+        streams = None
+    if streams:
+        for fd, chunks in streams:
+            for chunk in chunks:
+                write_all(fd, chunk)
+        return
+    burst = 0
+    pending = [(1, out), (2, err)]
+    while pending:
+        for fd, chunks in list(pending):
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                pending.remove((fd, chunks))
+                continue
+            write_all(fd, chunk)
+            burst += len(chunk)
+            if mode == 'bursty' and burst >= BURST:
+                burst = 0
+                time.sleep(BURST_PAUSE)
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def expected(spec, stream, scale):
+    digest = hashlib.sha1()
+    size = 0
+    for piece in pieces(spec, stream, scale):
+        digest.update(piece)
+        size += len(piece)
+    return digest.hexdigest(), size
+
+
+class Capture(object):
+    """hashes the command output logged by ``run()``, one digest per stream"""
+
+    def __init__(self):
+        self.digests = dict(stdout=hashlib.sha1(), stderr=hashlib.sha1())
+
+    def handle(self, record):
+        if getattr(record, 'command_output', False):
+            stream = 'stderr' if record.levelname == 'WARNING' else 'stdout'
+            self.digests[stream].update(record.getMessage() + '\n')
+
+
+def lines_digest(lines):
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(line + '\n')
+    return digest.hexdigest()
+
+
+def worker(scenario, function, scale):
+    """run ``function`` on the child of ``scenario`` and return the measures"""
+    spec = dict(SCENARIOS)[scenario]
+    cmd = [sys.executable, os.path.abspath(__file__), '--generate', scenario, '--scale', str(scale)]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    got = {}
+    start = time.time()
+    if function == 'run':
+        capture = Capture()
+        ice.logger.setLevel(1)
+        ice.logger.propagate = False
+        ice.logger.handlers = []
+        handler = logging.Handler()
+        handler.emit = capture.handle
+        ice.logger.addHandler(handler)
+        ice.run(cmd)
+        got = dict((name, d.hexdigest()) for name, d in capture.digests.items())
+    elif function == 'run_get_stdout':
+        # stderr is logged as a single record, it is not checked here
+        ice.logger.disabled = True
+        got['stdout'] = hashlib.sha1(ice.run_get_stdout(cmd)).hexdigest()
+    else:
+        ice.logger.disabled = True
+        stdout, stderr, returncode = ice.run_call(cmd)
+        got = dict(stdout=lines_digest(stdout), stderr=lines_digest(stderr))
+    elapsed = time.time() - start
+
+    correct = True
+    total = 0
+    for stream in ['stdout', 'stderr']:
+        digest, size = expected(spec, stream, scale)
+        total += size
+        if stream in got and got[stream] != digest:
+            correct = False
+    return dict(
+        seconds=elapsed,
+        bytes=total,
+        throughput=total / elapsed / MB if elapsed else None,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        rss_growth_mb=(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024.0,
+        correct=correct,
+    )
+
+
+def watch(scenario, function, scale, timeout):
+    """run a worker, killing it if it is not done after ``timeout`` seconds"""
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--worker', scenario, function, '--scale', str(scale)],
+        stdout=subprocess.PIPE,
+    )
+    deadline = time.time() + timeout
+    while process.poll() is None:
+        if time.time() > deadline:
+            # the worker and the generator it is stuck with
+            subprocess.call(['pkill', '-KILL', '-P', str(process.pid)])
+            process.kill()
+            process.wait()
+            return dict(status='hang', seconds=timeout)
+        time.sleep(0.1)
+    output = process.stdout.read()
+    if process.returncode != 0:
+        return dict(status='error', returncode=process.returncode)
+    result = json.loads(output.splitlines()[-1])
+    result['status'] = 'ok' if result['correct'] else 'wrong output'
+    return result
+
+
+def parse_args(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--scenarios', default=','.join(name for name, _ in SCENARIOS))
+    parser.add_option('--functions', default=','.join(FUNCTIONS))
+    parser.add_option('--scale', type='float', default=1.0,
+                      help='multiply the volume of every scenario by this much')
+    parser.add_option('--timeout', type='float', default=120,
+                      help='seconds before a run is considered hung')
+    parser.add_option('--output', help='defaults to results/subprocess-<version>.json')
+    parser.add_option('--generate', help=SUPPRESS_HELP)
+    parser.add_option('--worker', nargs=2, help=SUPPRESS_HELP)
+    return parser.parse_args(argv)[0]
+
+
+def main(argv=None):
+    options = parse_args(argv if argv is not None else sys.argv[1:])
+    if options.generate:
+        return generate(dict(SCENARIOS)[options.generate], options.scale)
+    if options.worker:
+        result = worker(options.worker[0], options.worker[1], options.scale)
+        sys.stdout.write(json.dumps(result) + '\n')
+        return
+
+    results = dict(
+        version=ice.__version__,
+        timestamp=time.time(),
+        scale=options.scale,
+        timeout=options.timeout,
+        results=[],
+    )
+    print '%-20s %-15s %-12s %9s %10s %10s' % (
+        'scenario', 'function', 'status', 'seconds', 'MB/s', 'peak MB')
+    for scenario in options.scenarios.split(','):
+        for function in options.functions.split(','):
+            result = watch(scenario, function, options.scale, options.timeout)
+            result.update(scenario=scenario, function=function)
+            results['results'].append(result)
+            print '%-20s %-15s %-12s %9.2f %10s %10s' % (
+                scenario, function, result['status'], result.get('seconds', 0),
+                '%.1f' % result['throughput'] if result.get('throughput') else '-',
+                '%.1f' % result['peak_rss_mb'] if 'peak_rss_mb' in result else '-',
+            )
+
+    output = options.output or os.path.join(RESULTS_DIR, 'subprocess-%s.json' % ice.__version__)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'results written to %s' % output
+
+
+if __name__ == '__main__':
+    main()
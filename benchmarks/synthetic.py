@@ -0,0 +1,192 @@
+"""
+Synthetic package trees and stand-in tools for the benchmarks.
+
+Trees are generated from a fixed seed so that every run (and every version
+of ice_setup) gets the exact same files, and they are kept around between
+runs since generating the larger ones takes a while. The stand-in tools are
+small scripts put first on ``PATH`` that answer like the real ones would,
+after sleeping for ``ICE_BENCH_LATENCY`` seconds.
+"""
+import math
+import os
+import random
+import stat
+import sys
+from contextlib import contextmanager
+
+# root of the repository, so that the benchmarks import the working copy
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from ice_setup import ice  # noqa
+
+SEED = 1015
+
+# sizes of packages in a repo are roughly log-normal: lots of small ones,
+# a few very large ones (debuginfo, the ceph daemons)
+MEDIAN_SIZE = 100 * 1024
+SIZE_SIGMA = 1.2
+MAX_SIZE = 32 * 1024 * 1024
+
+NAMES = [
+    'ceph', 'ceph-common', 'ceph-mon', 'ceph-osd', 'ceph-radosgw', 'librados2',
+    'librbd1', 'libcephfs1', 'python-rados', 'python-rbd', 'calamari-server',
+    'calamari-clients', 'ceph-deploy', 'salt', 'salt-minion', 'diamond',
+]
+
+
+def package_sizes(count, scale=1.0, seed=SEED):
+    rand = random.Random('%s-%s' % (seed, count))
+    mu = math.log(MEDIAN_SIZE * scale)
+    return [
+        max(1, min(int(rand.lognormvariate(mu, SIZE_SIGMA)), int(MAX_SIZE * scale)))
+        for i in range(count)
+    ]
+
+
+def package_file_name(index, kind):
+    name = '%s-%s' % (NAMES[index % len(NAMES)], index)
+    if kind == 'deb':
+        return '%s_0.94.%s-1_amd64.deb' % (name, index % 7)
+    return '%s-0.94.%s-1.el7cp.x86_64.rpm' % (name, index % 7)
+
+
+def write_package(path, size, block):
+    # every file starts with its own name so that no two are the same
+    header = os.path.basename(path) + '\n'
+    with open(path, 'wb') as f:
+        f.write(header[:size])
+        size -= len(header)
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def generate_tree(path, count, kind='rpm', scale=1.0):
+    """
+    Write ``count`` fake packages into ``path``, unless a complete tree is
+    already there. Returns the total size in bytes.
+    """
+    marker = os.path.join(path, '.complete')
+    sizes = package_sizes(count, scale)
+    if os.path.exists(marker):
+        return sum(sizes)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    # the contents do not matter, but they should not compress or dedup
+    # to nothing
+    rand = random.Random(SEED)
+    block = str(bytearray(rand.getrandbits(8) for i in range(1048576)))
+    for index, size in enumerate(sizes):
+        write_package(os.path.join(path, package_file_name(index, kind)), size, block)
+    if kind == 'deb':
+        with open(os.path.join(path, 'release.asc'), 'w') as f:
+            f.write('-----BEGIN PGP PUBLIC KEY BLOCK-----\n')
+    open(marker, 'w').close()
+    return sum(sizes)
+
+
+STUB_HEADER = """#!%s
+import os, sys, time
+time.sleep(float(os.environ.get('ICE_BENCH_LATENCY', '0')))
+args = sys.argv[1:]
+"""
+
+STUBS = {
+    # rpm -q --queryformat=%{NAME} -p <files>, rpm --import <key>,
+    # rpm -Kv [--nosignature] <files>
+    'rpm': """
+if '-q' in args:
+    names = [a for a in args if a.endswith('.rpm')]
+    sys.stdout.write(' '.join(n.rsplit('-', 2)[0] for n in names) + ' ')
+elif '-Kv' in args:
+    import hashlib
+    for name in [a for a in args if a.endswith('.rpm')]:
+        # the real one reads every package through to check its digests
+        digest = hashlib.md5()
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1048576), ''):
+                digest.update(block)
+        sys.stdout.write('%s:\\n' % name)
+        if '--nosignature' not in args:
+            sys.stdout.write('    Header V4 RSA/SHA256 Signature, key ID fd431d51: OK\\n')
+        sys.stdout.write('    Header SHA256 digest: OK\\n')
+        sys.stdout.write('    MD5 digest: OK (%s)\\n' % digest.hexdigest())
+""",
+    # dpkg-deb -f <deb> Package
+    'dpkg-deb': """
+sys.stdout.write(os.path.basename(args[1]).split('_')[0] + '\\n')
+""",
+    # reposync --repoid=<id> ... -p <destination>
+    'reposync': """
+destination = args[args.index('-p') + 1]
+if not os.path.isdir(destination):
+    os.makedirs(destination)
+count = int(os.environ.get('ICE_BENCH_SYNC_PACKAGES', '100'))
+for i in range(count):
+    name = 'synced-%s-0.94-1.el7cp.x86_64.rpm' % i
+    with open(os.path.join(destination, name), 'wb') as f:
+        f.write(os.urandom(4096))
+    sys.stdout.write('(%s/%s): %s\\n' % (i + 1, count, name))
+""",
+    'createrepo': """
+repodata = os.path.join(args[-1], 'repodata')
+if not os.path.isdir(repodata):
+    os.makedirs(repodata)
+with open(os.path.join(repodata, 'repomd.xml'), 'w') as f:
+    f.write('<repomd/>\\n')
+""",
+    'yum': '',
+    'apt-get': '',
+    'apt-key': '',
+}
+
+
+def write_stubs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, body in STUBS.items():
+        stub = os.path.join(path, name)
+        with open(stub, 'w') as f:
+            f.write(STUB_HEADER % sys.executable + body)
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+@contextmanager
+def sandbox(path, latency=0.0, distro=('centos', '7.1', 'Core')):
+    """
+    Point ice_setup at directories under ``path`` rather than the system
+    ones, with the stand-in tools first on ``PATH`` and ``distro`` as the
+    platform of the host
+    """
+    dirs = dict(
+        LOCAL_REPO_DIR=os.path.join(path, 'opt', 'ICE'),
+        REMOTE_REPO_DIR=os.path.join(path, 'opt', 'calamari', 'webapp', 'content'),
+        YUM_REPOS_DIR=os.path.join(path, 'etc', 'yum.repos.d'),
+        APT_SOURCES_DIR=os.path.join(path, 'etc', 'apt', 'sources.list.d'),
+        STATE_DIR=os.path.join(path, 'state'),
+        CWD=os.path.join(path, 'cwd'),
+    )
+    for directory in dirs.values():
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    dirs['APT_PREFERENCES_FILE'] = os.path.join(path, 'etc', 'apt', 'rhcs.pref')
+    write_stubs(os.path.join(path, 'bin'))
+
+    saved = dict((name, getattr(ice, name)) for name in dirs)
+    saved['platform_information'] = ice.platform_information
+    environ = dict(os.environ)
+    for name, value in dirs.items():
+        setattr(ice, name, value)
+    ice.platform_information = lambda: distro
+    os.environ['PATH'] = os.pathsep.join([os.path.join(path, 'bin'), os.environ['PATH']])
+    os.environ['HOME'] = dirs['CWD']
+    os.environ['ICE_BENCH_LATENCY'] = str(latency)
+    try:
+        yield dirs
+    finally:
+        for name, value in saved.items():
+            setattr(ice, name, value)
+        os.environ.clear()
+        os.environ.update(environ)
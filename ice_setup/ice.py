@@ -20,22 +20,48 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import BaseHTTPServer
+import cProfile
+import fcntl
+import gzip
+import hashlib
+import httplib
+import json
 import logging
+import logging.handlers
+import mimetypes
+import multiprocessing
 import os
+import pipes
 import platform
+import pstats
+import Queue
+import random
+import select
+import shlex
 import shutil
 import socket
+import stat
+import struct
 import subprocess
 import sys
 import tarfile
 import tempfile
+import thread
+import threading
+import time
+import urllib
 import urllib2
 import urlparse
-from ConfigParser import SafeConfigParser, NoSectionError, NoOptionError
-from errno import EROFS
+from ConfigParser import RawConfigParser, NoSectionError, NoOptionError
+from email import utils as email_utils
+from errno import EACCES, EAGAIN, EINTR, EROFS
 
+from contextlib import contextmanager
 from functools import wraps
+from StringIO import StringIO
 from textwrap import dedent
+from xml.etree import ElementTree
 
 __version__ = '0.4.5'
 
@@ -72,11 +98,27 @@ RESET_SEQ = "\033[0m"
 COLOR_SEQ = "\033[1;%dm"
 BOLD_SEQ = "\033[1m"
 
+FILE_FORMAT = "%(asctime)s [%(threadName)s][%(levelname)s] %(message)s"
 BASE_COLOR_FORMAT = "%(color_levelname)s %(message)s"
 VERBOSE_COLOR_FORMAT = "[%(name)s][$BOLD%(levelname)s] $RESET%(color_levelname)s %(message)s"
 
 CWD = os.getcwd()
 
+STATE_DIR = '/var/lib/ice_setup'
+
+# downloaded bundles, and the bundles extracted from them (see
+# ``ExtractionCache``)
+DOWNLOAD_DIR = '/opt/ice/tmp'
+EXTRACT_CACHE_DIR = '/opt/ice/cache'
+
+# where the repos are published for this host and for remote hosts
+LOCAL_REPO_DIR = '/opt/ICE'
+REMOTE_REPO_DIR = '/opt/calamari/webapp/content'
+
+YUM_REPOS_DIR = '/etc/yum.repos.d'
+APT_SOURCES_DIR = '/etc/apt/sources.list.d'
+APT_PREFERENCES_FILE = '/etc/apt/preferences.d/rhcs.pref'
+
 
 def get_rhel_gpg_path():
     gpg_path = "/etc/pki/rpm-gpg/RPM-GPG-KEY-redhat-release"
@@ -106,6 +148,244 @@ class ColoredFormatter(logging.Formatter):
         return logging.Formatter.format(self, record)
 
 
+class ConsoleHandler(logging.StreamHandler):
+    """
+    A stream handler that can hold back records coming from other threads
+    while a prompt is waiting for input, so that the output of steps running
+    in the background does not get mixed with the question being asked. Held
+    records are written as soon as the prompt is done.
+
+    When ``output_rate`` is set, at most that many lines of command output
+    (records logged with ``command_output`` set) are written every second,
+    and a line noting how many were skipped is written before the next
+    record that does get through.
+
+    On a tty the handler also keeps a status line below the records (see
+    :class:`Progress`), which is cleared before writing a record and drawn
+    again right after it.
+    """
+
+    def __init__(self, stream=None, output_rate=None, full_log=None):
+        logging.StreamHandler.__init__(self, stream)
+        self.holder = None
+        self.hold_depth = 0
+        self.held = []
+        self.output_rate = output_rate
+        self.full_log = full_log
+        self.window = None
+        self.window_count = 0
+        self.skipped = 0
+        self.statuses = {}
+        self.status_drawn = False
+
+    @property
+    def is_tty(self):
+        isatty = getattr(self.stream, 'isatty', None)
+        return bool(isatty and isatty())
+
+    def emit(self, record):
+        # ``handle()`` has already acquired ``self.lock`` at this point.
+        # Records are checked against the thread that logged them, because
+        # they might be written by the background log writer.
+        if self.holder not in (None, record.thread):
+            self.held.append(record)
+            return
+        self.write(record)
+
+    def write(self, record):
+        if self.output_rate and getattr(record, 'command_output', False):
+            window = int(record.created)
+            if window != self.window:
+                self.window, self.window_count = window, 0
+            self.window_count += 1
+            if self.window_count > self.output_rate:
+                self.skipped += 1
+                return
+        if self.skipped:
+            note = '%s lines of command output not shown' % self.skipped
+            if self.full_log:
+                note = '%s, see %s' % (note, self.full_log)
+            self.skipped = 0
+            self.clear_status()
+            logging.StreamHandler.emit(self, logging.makeLogRecord(dict(
+                name=record.name, levelno=logging.DEBUG, levelname='DEBUG', msg=note,
+            )))
+        self.clear_status()
+        logging.StreamHandler.emit(self, record)
+        self.draw_status()
+
+    def status(self, key, line):
+        """
+        Set the status line for ``key``, or remove it if ``line`` is None.
+        Status lines of different keys are shown side by side.
+        """
+        self.acquire()
+        try:
+            if line is None:
+                self.statuses.pop(key, None)
+            else:
+                self.statuses[key] = line
+            self.draw_status()
+        finally:
+            self.release()
+
+    def clear_status(self):
+        if self.status_drawn:
+            self.stream.write('\r\033[K')
+            self.status_drawn = False
+
+    def draw_status(self):
+        # leave the console alone while another thread is prompting
+        if not self.is_tty or self.holder not in (None, thread.get_ident()):
+            return
+        self.clear_status()
+        if self.statuses:
+            width = int(os.environ.get('COLUMNS', 80)) - 1
+            line = ' | '.join(self.statuses[key] for key in sorted(self.statuses))
+            self.stream.write(line[:width])
+            self.status_drawn = True
+        self.flush()
+
+    def hold(self):
+        self.acquire()
+        try:
+            self.holder = thread.get_ident()
+            self.hold_depth += 1
+            self.clear_status()
+        finally:
+            self.release()
+
+    def unhold(self):
+        self.acquire()
+        try:
+            self.hold_depth -= 1
+            if self.hold_depth:
+                return
+            self.holder = None
+            held, self.held = self.held, []
+            for record in held:
+                self.write(record)
+            self.draw_status()
+        finally:
+            self.release()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands records over to a :class:`LogWriter`. The message is rendered
+    right away since the arguments could change before the record is
+    written.
+    """
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.writer.put(record)
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(object):
+    """
+    Writes log records to the real handlers from a background thread, so
+    that the threads doing the work never wait on a slow terminal or pipe.
+
+    ``start()`` swaps the handlers on the logger for a :class:`QueueHandler`
+    and ``stop()`` writes whatever is left and puts them back.
+    """
+
+    def __init__(self):
+        self.records = Queue.Queue()
+        self.queue_handler = QueueHandler(self)
+        self.handlers = []
+        self.worker = None
+        self.pending = 0
+        self.idle = threading.Condition()
+
+    @property
+    def running(self):
+        return self.worker is not None
+
+    def start(self, handlers):
+        self.handlers = handlers
+        self.worker = threading.Thread(target=self._work, name='log-writer')
+        self.worker.daemon = True
+        self.worker.start()
+        logger.addHandler(self.queue_handler)
+
+    def put(self, record):
+        with self.idle:
+            self.pending += 1
+        self.records.put(record)
+
+    def _work(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            with self.idle:
+                self.pending -= 1
+                self.idle.notify_all()
+
+    def flush(self):
+        """wait until every record logged so far has been written"""
+        if not self.running:
+            return
+        with self.idle:
+            while self.pending:
+                self.idle.wait(0.5)
+
+    def stop(self):
+        if not self.running:
+            return
+        logger.removeHandler(self.queue_handler)
+        self.records.put(None)
+        self.worker.join()
+        self.worker = None
+        for handler in self.handlers:
+            logger.addHandler(handler)
+
+
+log_writer = LogWriter()
+
+
+def console_handlers():
+    return [
+        h for h in logger.handlers + log_writer.handlers
+        if isinstance(h, ConsoleHandler)
+    ]
+
+
+@contextmanager
+def holding_output():
+    """
+    Serialize console output with respect to a prompt: only the calling
+    thread gets to write to the console until the block is done. Records
+    that are still queued are written first so that they show up before the
+    question.
+    """
+    handlers = console_handlers()
+    for handler in handlers:
+        handler.hold()
+    log_writer.flush()
+    try:
+        yield
+    finally:
+        for handler in handlers:
+            handler.unhold()
+
+
 def color_format(verbose=False):
     """
     Main entry point to get a colored formatter, it will use the
@@ -253,9 +533,10 @@ class Transport(Parse):
 
     def dispatch(self):
         mapper_keys = self.mapper.keys()
-        for arg in self.arguments:
+        for index, arg in enumerate(self.arguments):
             if arg in mapper_keys:
-                instance = self.mapper.get(arg)(self.arguments)
+                # options before the subcommand belong to the main parser
+                instance = self.mapper.get(arg)(self.arguments[index:])
                 return instance.parse_args()
         self.parse_args()
         if self.unkown_commands:
@@ -326,11 +607,87 @@ class VersionNotFound(DirNotFound):
         return 'could not find version directory in %s' % self.filepath
 
 
+class GenerationNotFound(ICEError):
+    """
+    A published repository does not have the generation asked for
+    """
+
+    def __init__(self, path, number, available):
+        self.path = path
+        self.number = number
+        self.available = available
+        Exception.__init__(self, self.__str__())
+
+    def __str__(self):
+        return 'generation %s of %s not found, available generations: %s' % (
+            self.number, self.path, ', '.join(str(n) for n in self.available) or 'none'
+        )
+
+
 class InvalidRepoName(ICEError):
     """Unrecognized name of repository"""
     pass
 
 
+class ReplicationError(ICEError):
+    """A replica host could not be read from or written to"""
+    pass
+
+
+class InsufficientSpace(ICEError):
+    """
+    The repositories would not fit in the filesystems they are published to
+    """
+
+    def __init__(self, shortfalls):
+        # (path, what, needed, available) for every filesystem that is short
+        self.shortfalls = shortfalls
+        Exception.__init__(self, self.__str__())
+
+    def __str__(self):
+        return 'not enough space to publish the repositories: %s' % '; '.join(
+            '%s needs %s but has %s' % (
+                path,
+                format_bytes(needed) if what == 'bytes' else '%s inodes' % needed,
+                format_bytes(available) if what == 'bytes' else '%s inodes' % available,
+            )
+            for path, what, needed, available in self.shortfalls
+        )
+
+
+class VerificationFailed(ICEError):
+    """
+    Packages that are about to be published are corrupt or not signed
+    """
+
+    def __init__(self, source, failures):
+        # (path, problem) for every package that failed
+        self.source = source
+        self.failures = failures
+        Exception.__init__(self, self.__str__())
+
+    def __str__(self):
+        return '%s packages in %s failed verification: %s' % (
+            len(self.failures), self.source,
+            ', '.join(path for path, problem in self.failures[:5]) +
+            (', ...' if len(self.failures) > 5 else ''),
+        )
+
+
+class LockHeld(ICEError):
+    """
+    A lock is held by another run and waiting for it was not an option
+    """
+
+    def __init__(self, lock, holder):
+        self.lock = lock
+        self.holder = holder
+        Exception.__init__(self, self.__str__())
+
+    def __str__(self):
+        return '%s is in use by %s' % (self.lock.description, self.holder)
+
+
 # =============================================================================
 # Decorators
 # =============================================================================
@@ -419,6 +776,406 @@ def make_exception_message(exc):
         return '%s' % (exc.__class__.__name__)
 
 
+# =============================================================================
+# Instrumentation
+# =============================================================================
+
+
+def cpu_time():
+    """
+    CPU time used so far by this process (all of its threads) and by the
+    child processes that have been waited for
+    """
+    times = os.times()
+    return sum(times[:4])
+
+
+class Span(object):
+    """
+    A timed phase of a run, like a step, a command or a copy. CPU time is
+    process wide, so spans that overlap in time share it. ``error`` is set
+    when the phase raised.
+    """
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.current_thread()
+        self.start = None
+        self.end = None
+        self.cpu = None
+        self.error = None
+
+    @property
+    def wall(self):
+        return self.end - self.start
+
+
+class Recorder(object):
+    """
+    Collects the spans of a run and lets listeners know when a span starts
+    and ends, and when it transfers bytes. Listeners are callables that get
+    the event (``'start'``, ``'end'`` or ``'bytes'``) and the span, and
+    should ignore events they do not know about.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.listeners = []
+        self.started = time.time()
+        self.cpu_started = cpu_time()
+
+    @contextmanager
+    def span(self, name, category, **args):
+        span = Span(name, category, args)
+        span.start = time.time()
+        cpu_start = cpu_time()
+        self.notify('start', span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = make_exception_message(exc)
+            raise
+        finally:
+            span.end = time.time()
+            span.cpu = cpu_time() - cpu_start
+            with self.lock:
+                self.spans.append(span)
+            self.notify('end', span)
+
+    def notify(self, event, span):
+        for listener in self.listeners:
+            listener(event, span)
+
+    def transferred(self, span, nbytes):
+        """account for ``nbytes`` copied or downloaded within ``span``"""
+        span.args['bytes'] = span.args.get('bytes', 0) + nbytes
+        self.notify('bytes', span)
+
+    def summary(self):
+        """
+        Aggregate the spans by category and name, returning rows of
+        ``(category, name, count, wall, cpu)`` sorted by wall time
+        """
+        totals = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            count, wall, cpu = totals.get((span.category, span.name), (0, 0.0, 0.0))
+            totals[(span.category, span.name)] = (count + 1, wall + span.wall, cpu + span.cpu)
+        rows = [key + value for key, value in totals.items()]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows
+
+
+recorder = Recorder()
+
+
+def span(name, category, **args):
+    """
+    Time a phase of the run in a ``with`` block::
+
+        with span('copy', 'file', source=source) as copy_span:
+            ...
+    """
+    return recorder.span(name, category, **args)
+
+
+def format_bytes(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            break
+        nbytes /= 1024.0
+    else:
+        unit = 'TB'
+    if unit == 'B':
+        return '%d B' % nbytes
+    return '%.1f %s' % (nbytes, unit)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class Progress(object):
+    """
+    Reports how far along a long operation is: bytes and files done out of
+    their totals (when known), throughput and ETA. On a tty this is a status
+    line that keeps getting updated, otherwise a log line is written every
+    ``interval`` seconds.
+
+    ``update()`` is meant to be called from copy loops, it only adds up the
+    counters and checks the clock unless a report is due. When given a
+    ``span`` the bytes are also accounted to it (see
+    :meth:`Recorder.transferred`).
+    """
+
+    def __init__(self, label, total_bytes=None, total_files=None, span=None, interval=None):
+        self.label = label
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.span = span
+        self.bytes = 0
+        self.files = 0
+        self.handlers = [h for h in console_handlers() if h.is_tty]
+        if interval is None:
+            interval = 0.2 if self.handlers else 10
+        self.interval = interval
+        self.started = time.time()
+        self.next_report = self.started + interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+
+    def update(self, nbytes=0, files=0):
+        self.bytes += nbytes
+        self.files += files
+        if nbytes and self.span is not None:
+            recorder.transferred(self.span, nbytes)
+        now = time.time()
+        if now >= self.next_report:
+            self.next_report = now + self.interval
+            self.report(now)
+
+    def eta(self, elapsed):
+        """seconds left, estimated from the bytes or else the files done"""
+        for done, total in [(self.bytes, self.total_bytes), (self.files, self.total_files)]:
+            if total and done:
+                return elapsed * (total - done) / float(done)
+
+    def status(self, now=None):
+        elapsed = (now or time.time()) - self.started
+        parts = []
+        if self.total_bytes or self.bytes:
+            done = format_bytes(self.bytes)
+            if self.total_bytes:
+                done = '%s/%s (%d%%)' % (
+                    done, format_bytes(self.total_bytes),
+                    min(100, 100 * self.bytes / self.total_bytes)
+                )
+            parts.append(done)
+        if self.total_files or self.files:
+            if self.total_files:
+                parts.append('%s/%s files' % (self.files, self.total_files))
+            else:
+                parts.append('%s files' % self.files)
+        if self.bytes and elapsed > 0:
+            parts.append('%s/s' % format_bytes(self.bytes / elapsed))
+        eta = self.eta(elapsed)
+        if eta is not None:
+            parts.append('ETA %s' % format_duration(eta))
+        else:
+            parts.append('elapsed %s' % format_duration(elapsed))
+        return '%s: %s' % (self.label, ', '.join(parts))
+
+    def report(self, now=None):
+        if self.handlers:
+            for handler in self.handlers:
+                handler.status(id(self), self.status(now))
+        else:
+            logger.info(self.status(now))
+
+    def finish(self):
+        """remove the status line, or log the last report if it took a while"""
+        if self.handlers:
+            for handler in self.handlers:
+                handler.status(id(self), None)
+        elif time.time() - self.started >= self.interval:
+            self.report()
+
+
+class EventStream(object):
+    """
+    A recorder listener that writes one JSON object per line for every span
+    that starts or ends (``step_start``, ``command_end``, ``file_end``...),
+    so that orchestration tools can follow a run without parsing the log
+    output. Bytes transferred are reported as ``bytes`` events, at most once
+    every ``interval`` seconds for each span, and in total when it ends.
+    """
+
+    def __init__(self, stream, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_bytes = {}
+
+    @classmethod
+    def open(cls, target):
+        """``target`` is either a file descriptor number or a path"""
+        try:
+            if target.isdigit():
+                return cls(os.fdopen(int(target), 'w'))
+            return cls(open(target, 'a'))
+        except (IOError, OSError) as exc:
+            raise ICEError('could not open events target %s: %s' % (target, exc))
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        fields['pid'] = os.getpid()
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def __call__(self, event, span):
+        fields = dict(span.args)
+        fields.update(name=span.name, thread=span.thread.name)
+        if event == 'start':
+            self.emit('%s_start' % span.category, **fields)
+        elif event == 'end':
+            self.last_bytes.pop(id(span), None)
+            fields.update(duration=span.wall, cpu=span.cpu)
+            if span.error:
+                fields['error'] = span.error
+            self.emit('%s_end' % span.category, **fields)
+        elif event == 'bytes':
+            now = time.time()
+            if now - self.last_bytes.get(id(span), 0) < self.interval:
+                return
+            self.last_bytes[id(span)] = now
+            self.emit('bytes', op=span.name, bytes=span.args['bytes'], thread=span.thread.name)
+
+
+class TraceExporter(object):
+    """
+    A recorder listener that keeps every span and writes them as Chrome Trace
+    Event Format JSON, which loads in ``about:tracing`` or perfetto. Every
+    thread (the main one, each step worker, the metadata prefetcher) gets its
+    own track so that overlapping work and idle gaps are easy to spot, and
+    bytes transferred are plotted as counters.
+    """
+
+    def __init__(self, path, started=None):
+        self.path = path
+        self.started = started or time.time()
+        self.lock = threading.Lock()
+        self.tracks = {}
+        self.events = []
+
+    def track(self, thread):
+        with self.lock:
+            if thread not in self.tracks:
+                self.tracks[thread] = len(self.tracks) + 1
+                self.events.append(dict(
+                    ph='M',
+                    name='thread_name',
+                    pid=os.getpid(),
+                    tid=self.tracks[thread],
+                    args=dict(name=thread.name),
+                ))
+            return self.tracks[thread]
+
+    def microseconds(self, timestamp):
+        return int((timestamp - self.started) * 1000000)
+
+    def __call__(self, event, span):
+        if event == 'end':
+            args = dict(span.args)
+            if span.error:
+                args['error'] = span.error
+            trace_event = dict(
+                ph='X',
+                name=span.name,
+                cat=span.category,
+                ts=self.microseconds(span.start),
+                dur=self.microseconds(span.end) - self.microseconds(span.start),
+                pid=os.getpid(),
+                tid=self.track(span.thread),
+                args=args,
+            )
+        elif event == 'bytes':
+            trace_event = dict(
+                ph='C',
+                name='bytes %s' % span.name,
+                ts=self.microseconds(time.time()),
+                pid=os.getpid(),
+                args=dict(bytes=span.args['bytes']),
+            )
+        else:
+            return
+        with self.lock:
+            self.events.append(trace_event)
+
+    def write(self):
+        with self.lock:
+            trace = dict(traceEvents=list(self.events), displayTimeUnit='ms')
+        with open(self.path, 'w') as trace_file:
+            json.dump(trace, trace_file)
+        logger.info('trace of the run written to %s', self.path)
+
+
+def report_timings():
+    """
+    Log a table with the wall and CPU time spent on every kind of span, if
+    anything was timed at all
+    """
+    rows = recorder.summary()
+    if not rows:
+        return
+    row_format = '%-10s %-32s %6s %10s %10s'
+    logger.info('')
+    logger.info('{markup} Timings {markup}'.format(markup='===='))
+    logger.info('')
+    logger.info(row_format, 'category', 'name', 'count', 'wall (s)', 'cpu (s)')
+    for category, name, count, wall, cpu in rows:
+        logger.info(row_format, category, name[:32], count, '%.2f' % wall, '%.2f' % cpu)
+    logger.info(
+        'total: %.2fs wall, %.2fs cpu',
+        time.time() - recorder.started,
+        cpu_time() - recorder.cpu_started,
+    )
+
+
+class Profiler(object):
+    """
+    Profiles the in-process work with cProfile when enabled. A profile only
+    sees the thread it was enabled in, so each thread that does work (the
+    main one and the step workers) is profiled on its own and the results
+    are merged when reporting.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    def run(self, func, *a, **kw):
+        if not self.enabled:
+            return func(*a, **kw)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        return profile.runcall(func, *a, **kw)
+
+    def report(self, path, limit=20):
+        """dump the merged stats to ``path`` and log the top entries"""
+        if not self.profiles:
+            return
+        output = StringIO()
+        stats = pstats.Stats(self.profiles[0], stream=output)
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0755)
+        stats.dump_stats(path)
+        stats.sort_stats('cumulative').print_stats(limit)
+        logger.info('profile stats written to %s', path)
+        for line in output.getvalue().splitlines():
+            logger.debug(line)
+
+
+profiler = Profiler()
+
+
 # =============================================================================
 # Templates
 # =============================================================================
@@ -530,6 +1287,324 @@ apt_templates = {
 
 
 
+# =============================================================================
+# Locks
+# =============================================================================
+
+
+class FileLock(object):
+    """
+    A lock shared by every ``ice_setup`` run on this host, with ``flock(2)``
+    on a file in ``STATE_DIR/locks``. It is reentrant for the thread that
+    holds it, and the other threads of the same run wait for it like other
+    runs do. ``shared`` locks can be held by many at once, but not along
+    with the exclusive one of the same name.
+
+    The holder writes who it is to the lock file, so that a run that has to
+    wait (or give up, when ``wait`` is off, see ``--no-wait``) can tell
+    which run has it.
+    """
+
+    # wait for locks held by others, rather than failing with ``LockHeld``
+    wait = True
+    poll_interval = 0.1
+
+    def __init__(self, name, description=None, shared=False):
+        self.name = name
+        self.description = description or name
+        self.shared = shared
+        self.local = threading.local()
+
+    @property
+    def path(self):
+        return os.path.join(STATE_DIR, 'locks', '%s.lock' % self.name)
+
+    def holder(self):
+        """who holds the lock, as far as the lock file says"""
+        try:
+            with open(self.path) as f:
+                info = json.loads(f.read() or '{}')
+        except (IOError, ValueError):
+            info = {}
+        if not info:
+            return 'another run'
+        return 'pid %s (%s) since %s' % (
+            info.get('pid'), info.get('command'),
+            time.strftime('%H:%M:%S', time.localtime(info.get('started', 0))),
+        )
+
+    def acquire(self, wait=None):
+        if getattr(self.local, 'depth', 0):
+            self.local.depth += 1
+            return
+        wait = self.wait if wait is None else wait
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0755)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        waiting = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                    break
+                except IOError as exc:
+                    if exc.errno not in (EAGAIN, EACCES, EINTR):
+                        raise
+                if not wait:
+                    raise LockHeld(self, self.holder())
+                if not waiting:
+                    waiting = True
+                    logger.info('waiting for %s, in use by %s', self.description, self.holder())
+                # polling keeps the wait responsive to Ctrl-C
+                time.sleep(self.poll_interval)
+        except BaseException:
+            os.close(fd)
+            raise
+        if not self.shared:
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps(dict(
+                pid=os.getpid(),
+                command=' '.join(['ice_setup'] + sys.argv[1:]),
+                started=time.time(),
+            )))
+        self.local.fd = fd
+        self.local.depth = 1
+
+    def release(self):
+        self.local.depth -= 1
+        if self.local.depth:
+            return
+        fd = self.local.fd
+        self.local.fd = None
+        if not self.shared:
+            os.ftruncate(fd, 0)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+repo_locks = {}
+repo_locks_lock = threading.Lock()
+
+
+def repo_lock(path):
+    """
+    The lock of the published repo at ``path``, held while it is published,
+    synced, rolled back, deduplicated or replicated
+    """
+    path = os.path.abspath(path)
+    with repo_locks_lock:
+        if path not in repo_locks:
+            repo_locks[path] = FileLock(
+                'repo%s' % path.replace(os.sep, '_'),
+                description='the %s repo (%s)' % (os.path.basename(path), path),
+            )
+        return repo_locks[path]
+
+
+# publishing adds blobs to the store and links them, the store can only be
+# garbage collected when nothing is being published
+store_publish_lock = FileLock('store', description='the package store', shared=True)
+store_gc_lock = FileLock('store', description='the package store')
+
+
+# =============================================================================
+# Throttling
+# =============================================================================
+
+
+# ``ioprio_set(2)`` has no libc wrapper, these are its syscall numbers
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'ppc64': 273,
+    'ppc64le': 273,
+    's390x': 282,
+}
+
+
+def load_ioprio_set():
+    """
+    A function setting the I/O scheduling class and level of the current
+    process with ``ioprio_set(2)``, or ``None`` when it is not available
+    """
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if platform.system() != 'Linux' or number is None:
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        syscall = libc.syscall
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    def ioprio_set(io_class, level):
+        # IOPRIO_WHO_PROCESS, and 0 for the calling process
+        return syscall(number, 1, 0, (io_class << 13) | level)
+    return ioprio_set
+
+
+def parse_rate(value):
+    """
+    Bytes per second from ``value`` like ``512K``, ``20M`` or ``1.5G`` (a
+    ``B`` or ``/s`` after the unit is fine too), ``None`` for no limit when
+    it is empty, ``0`` or ``off``
+    """
+    value = value.strip().lower()
+    if value.endswith('/s'):
+        value = value[:-2]
+    if value.endswith('b'):
+        value = value[:-1]
+    if value in ('', '0', 'off', 'none'):
+        return None
+    multiplier = 1
+    for power, unit in enumerate('kmg', 1):
+        if value.endswith(unit):
+            value, multiplier = value[:-1], 1024 ** power
+    rate = int(float(value) * multiplier)
+    if rate <= 0:
+        raise ValueError('not a rate: %s' % value)
+    return rate
+
+
+def parse_ionice(value):
+    """``(class, level)`` for ``idle``, or for a best-effort level from 0 to 7"""
+    if value == 'idle':
+        return 3, 0
+    if value.isdigit() and int(value) <= 7:
+        return 2, int(value)
+    raise ValueError('not an I/O priority: %s' % value)
+
+
+def format_rate(rate):
+    return '%s/s' % format_bytes(rate) if rate else 'no limit'
+
+
+class Throttle(object):
+    """
+    Keeps copying, downloading and extracting from saturating the disks of
+    a host that serves packages while repos are published. A token bucket
+    limits the bytes per second of all the copy loops together, whichever
+    thread they run in, and commands run with a lower CPU (``nice``) and
+    I/O (``ionice``) priority.
+
+    The rate can be changed while a run is in progress by writing it (e.g.
+    ``5M``, or ``off``) to the control file, ``STATE_DIR/throttle``, which
+    is checked about once a second. Removing it goes back to the rate the
+    run was started with.
+    """
+
+    check_interval = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.nice = None
+        self.ionice = None
+        self.ioprio_set = None
+        # modification time and rate of the control file, when there is one
+        self.control = None
+        self.checked = 0
+        self.tokens = 0
+        self.refilled = time.time()
+
+    @property
+    def path(self):
+        return os.path.join(STATE_DIR, 'throttle')
+
+    def configure(self, rate=None, nice=None, ionice=None):
+        """set up from the ``--throttle``, ``--nice`` and ``--ionice`` values"""
+        try:
+            self.rate = parse_rate(rate) if rate else None
+            self.nice = int(nice) if nice else None
+            self.ionice = parse_ionice(ionice) if ionice else None
+        except ValueError as error:
+            raise ICEError(str(error))
+        if self.ionice and self.ioprio_set is None:
+            self.ioprio_set = load_ioprio_set()
+            if self.ioprio_set is None:
+                logger.warning('cannot set I/O priorities on %s, ignoring --ionice', platform.machine())
+        self.checked = 0
+        if self.rate:
+            logger.info('throttling to %s', format_rate(self.rate))
+
+    def current_rate(self):
+        now = time.time()
+        if now - self.checked >= self.check_interval:
+            self.checked = now
+            self.reload()
+        if self.control is not None:
+            return self.control[1]
+        return self.rate
+
+    def reload(self):
+        """pick up changes to the control file"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            if self.control is not None:
+                logger.info('%s was removed, throttling back to %s', self.path, format_rate(self.rate))
+                self.control = None
+            return
+        if self.control is not None and self.control[0] == mtime:
+            return
+        previous = self.control[1] if self.control is not None else self.rate
+        try:
+            with open(self.path) as f:
+                rate = parse_rate(f.read())
+        except (IOError, ValueError) as error:
+            # keep going at the same rate until the file is fixed
+            logger.warning('ignoring %s: %s', self.path, error)
+            self.control = (mtime, previous)
+            return
+        self.control = (mtime, rate)
+        logger.info('throttling to %s, from %s', format_rate(rate), self.path)
+
+    def consume(self, nbytes):
+        """wait until ``nbytes`` more bytes fit in the rate"""
+        with self.lock:
+            rate = self.current_rate()
+            if not rate:
+                return
+            now = time.time()
+            # at most a second worth of bytes can be saved up
+            self.tokens = min(rate, self.tokens + (now - self.refilled) * rate)
+            self.refilled = now
+            # the bytes are taken right away, the threads that come next
+            # wait for them as well
+            self.tokens -= nbytes
+            delay = -self.tokens / float(rate)
+        if delay > 0:
+            time.sleep(delay)
+
+    def lower_priority(self):
+        """
+        Lower the priority of a command about to run, as the ``preexec_fn``
+        of ``subprocess.Popen``. This is in the child, nothing can be logged.
+        """
+        if self.nice:
+            os.nice(self.nice)
+        if self.ionice and self.ioprio_set is not None:
+            self.ioprio_set(*self.ionice)
+
+
+throttle = Throttle()
+
 
 # =============================================================================
 # Distributions
@@ -587,34 +1662,294 @@ def append_item_or_list(list_, append):
 # XXX These probably do not need to be full of classmethods but can be
 # instantiated when the distro detection happens
 
+# yum, rpm, apt-get and apt-key do not like running concurrently, steps that
+# run in parallel (and other runs) need to take turns when calling them
+package_manager_lock = FileLock('package-manager', description='the package manager')
+
+
+class MetadataPrefetcher(object):
+    """
+    Builds package manager metadata in a background thread while other work
+    (like copying the rest of the repos) is going on. Commands run one at
+    a time, taking turns with the other package manager calls, and a failure
+    is only a warning since the metadata will be loaded again when needed.
+
+    Callers must not hold ``package_manager_lock`` when calling ``wait()``.
+    """
+
+    def __init__(self):
+        self.commands = Queue.Queue()
+        self.worker = None
+        self.pending = 0
+        self.idle = threading.Condition()
+
+    def start(self, cmd):
+        with self.idle:
+            self.pending += 1
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, name='metadata-prefetch')
+                self.worker.daemon = True
+                self.worker.start()
+        self.commands.put(cmd)
+
+    def _work(self):
+        while True:
+            cmd = self.commands.get()
+            try:
+                with package_manager_lock:
+                    run(cmd, stop_on_nonzero=False)
+            except Exception as exc:
+                logger.warning('metadata prefetch failed: %s', make_exception_message(exc))
+            with self.idle:
+                self.pending -= 1
+                self.idle.notify_all()
+
+    def wait(self):
+        """block until every prefetch started so far is done"""
+        with self.idle:
+            while self.pending:
+                # a timeout keeps the wait responsive to Ctrl-C
+                self.idle.wait(0.5)
+
+
+metadata_prefetcher = MetadataPrefetcher()
+
+# repo ids of the local repos, as defined in their yum templates
+yum_repo_ids = {
+    'Calamari': 'calamari',
+    'Installer': 'ceph_deploy',
+    'Tools': 'tools',
+}
+
+
+RPM_LEAD_MAGIC = '\xed\xab\xee\xdb'
+RPM_HEADER_MAGIC = '\x8e\xad\xe8\x01'
+
+RPMTAG_EPOCH = 1003
+
+
+def read_rpm_header(f):
+    """
+    Read a header structure of a package at the current position of ``f``
+
+    :returns: its raw bytes and its entries as ``{tag: (type, offset, count)}``
+              into the raw bytes
+    """
+    intro = f.read(16)
+    if len(intro) < 16 or intro[:4] != RPM_HEADER_MAGIC:
+        raise ValueError('bad header')
+    count, size = struct.unpack('>II', intro[8:])
+    index = f.read(16 * count)
+    data = f.read(size)
+    if len(index) < 16 * count or len(data) < size:
+        raise ValueError('truncated header')
+    entries = {}
+    for number in range(count):
+        tag, kind, offset, entry_count = struct.unpack('>IIII', index[16 * number:16 * (number + 1)])
+        entries[tag] = (kind, 16 + 16 * count + offset, entry_count)
+    return intro + index + data, entries
+
+
+def rpm_header_value(raw, entry):
+    """the value of a string, binary or int32 header entry"""
+    kind, offset, count = entry
+    if kind == 4:
+        return struct.unpack('>I', raw[offset:offset + 4])[0]
+    if kind == 7:
+        return raw[offset:offset + count]
+    return raw[offset:raw.index('\0', offset)]
+
+
+def read_rpm_epoch(path):
+    """
+    The epoch of the package at ``path`` as a string, ``'0'`` if it has
+    none, read from its header like ``rpm -qp --qf '%{EPOCHNUM}'`` does.
+
+    :returns: the epoch, or ``None`` if ``path`` is not a readable package
+    """
+    try:
+        with open(path, 'rb') as f:
+            lead = f.read(96)
+            if len(lead) < 96 or lead[:4] != RPM_LEAD_MAGIC:
+                return None
+            raw, signature = read_rpm_header(f)
+            # the header after the signature is aligned to 8 bytes
+            f.read(-len(raw) % 8)
+            raw, header = read_rpm_header(f)
+    except (IOError, ValueError):
+        return None
+    if RPMTAG_EPOCH not in header:
+        return '0'
+    return str(rpm_header_value(raw, header[RPMTAG_EPOCH]))
+
+
+def parse_rpm_file_name(file_name):
+    """
+    Split the file name of an rpm into its name, version, release and arch.
+    File names do not carry the epoch, so it is always ``0`` (see
+    :func:`read_rpm_epoch`).
+
+    :returns: ``(name, epoch, version, release, arch)``, or ``None`` if
+    ``file_name`` does not look like ``name-version-release.arch.rpm``
+    """
+    if not file_name.endswith('.rpm'):
+        return None
+    nvr, _, arch = file_name[:-len('.rpm')].rpartition('.')
+    parts = nvr.rsplit('-', 2)
+    if not arch or len(parts) != 3 or not all(parts):
+        return None
+    name, version, release = parts
+    return name, '0', version, release, arch
+
+
+def rpmvercmp(one, two):
+    """
+    Compare two version (or release) strings the way rpm does: alphabetic
+    and numeric segments are compared one by one, numeric ones as numbers
+    and always newer than alphabetic ones, ``~`` sorts before anything
+    (even the end of the string) and ``^`` after the end of the string but
+    before anything else.
+
+    :returns: ``1``, ``0`` or ``-1`` like ``cmp()``
+    """
+    if one == two:
+        return 0
+    i = j = 0
+    while i < len(one) or j < len(two):
+        while i < len(one) and not one[i].isalnum() and one[i] not in '~^':
+            i += 1
+        while j < len(two) and not two[j].isalnum() and two[j] not in '~^':
+            j += 1
+
+        a = one[i:i + 1]
+        b = two[j:j + 1]
+        if a == '~' or b == '~':
+            if a != '~':
+                return 1
+            if b != '~':
+                return -1
+            i += 1
+            j += 1
+            continue
+        if a == '^' or b == '^':
+            if not a:
+                return -1
+            if not b:
+                return 1
+            if a != '^':
+                return 1
+            if b != '^':
+                return -1
+            i += 1
+            j += 1
+            continue
+        if not (a and b):
+            break
+
+        is_number = a.isdigit()
+        kind = str.isdigit if is_number else str.isalpha
+        start_i, start_j = i, j
+        while i < len(one) and kind(one[i]):
+            i += 1
+        while j < len(two) and kind(two[j]):
+            j += 1
+        segment_one = one[start_i:i]
+        segment_two = two[start_j:j]
+        if not segment_two:
+            # the segments are of different kinds
+            return 1 if is_number else -1
+        if is_number:
+            segment_one = segment_one.lstrip('0')
+            segment_two = segment_two.lstrip('0')
+            if len(segment_one) != len(segment_two):
+                return 1 if len(segment_one) > len(segment_two) else -1
+        if segment_one != segment_two:
+            return 1 if segment_one > segment_two else -1
+
+    if i >= len(one) and j >= len(two):
+        return 0
+    return 1 if i < len(one) else -1
+
+
+def compare_evr(one, two):
+    """compare two ``(epoch, version, release)`` tuples like rpm does"""
+    for a, b in zip(one, two):
+        result = rpmvercmp(a, b)
+        if result:
+            return result
+    return 0
+
+
+def prune_packages(path, keep):
+    """
+    Remove all but the ``keep`` newest versions of every package (by name
+    and arch) in the tree at ``path``. Files that do not look like rpms are
+    left alone. The epoch comes from the header of each package, and is
+    ``0`` for the ones whose header cannot be read.
+
+    :returns: the ``(path, size)`` of the removed rpms, and how many are left
+    """
+    packages = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for file_name in filenames:
+            nevra = parse_rpm_file_name(file_name)
+            if nevra is None:
+                continue
+            name, epoch, version, release, arch = nevra
+            package_path = os.path.join(dirpath, file_name)
+            epoch = read_rpm_epoch(package_path) or epoch
+            packages.setdefault((name, arch), []).append(
+                ((epoch, version, release), package_path)
+            )
+
+    removed = []
+    kept = 0
+    for versions in packages.values():
+        versions.sort(cmp=lambda a, b: compare_evr(b[0], a[0]))
+        kept += len(versions[:keep])
+        for evr, package_path in versions[keep:]:
+            size = os.path.getsize(package_path)
+            os.remove(package_path)
+            removed.append((package_path, size))
+    return removed, kept
+
+
 class Yum(object):
 
+    @classmethod
+    def repo_file_path(cls, file_name=None, etc_path=None, **kw):
+        return os.path.join(etc_path or YUM_REPOS_DIR, '%s.repo' % (file_name or 'ice'))
+
+    @classmethod
+    def repo_file_contents(cls, template_name, repo_url, gpg_url, use_gpg=True, **kw):
+        """
+        ``repo_url`` can be a list of mirrors, they all go in the one
+        ``baseurl`` and yum picks one at random for every client (the
+        default ``failovermethod=roundrobin``), trying the others if it
+        fails
+        """
+        template = yum_templates[template_name]
+        return template.format(
+            gpg_url=gpg_url,
+            repo_url=join_mirrors(repo_url),
+            gpg_check=1 if use_gpg else 0,
+        )
+
     @classmethod
     def create_repo_file(cls, template_name, repo_url, gpg_url, file_name=None, use_gpg=True, **kw):
         """set the contents of /etc/yum.repos.d/ice.repo"""
-        etc_path = kw.pop('etc_path', '/etc/yum.repos.d')
-        file_name = '%s.repo' % (file_name or 'ice')
-        template = yum_templates[template_name]
-        repo_file_path = os.path.join(etc_path, file_name)
+        repo_file_path = cls.repo_file_path(file_name, **kw)
         with open(repo_file_path, 'w') as repo_file:
-            contents = template.format(
-                gpg_url=gpg_url,
-                repo_url=repo_url,
-                gpg_check=1 if use_gpg else 0,
+            repo_file.write(
+                cls.repo_file_contents(template_name, repo_url, gpg_url, use_gpg=use_gpg)
             )
-            repo_file.write(contents)
 
     @classmethod
     def print_repo_file(cls, template_name, repo_url, gpg_url, file_name=None, use_gpg=True, **kw):
         """print repo file as it would be written to yum.repos.d"""
-        template = yum_templates[template_name]
         logger.info('Contents of %s repo file:' % template_name)
         logger.info(
-            template.format(
-                gpg_url=gpg_url,
-                repo_url=repo_url,
-                gpg_check=1 if use_gpg else 0,
-            )
+            cls.repo_file_contents(template_name, repo_url, gpg_url, use_gpg=use_gpg)
         )
 
     @classmethod
@@ -627,7 +1962,8 @@ class Yum(object):
             '--import',
             gpg_path,
         ]
-        run(cmd)
+        with package_manager_lock:
+            run(cmd)
 
     @classmethod
     def install(cls, package):
@@ -637,15 +1973,34 @@ class Yum(object):
             'install',
         ]
         append_item_or_list(cmd, package)
-        run(cmd)
+        metadata_prefetcher.wait()
+        with package_manager_lock:
+            run(cmd)
 
     @classmethod
     def update(cls):
-        # stub
-        pass
+        # yum loads metadata on demand, just make sure the prefetched
+        # metadata is in place
+        metadata_prefetcher.wait()
+
+    @classmethod
+    def prefetch(cls, name):
+        """build the metadata cache for a local repo in the background"""
+        cmd = [
+            'yum',
+            '-q',
+            'makecache',
+            '--disablerepo=*',
+            '--enablerepo=%s' % yum_repo_ids.get(name, name),
+        ]
+        metadata_prefetcher.start(cmd)
 
     @classmethod
-    def sync(cls, repos, distro):
+    def sync(cls, repos, distro, keep=2):
+        """
+        Sync ``repos`` from their upstream repos, keeping the ``keep`` newest
+        versions of each package
+        """
         # resolve needed dependencies
         if not which('reposync'):
             cls.install('yum-utils')
@@ -658,33 +2013,119 @@ class Yum(object):
                     '6': ['rhel-6-server-rhceph-1.3-osd-rpms'],
                     '7': ['rhel-7-server-rhceph-1.3-osd-rpms']
                 },
-                'destination': '/opt/calamari/webapp/content/OSD'
+                'destination': os.path.join(REMOTE_REPO_DIR, 'OSD')
             },
             'ceph-mon': {
                 'sources': {
                     '6': ['rhel-6-server-rhceph-1.3-mon-rpms'],
                     '7': ['rhel-7-server-rhceph-1.3-mon-rpms']
                 },
-                'destination': '/opt/calamari/webapp/content/MON'
+                'destination': os.path.join(REMOTE_REPO_DIR, 'MON')
             },
         }
 
+        # nothing is synced if the new packages would not fit
+        sizes = {}
+        plan = CapacityPlan()
         for repo in repos:
             destination = repo_mapping[repo]['destination']
-            for repo_id in repo_mapping[repo]['sources'][distro.normalized_release.major]:
-                run(
-                    [
-                        'reposync',
-                        '--repoid=%s' % repo_id,
-                        '--newest-only',
-                        '--norepopath',
-                        '-p',
-                        destination
-                    ]
-                )
+            sizes[repo] = cls.package_sizes(repo_mapping[repo]['sources'][distro.normalized_release.major])
+            nbytes, count = cls.sync_size(sizes[repo], destination)
+            plan.add(destination, nbytes, count)
+        plan.check(sample=False)
 
-            run(['createrepo', destination ])
-            run(['yum', 'clean', 'all'])
+        for repo in repos:
+            destination = repo_mapping[repo]['destination']
+            repo_ids = repo_mapping[repo]['sources'][distro.normalized_release.major]
+            # packages are synced into a new generation of the repo, which
+            # starts as a hardlinked copy of the current one and is only
+            # served once the sync is complete
+            with span(repo, 'sync', destination=destination):
+                with repo_lock(destination):
+                    with Generations(destination).new(from_current=True) as target:
+                        if not os.path.isdir(target):
+                            os.makedirs(target, 0755)
+                        # the links are shared with the previous generations,
+                        # which reposync must not change by resuming a download
+                        removed, copied = detach_packages(target, sizes[repo])
+                        logger.debug(
+                            'removed %s changed packages and copied %s before syncing %s',
+                            removed, copied, repo
+                        )
+                        # reposync does not say how many packages it will fetch,
+                        # so only the ones done so far can be reported
+                        with Progress('syncing %s' % repo) as progress:
+                            def count_package(line):
+                                if '.rpm' in line:
+                                    progress.update(files=1)
+                            for repo_id in repo_ids:
+                                run(
+                                    [
+                                        'reposync',
+                                        '--repoid=%s' % repo_id,
+                                        '--newest-only',
+                                        '--norepopath',
+                                        '-p',
+                                        target
+                                    ],
+                                    on_output=count_package,
+                                )
+
+                        # old versions go before createrepo, so that it does
+                        # not have to scan them
+                        removed, kept = prune_packages(target, keep)
+                        started = time.time()
+                        run(['createrepo', target])
+                        scan_time = time.time() - started
+                        if removed:
+                            logger.info(
+                                'pruned %s old packages from %s (%s), which saves createrepo about %.1fs',
+                                len(removed), repo, format_bytes(sum(size for _, size in removed)),
+                                scan_time * len(removed) / max(kept, 1),
+                            )
+                with package_manager_lock:
+                    run(['yum', 'clean', 'all'])
+
+    @classmethod
+    def package_sizes(cls, repo_ids):
+        """
+        The size of every package of ``repo_ids`` by file name, according to
+        ``repoquery``. ``None`` when that cannot be known.
+        """
+        if not which('repoquery'):
+            logger.debug('repoquery is not available, cannot tell the size of the packages')
+            return None
+        sizes = {}
+        for repo_id in repo_ids:
+            stdout, stderr, returncode = run_call([
+                'repoquery',
+                '--repoid=%s' % repo_id,
+                '--all',
+                '--queryformat=%{packagesize} %{name}-%{version}-%{release}.%{arch}.rpm',
+            ])
+            if returncode:
+                logger.debug('repoquery failed for %s', repo_id)
+                return None
+            for line in stdout:
+                size, _, name = line.strip().partition(' ')
+                if size.isdigit():
+                    sizes[name] = int(size)
+        return sizes
+
+    @classmethod
+    def sync_size(cls, sizes, destination):
+        """
+        The bytes and number of the packages in ``sizes`` (see
+        :meth:`package_sizes`) that are not in ``destination`` yet. When
+        the sizes are not known in advance, nothing is counted.
+        """
+        if sizes is None:
+            return 0, 0
+        missing = [
+            size for name, size in sizes.items()
+            if not os.path.exists(os.path.join(destination, name))
+        ]
+        return sum(missing), len(missing)
 
     @classmethod
     def enumerate_repo(cls, path):
@@ -707,25 +2148,47 @@ class Yum(object):
 
 class Apt(object):
 
+    @classmethod
+    def repo_file_path(cls, file_name=None, etc_path=None, **kw):
+        return os.path.join(etc_path or APT_SOURCES_DIR, '%s.list' % (file_name or 'ice'))
+
+    @classmethod
+    def repo_file_contents(cls, template_name, repo_url, gpg_url, codename=None, hostname=None, **kw):
+        """
+        ``repo_url`` can be a list of mirrors, which get a source line each.
+        apt fetches from the first one that has a package, so they are
+        ordered by ``hostname`` to spread the hosts across them, see
+        ``order_mirrors``
+        """
+        template = apt_templates[template_name]
+        if isinstance(repo_url, basestring):
+            return template.format(repo_url=repo_url, codename=codename)
+        return ''.join(
+            template.format(repo_url=url, codename=codename)
+            for url in order_mirrors(repo_url, key=hostname)
+        )
+
     @classmethod
     def create_repo_file(cls, template_name, repo_url, gpg_url, file_name=None, **kw):
         """add ceph deb repo to sources.list"""
-        etc_path = kw.pop('etc_path', '/etc/apt/sources.list.d')
-        file_name = '%s.list' % (file_name or 'ice')
-        list_file_path = os.path.join(etc_path, file_name)
-        template = apt_templates[template_name]
+        list_file_path = cls.repo_file_path(file_name, **kw)
         with open(list_file_path, 'w') as list_file:
-            list_file.write(template.format(
-                repo_url=repo_url, codename=kw.pop('codename'))
+            list_file.write(
+                cls.repo_file_contents(
+                    template_name, repo_url, gpg_url,
+                    codename=kw.pop('codename'), hostname=kw.pop('hostname', None),
+                )
             )
 
     @classmethod
     def print_repo_file(cls, template_name, repo_url, gpg_url, file_name=None, **kw):
         """print deb repo as it would be written to sources.list"""
-        template = apt_templates[template_name]
         logger.info('Contents of %s deb sources.list file:' % template_name )
-        logger.info(template.format(
-            repo_url=repo_url, codename=kw.pop('codename'))
+        logger.info(
+            cls.repo_file_contents(
+                template_name, repo_url, gpg_url,
+                codename=kw.pop('codename'), hostname=kw.pop('hostname', None),
+            )
         )
 
     @classmethod
@@ -738,7 +2201,8 @@ class Apt(object):
             'add',
             gpg_path,
         ]
-        run(cmd)
+        with package_manager_lock:
+            run(cmd)
 
     @classmethod
     def install(cls, package):
@@ -751,7 +2215,9 @@ class Apt(object):
             '--assume-yes',
         ]
         append_item_or_list(cmd, package)
-        run(cmd)
+        metadata_prefetcher.wait()
+        with package_manager_lock:
+            run(cmd)
 
     @classmethod
     def update(cls):
@@ -760,7 +2226,25 @@ class Apt(object):
             '-q',
             'update',
         ]
-        run(cmd)
+        metadata_prefetcher.wait()
+        with package_manager_lock:
+            run(cmd)
+
+    @classmethod
+    def prefetch(cls, name, etc_path=None):
+        """
+        fetch the indexes of a local repo in the background, looking only at
+        its own sources list file and leaving the other lists alone
+        """
+        cmd = [
+            'apt-get',
+            '-q',
+            'update',
+            '-o', 'Dir::Etc::sourcelist=%s' % cls.repo_file_path(name, etc_path=etc_path),
+            '-o', 'Dir::Etc::sourceparts=-',
+            '-o', 'APT::Get::List-Cleanup=0',
+        ]
+        metadata_prefetcher.start(cmd)
 
     @classmethod
     def enumerate_repo(cls, path):
@@ -786,7 +2270,24 @@ class Debian(object):
     pkg_manager = Apt()
 
 
-def pin_local_repos(path='/etc/apt/preferences.d/rhcs.pref', distro=None):
+def repo_file_is_current(pkg_manager, template_name, repo_url, gpg_url, file_name=None, **kw):
+    """
+    Check if the repo file that ``create_repo_file`` would write with these
+    arguments is already in place with the exact same contents.
+    """
+    repo_file_path = pkg_manager.repo_file_path(file_name, **kw)
+    try:
+        with open(repo_file_path) as repo_file:
+            contents = repo_file.read()
+    except IOError:
+        return False
+    kw.pop('etc_path', None)
+    return contents == pkg_manager.repo_file_contents(
+        template_name, repo_url, gpg_url, **kw
+    )
+
+
+def pin_local_repos(path=None, distro=None):
     """ Write apt preferences file """
 
     # Skip this on non-Apt-based systems.
@@ -798,7 +2299,7 @@ def pin_local_repos(path='/etc/apt/preferences.d/rhcs.pref', distro=None):
                 "Package: *\n"
                 "Pin: release o=/Red Hat/\n"
                 "Pin-Priority: 999\n")
-    with open(path, 'wb') as fout:
+    with open(path or APT_PREFERENCES_FILE, 'wb') as fout:
         fout.write(template)
 
 
@@ -812,36 +2313,56 @@ debian = Debian
 # =============================================================================
 
 
+# flags records that carry the output of a command, see ``ConsoleHandler``
+COMMAND_OUTPUT = {'command_output': True}
+
+
+def command_span(cmd):
+    return span(os.path.basename(cmd[0]), 'command', cmd=' '.join(cmd))
+
+
+def log_output(stream, log, on_line=None):
+    for line in iter(stream.readline, ''):
+        line = line.rstrip('\n')
+        log(line, extra=COMMAND_OUTPUT)
+        if on_line is not None:
+            on_line(line)
+
+
 def run(cmd, **kw):
+    """
+    Run ``cmd`` logging its output as it goes. ``on_output`` can be a
+    callable that gets every line of standard output, to follow the progress
+    of the command.
+    """
     logger.info('Running command: %s' % ' '.join(cmd))
     stop_on_nonzero = kw.pop('stop_on_nonzero', True)
+    on_output = kw.pop('on_output', None)
+
+    with command_span(cmd) as cmd_span:
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            preexec_fn=throttle.lower_priority,
+            **kw
+        )
 
-    process = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        close_fds=True,
-        **kw
-    )
+        # both pipes are drained at the same time, so that the command is
+        # never blocked writing to one while the other one is being read
+        stderr_reader = threading.Thread(
+            target=log_output,
+            args=(process.stderr, logger.warning),
+            name='%s-stderr' % threading.current_thread().name,
+        )
+        stderr_reader.daemon = True
+        stderr_reader.start()
+        log_output(process.stdout, logger.debug, on_output)
+        stderr_reader.join()
 
-    if process.stderr:
-        while True:
-            err = process.stderr.readline()
-            if err == '' and process.poll() is not None:
-                break
-            if err != '':
-                logger.warning(err)
-                sys.stderr.flush()
-    if process.stdout:
-        while True:
-            out = process.stdout.readline()
-            if out == '' and process.poll() is not None:
-                break
-            if out != '':
-                logger.debug(out.strip('\n'))
-                sys.stdout.flush()
+        returncode = cmd_span.args['returncode'] = process.wait()
 
-    returncode = process.wait()
     if returncode != 0:
         error_msg = "command returned non-zero exit status: %s" % returncode
         if stop_on_nonzero:
@@ -857,12 +2378,15 @@ def run_get_stdout(cmd, **kw):
 
     if not quiet:
         logger.info('Running command: %s' % ' '.join(cmd))
-    process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kw
-    )
-    out, err = process.communicate()
+    with command_span(cmd) as cmd_span:
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            preexec_fn=throttle.lower_priority, **kw
+        )
+        out, err = process.communicate()
+        cmd_span.args['returncode'] = process.returncode
     if err:
-        logger.warning(err)
+        logger.warning(err, extra=COMMAND_OUTPUT)
 
     if process.returncode != 0:
         error_msg = "command returned non-zero exit status: %s" % process.returncode
@@ -873,6 +2397,14 @@ def run_get_stdout(cmd, **kw):
     return out
 
 
+def split_lines(output):
+    """like ``readlines()`` with the newlines stripped"""
+    lines = output.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
 def run_call(cmd, **kw):
     """
     a callable that will execute a subprocess without raising an exception if
@@ -882,12 +2414,18 @@ def run_call(cmd, **kw):
     API, it does nothing by default.
     """
     logger.info('Running command: %s' % ' '.join(cmd))
-    process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kw
-    )
-    stdout = [line.strip('\n') for line in process.stdout.readlines()]
-    stderr = [line.strip('\n') for line in process.stderr.readlines()]
-    return stdout, stderr, process.wait()
+    with command_span(cmd) as cmd_span:
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            preexec_fn=throttle.lower_priority, **kw
+        )
+        # reading one pipe to the end before the other would block the
+        # command as soon as it fills the pipe that is not being read
+        out, err = process.communicate()
+        stdout = split_lines(out)
+        stderr = split_lines(err)
+        returncode = cmd_span.args['returncode'] = process.returncode
+    return stdout, stderr, returncode
 
 
 # =============================================================================
@@ -1020,45 +2558,873 @@ def is_url(url_wannabe):
         return False
 
 
-def download_file(url, filename=None, destination_dir='/opt/ice/tmp'):
+def download_file(url, filename=None, destination_dir=None):
     """
     Given a URL, download the contents to a pre-defined destination directory
     If the filename to save already exists it will get removed before starting
-    the actual download.
+    the actual download. The download goes to a temporary file first, so an
+    interrupted one never looks complete.
+
+    Old downloads are removed when the extraction cache is collected, see
+    ``ExtractionCache.gc``.
     """
+    destination_dir = destination_dir or DOWNLOAD_DIR
     if not os.path.exists(destination_dir):
         os.makedirs(destination_dir)
-    url_fd = urllib2.urlopen(urllib2.Request(url))
-    filename_from_url = os.path.basename(urlparse.urlsplit(url_fd.url)[2])
-    filename = filename or filename_from_url
-    destination_path = os.path.join(destination_dir, filename)
-    if os.path.isfile(destination_path):
-        os.remove(destination_path)
-    try:
-        with open(destination_path, 'wb') as f:
-            shutil.copyfileobj(url_fd, f)
-    finally:
-        url_fd.close()
+    with span('download', 'file', url=url) as download_span:
+        url_fd = urllib2.urlopen(urllib2.Request(url))
+        filename_from_url = os.path.basename(urlparse.urlsplit(url_fd.url)[2])
+        filename = filename or filename_from_url
+        destination_path = os.path.join(destination_dir, filename)
+        if os.path.isfile(destination_path):
+            os.remove(destination_path)
+        total = url_fd.info().getheader('Content-Length')
+        progress = Progress(
+            'downloading %s' % filename,
+            total_bytes=int(total) if total and total.isdigit() else None,
+            span=download_span,
+        )
+        partial_path = '%s.part' % destination_path
+        try:
+            with progress:
+                with open(partial_path, 'wb') as f:
+                    while True:
+                        chunk = url_fd.read(1048576)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        progress.update(len(chunk))
+                        throttle.consume(len(chunk))
+            os.rename(partial_path, destination_path)
+        finally:
+            url_fd.close()
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+    ExtractionCache(download_dir=destination_dir).gc(keep=destination_path)
+    return destination_path
+
+
+class ProgressFile(object):
+    """
+    A file that reports the bytes read from it, or written to it, to a
+    :class:`Progress`
+    """
+
+    def __init__(self, fileobj, progress):
+        self.fileobj = fileobj
+        self.progress = progress
 
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.progress.update(len(data))
+        throttle.consume(len(data))
+        return data
 
-def extract_file(file_path):
+    def write(self, data):
+        self.fileobj.write(data)
+        self.progress.update(len(data))
+        throttle.consume(len(data))
+
+    def close(self):
+        self.fileobj.close()
+
+
+def extract_file(file_path, cache=None):
     """
     Decompress/Extract a tar file to a temporary location and return its full
     path so that it can be handled elsewhere.  If ``file_path`` is not a tar
     file and it is a directory holding decompressed files return ``file_path``,
     otherwise raise an error.
 
-    Removal of the temporary directory files is responsibility of the caller.
+    Extracted files are kept in ``cache`` (see ``ExtractionCache``) and
+    reused for archives with the same contents, so the caller must not
+    change or remove them.
     """
     if os.path.isdir(file_path):
         return file_path
     if tarfile.is_tarfile(file_path):
-        tmp_dir = tempfile.mkdtemp()
-        destination = os.path.join(tmp_dir, 'repo')
-        tar = tarfile.open(file_path, 'r:gz')
-        tar.extractall(destination)
-        tar.close()
-        return destination
+        return (cache or ExtractionCache()).get(file_path)
+
+
+def extract_archive(file_path, destination):
+    # the archive is read as a stream, so progress is reported against its
+    # compressed size
+    with span('extract', 'file', path=file_path) as extract_span:
+        progress = Progress(
+            'extracting %s' % os.path.basename(file_path),
+            total_bytes=os.path.getsize(file_path),
+            span=extract_span,
+        )
+        with progress:
+            with open(file_path, 'rb') as archive:
+                tar = tarfile.open(fileobj=ProgressFile(archive, progress), mode='r|gz')
+                tar.extractall(destination)
+                tar.close()
+
+
+def tree_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        size += sum(os.lstat(os.path.join(dirpath, name)).st_size for name in filenames)
+    return size
+
+
+class ExtractionCache(object):
+    """
+    Archives extracted once and reused, in ``<path>/<sha256 of the
+    archive>/repo``. The digest of an archive is remembered by its inode,
+    size and modification time, so a bundle that was seen before is not
+    even read again.
+
+    :meth:`gc` keeps the cache, along with the downloads, under
+    ``max_bytes`` by removing the least recently used entries first, and
+    removes what interrupted runs left behind. The path :meth:`get` returns
+    is read after the cache is unlocked, so entries used in the last
+    ``in_use_window`` seconds are never removed.
+    """
+
+    max_bytes = 20 * 1024 * 1024 * 1024
+    # extractions and downloads that are not done after this long are
+    # considered abandoned
+    stale_after = 24 * 60 * 60
+    # entries used this recently may still be read by the run that got them
+    in_use_window = 24 * 60 * 60
+
+    def __init__(self, path=None, download_dir=None):
+        self.path = path or EXTRACT_CACHE_DIR
+        self.download_dir = download_dir or DOWNLOAD_DIR
+        self.lock = FileLock('extract-cache', description='the extraction cache', shared=True)
+        self.gc_lock = FileLock('extract-cache', description='the extraction cache')
+
+    def index(self):
+        return Journal(path=os.path.join(self.path, 'index.json'))
+
+    def digest(self, file_path):
+        file_stat = os.stat(file_path)
+        key = '%s:%s:%s:%s' % (
+            file_stat.st_dev, file_stat.st_ino, file_stat.st_size, int(file_stat.st_mtime)
+        )
+        index = self.index()
+        digest = index.steps.get(key)
+        if digest is None:
+            digest = file_digest(file_path)
+            with FileLock('extract-cache-index', description='the extraction cache index'):
+                index = self.index()
+                index.record(key, digest)
+        return digest
+
+    def entry_path(self, digest):
+        return os.path.join(self.path, digest)
+
+    def get(self, file_path):
+        """the path to the extracted contents of the archive at ``file_path``"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0755)
+        with self.lock:
+            entry = self.entry_path(self.digest(file_path))
+            marker = os.path.join(entry, '.complete')
+            if os.path.exists(marker):
+                logger.debug('reusing %s extracted at %s', file_path, entry)
+                # the modification time of the marker is when it was last used
+                os.utime(marker, None)
+                return os.path.join(entry, 'repo')
+            tmp_entry = tempfile.mkdtemp(dir=self.path, prefix='.extract-')
+            try:
+                extract_archive(file_path, os.path.join(tmp_entry, 'repo'))
+                with open(os.path.join(tmp_entry, '.complete'), 'w') as f:
+                    json.dump(dict(archive=os.path.abspath(file_path), size=tree_size(tmp_entry)), f)
+                try:
+                    os.rename(tmp_entry, entry)
+                except OSError:
+                    # another run extracted the same archive in the meantime
+                    if not os.path.exists(marker):
+                        raise
+                    shutil.rmtree(tmp_entry, ignore_errors=True)
+            except BaseException:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                raise
+        self.gc(keep=entry)
+        return os.path.join(entry, 'repo')
+
+    def entries(self):
+        """``(last used, size, path)`` of every entry and download"""
+        entries = []
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                marker = os.path.join(self.path, name, '.complete')
+                if not os.path.isfile(marker):
+                    continue
+                try:
+                    with open(marker) as f:
+                        size = json.load(f)['size']
+                except (IOError, ValueError, KeyError):
+                    size = tree_size(os.path.join(self.path, name))
+                entries.append((os.path.getmtime(marker), size, os.path.join(self.path, name)))
+        if os.path.isdir(self.download_dir):
+            for name in os.listdir(self.download_dir):
+                path = os.path.join(self.download_dir, name)
+                if os.path.isfile(path) and not name.endswith('.part'):
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        return sorted(entries)
+
+    def stale(self):
+        """what interrupted extractions and downloads left behind"""
+        now = time.time()
+        paths = []
+        for parent, prefix in [(self.path, '.extract-'), (self.download_dir, None)]:
+            if not os.path.isdir(parent):
+                continue
+            for name in os.listdir(parent):
+                path = os.path.join(parent, name)
+                if prefix and not name.startswith(prefix):
+                    continue
+                if not prefix and not name.endswith('.part'):
+                    continue
+                if now - os.path.getmtime(path) > self.stale_after:
+                    paths.append(path)
+        return paths
+
+    def gc(self, max_bytes=None, keep=None):
+        """
+        Remove stale leftovers, and the least recently used entries and
+        downloads until they take less than ``max_bytes``. ``keep`` and the
+        entries used in the last ``in_use_window`` seconds are never
+        removed. Nothing is done while another run uses the cache.
+
+        :returns: how many entries were removed and the bytes freed
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = freed = 0
+        try:
+            self.gc_lock.acquire(wait=False)
+        except LockHeld as exc:
+            logger.debug('not collecting the extraction cache: %s', exc)
+            return removed, freed
+        try:
+            for path in self.stale():
+                logger.debug('removing abandoned %s', path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+                removed += 1
+            entries = self.entries()
+            total = sum(size for used, size, path in entries)
+            now = time.time()
+            for used, size, path in entries:
+                if total <= max_bytes:
+                    break
+                if path == keep:
+                    continue
+                if os.path.isdir(path) and now - used < self.in_use_window:
+                    logger.debug('not removing %s, it may still be in use', path)
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+                total -= size
+                removed += 1
+                freed += size
+        finally:
+            self.gc_lock.release()
+        if freed:
+            logger.info(
+                'removed %s old bundles and extractions, %s freed', removed, format_bytes(freed)
+            )
+        return removed, freed
+
+
+def file_digest(path, algorithm='sha256', block_size=1048576):
+    """hash the full contents of a file without reading it all in memory"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tree_fingerprint(path, checksum=False):
+    """
+    Compute a Merkle hash of the tree at ``path``. Every file contributes its
+    name, size and mtime (or a hash of its contents when ``checksum`` is set)
+    and every directory contributes its name and the hash of its children,
+    so two trees only match when they hold the same files. ``copy_tree``
+    preserves mtimes, so a published copy matches its source.
+
+    Returns ``None`` if ``path`` is not a directory.
+    """
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(path)):
+        entry_path = os.path.join(path, name)
+        if os.path.isdir(entry_path):
+            entry = 'd %s %s\n' % (name, tree_fingerprint(entry_path, checksum))
+        elif checksum:
+            entry = 'f %s %s\n' % (name, file_digest(entry_path))
+        else:
+            file_stat = os.stat(entry_path)
+            entry = 'f %s %s %s\n' % (name, file_stat.st_size, int(file_stat.st_mtime))
+        digest.update(entry)
+    return digest.hexdigest()
+
+
+def copy_file(source, destination, progress, block_size=1048576):
+    """
+    Copy ``source`` into ``destination`` along with its permission bits and
+    times (fingerprints rely on the modification time being kept)
+    """
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            while True:
+                chunk = src.read(block_size)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                progress.update(len(chunk))
+                throttle.consume(len(chunk))
+    shutil.copystat(source, destination)
+    progress.update(files=1)
+
+
+def copy_tree(source, destination, progress_label=None, span=None, duplicates=None):
+    """
+    Like ``shutil.copytree`` (symlinks are followed) but reporting progress
+    while copying. ``destination`` must not exist.
+
+    Files that ``duplicates`` (a :class:`DuplicateIndex`) already has a copy
+    of are hardlinked to it instead of copied.
+    """
+    directories = []
+    files = []
+    total_bytes = 0
+    for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+        target = os.path.join(destination, os.path.relpath(dirpath, source))
+        directories.append((dirpath, target))
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            files.append((path, os.path.join(target, name)))
+            total_bytes += os.path.getsize(path)
+
+    for dirpath, target in directories:
+        os.makedirs(target)
+    if duplicates is not None:
+        device = os.stat(destination).st_dev
+    progress = Progress(
+        progress_label or 'copying %s' % source,
+        total_bytes=total_bytes,
+        total_files=len(files),
+        span=span,
+    )
+    with progress:
+        for path, target in files:
+            if duplicates is None:
+                copy_file(path, target, progress)
+                continue
+            file_stat = os.stat(path)
+            key = duplicates.key(file_stat, device=device)
+            existing = duplicates.find(key, path)
+            if existing:
+                os.link(existing, target)
+                progress.update(file_stat.st_size, files=1)
+            else:
+                copy_file(path, target, progress)
+            if path in duplicates.digests:
+                duplicates.digests[target] = duplicates.digests[path]
+            duplicates.add(target, key=key)
+    # directory times change while their contents are copied
+    for dirpath, target in reversed(directories):
+        shutil.copystat(dirpath, target)
+
+
+def is_up_to_date(source, destination, checksum=False):
+    """
+    Tell if ``destination`` already holds an identical copy of ``source``
+    """
+    published = tree_fingerprint(destination, checksum)
+    if published is None:
+        return False
+    source_fingerprint = tree_fingerprint(source, checksum)
+    if published == source_fingerprint:
+        return True
+    # trees published from the store get the times of the blobs they link
+    # to, so they are matched against what was recorded when publishing
+    return not checksum and published_journal().is_done(
+        os.path.abspath(destination),
+        fingerprint(source=source_fingerprint, tree=published),
+    )
+
+
+# publishing happens in parallel steps and runs, the records of published
+# trees are updated one at a time
+published_lock = FileLock('published', description='the records of published repos')
+
+
+def published_journal():
+    return Journal(path=os.path.join(STATE_DIR, 'published.json'))
+
+
+def record_published(source, destination):
+    """remember that ``destination`` was published from ``source``"""
+    with published_lock:
+        published_journal().record(
+            os.path.abspath(destination),
+            fingerprint(
+                source=tree_fingerprint(source),
+                tree=tree_fingerprint(destination),
+            ),
+        )
+
+
+class DuplicateIndex(object):
+    """
+    Files that could be hardlinked to each other, grouped by device, size,
+    modification time and permission bits. Two files only count as
+    duplicates when all of those match, along with their SHA-256, so that
+    linking them does not change what ``tree_fingerprint`` sees in either
+    tree. Digests are computed only when there is a candidate to compare
+    with, and only once per file.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.digests = {}
+
+    @staticmethod
+    def key(file_stat, device=None):
+        return (
+            device or file_stat.st_dev,
+            file_stat.st_size,
+            int(file_stat.st_mtime),
+            stat.S_IMODE(file_stat.st_mode),
+        )
+
+    def digest(self, path):
+        if path not in self.digests:
+            self.digests[path] = file_digest(path)
+        return self.digests[path]
+
+    def add(self, path, key=None):
+        if key is None:
+            key = self.key(os.lstat(path))
+        self.files.setdefault(key, []).append(path)
+
+    def add_tree(self, path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                file_path = os.path.join(dirpath, name)
+                if not os.path.islink(file_path):
+                    self.add(file_path)
+
+    def find(self, key, path):
+        """a file already in the index with the same contents as ``path``"""
+        candidates = self.files.get(key)
+        if candidates:
+            digest = self.digest(path)
+            for candidate in candidates:
+                if self.digest(candidate) == digest:
+                    return candidate
+
+
+def published_trees():
+    """
+    The repositories served to this host and to remote hosts. Only the
+    directories under the remote repo dir that look like a repository are
+    considered, since the Calamari web application has its own files in
+    there.
+    """
+    trees = []
+    for parent in [LOCAL_REPO_DIR, REMOTE_REPO_DIR]:
+        if not os.path.isdir(parent):
+            continue
+        for name in sorted(os.listdir(parent)):
+            path = os.path.join(parent, name)
+            if path == Store().path or name.startswith('.'):
+                continue
+            if os.path.isdir(path) and (parent == LOCAL_REPO_DIR or is_repo_tree(path)):
+                trees.append(path)
+    return trees
+
+
+def is_repo_tree(path):
+    names = os.listdir(path)
+    return (
+        'repodata' in names or 'dists' in names or
+        any(name.endswith(('.rpm', '.deb')) for name in names)
+    )
+
+
+def link_replace(source, path):
+    """atomically replace ``path`` with a hardlink to ``source``"""
+    tmp_path = '%s.ice-link' % path
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.link(source, tmp_path)
+    os.rename(tmp_path, path)
+
+
+def dedup_trees(paths):
+    """
+    Hardlink the files in ``paths`` that are identical (see
+    :class:`DuplicateIndex`) to each other. Trees that another run is
+    working on are left alone.
+
+    :returns: how many files were linked and how many bytes that freed
+    """
+    locked = []
+    try:
+        for path in paths:
+            try:
+                repo_lock(path).acquire(wait=False)
+            except LockHeld as exc:
+                logger.debug('not deduplicating %s: %s', path, exc)
+                continue
+            locked.append(path)
+        return link_duplicates(locked)
+    finally:
+        for path in locked:
+            repo_lock(path).release()
+
+
+def link_duplicates(paths):
+    duplicates = DuplicateIndex()
+    # files that are links to one already in the index need no hashing
+    inodes = set()
+    linked = freed = 0
+    with span('dedup', 'file', paths=' '.join(paths)):
+        for path in paths:
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in sorted(filenames):
+                    file_path = os.path.join(dirpath, name)
+                    file_stat = os.lstat(file_path)
+                    inode = (file_stat.st_dev, file_stat.st_ino)
+                    if not stat.S_ISREG(file_stat.st_mode) or inode in inodes:
+                        continue
+                    key = duplicates.key(file_stat)
+                    existing = duplicates.find(key, file_path)
+                    if existing is None:
+                        duplicates.add(file_path, key=key)
+                        inodes.add(inode)
+                        continue
+                    link_replace(existing, file_path)
+                    linked += 1
+                    # the space only comes back with the last link
+                    if file_stat.st_nlink == 1:
+                        freed += file_stat.st_size
+    return linked, freed
+
+
+def dedup_published():
+    linked, freed = dedup_trees(published_trees())
+    if linked:
+        logger.info(
+            'hardlinked %s duplicate packages across repositories, %s saved',
+            linked, format_bytes(freed)
+        )
+    return linked, freed
+
+
+def after_publishing():
+    """link duplicates across the published repos and drop unused blobs"""
+    dedup_published()
+    Store().gc()
+
+
+class Store(object):
+    """
+    Content-addressed storage for published packages. Every file is kept
+    once, named by its SHA-256, and published trees are made of hardlinks to
+    the files in the store, so publishing a new version of a repo only
+    takes space for the packages that were not in the store already.
+
+    Blobs are not shared by anything else, :meth:`gc` removes the ones that
+    no published tree links to anymore.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(LOCAL_REPO_DIR, 'store')
+        self.tmp_path = os.path.join(self.path, 'tmp')
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def usable_for(self, path):
+        """blobs can only be linked from the same filesystem"""
+        if not os.path.isdir(self.tmp_path):
+            os.makedirs(self.tmp_path, 0755)
+        return os.stat(self.path).st_dev == os.stat(path).st_dev
+
+    def add(self, path, digest, progress):
+        """
+        Put a copy of ``path``, whose contents hash to ``digest``, in the
+        store unless it is there already
+
+        :returns: the path to the blob and whether it is new
+        """
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            progress.update(os.path.getsize(path), files=1)
+            return blob, False
+        if not os.path.isdir(os.path.dirname(blob)):
+            try:
+                os.makedirs(os.path.dirname(blob), 0755)
+            except OSError:
+                # another thread created it in the meantime
+                if not os.path.isdir(os.path.dirname(blob)):
+                    raise
+        fd, tmp_blob = tempfile.mkstemp(dir=self.tmp_path)
+        os.close(fd)
+        copy_file(path, tmp_blob, progress)
+        os.rename(tmp_blob, blob)
+        return blob, True
+
+    def materialize(self, source, destination, span=None):
+        """
+        Make ``destination`` (which must not exist) a tree of hardlinks to
+        the store with the same files as ``source``
+
+        :returns: how many bytes were added to the store
+        """
+        directories = []
+        files = []
+        total_bytes = 0
+        for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+            target = os.path.join(destination, os.path.relpath(dirpath, source))
+            directories.append((dirpath, target))
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                files.append((path, os.path.join(target, name)))
+                total_bytes += os.path.getsize(path)
+
+        for dirpath, target in directories:
+            os.makedirs(target)
+        added = 0
+        progress = Progress(
+            'publishing %s' % source,
+            total_bytes=total_bytes,
+            total_files=len(files),
+            span=span,
+        )
+        with progress:
+            for path, target in files:
+                blob, new = self.add(path, file_digest(path), progress)
+                if new:
+                    added += os.path.getsize(blob)
+                os.link(blob, target)
+        for dirpath, target in reversed(directories):
+            shutil.copystat(dirpath, target)
+        return added
+
+    def digests(self):
+        """
+        The SHA-256 of every blob by its ``(st_dev, st_ino)``, so that the
+        digest of a published file can be looked up rather than computed
+        """
+        digests = {}
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            dirnames[:] = [name for name in dirnames if os.path.join(dirpath, name) != self.tmp_path]
+            for name in filenames:
+                blob_stat = os.lstat(os.path.join(dirpath, name))
+                digests[(blob_stat.st_dev, blob_stat.st_ino)] = name
+        return digests
+
+    def gc(self):
+        """
+        Remove the blobs that no published tree links to
+
+        :returns: how many blobs were removed and their size in bytes
+        """
+        removed = freed = 0
+        if not os.path.isdir(self.path):
+            return removed, freed
+        try:
+            store_gc_lock.acquire(wait=False)
+        except LockHeld as exc:
+            # the next run collects what this one can not
+            logger.debug('not collecting unused packages: %s', exc)
+            return removed, freed
+        try:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            for dirpath, dirnames, filenames in os.walk(self.path):
+                for name in filenames:
+                    blob = os.path.join(dirpath, name)
+                    blob_stat = os.lstat(blob)
+                    if blob_stat.st_nlink == 1:
+                        os.remove(blob)
+                        removed += 1
+                        freed += blob_stat.st_size
+        finally:
+            store_gc_lock.release()
+        if removed:
+            logger.info(
+                'removed %s packages no repository uses anymore from the store, %s freed',
+                removed, format_bytes(freed)
+            )
+        return removed, freed
+
+
+def link_tree(source, destination):
+    """
+    Make ``destination`` (which must not exist) a copy of ``source`` where
+    every file is a hardlink to the one in ``source``
+    """
+    for dirpath, dirnames, filenames in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(dirpath, source))
+        os.makedirs(target)
+        for name in filenames:
+            os.link(os.path.join(dirpath, name), os.path.join(target, name))
+    for dirpath, dirnames, filenames in os.walk(source, topdown=False):
+        shutil.copystat(dirpath, os.path.join(destination, os.path.relpath(dirpath, source)))
+
+
+def detach_packages(path, sizes=None):
+    """
+    Make sure that no package in ``path`` that is hardlinked elsewhere (to a
+    previous generation, or to a blob of the store) gets written in place.
+    ``sizes`` maps the file names of the packages about to be downloaded to
+    their size: the ones that already have that size are left alone, and
+    the others are removed so that they are downloaded into new files.
+    Without ``sizes`` every hardlinked package gets a copy of its own.
+
+    :returns: how many packages were removed and copied
+    """
+    removed = copied = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            file_stat = os.lstat(file_path)
+            if not name.endswith('.rpm') or file_stat.st_nlink < 2:
+                continue
+            if sizes is not None:
+                if name in sizes and sizes[name] != file_stat.st_size:
+                    os.remove(file_path)
+                    removed += 1
+                continue
+            tmp_path = os.path.join(dirpath, '.%s.tmp' % name)
+            shutil.copy2(file_path, tmp_path)
+            os.rename(tmp_path, file_path)
+            copied += 1
+    return removed, copied
+
+
+class Generations(object):
+    """
+    The published generations of the repository at ``path``. ``path`` is a
+    symlink to the current generation, which is kept along with the
+    ``keep`` previous ones in ``<parent>/.ice_generations/<name>/<number>``.
+    Switching generations (to publish a new one, or to roll back) replaces
+    the symlink with a rename, so it is atomic and takes the same time no
+    matter how large the repository is.
+
+    Generations published from the store are trees of hardlinks, so the
+    previous ones only cost the packages that changed since.
+    """
+
+    keep = 3
+
+    def __init__(self, path):
+        self.path = os.path.normpath(path)
+        self.parent, self.name = os.path.split(self.path)
+        self.root = os.path.join(self.parent, '.ice_generations', self.name)
+
+    def numbers(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(int(name) for name in os.listdir(self.root) if name.isdigit())
+
+    def generation_path(self, number):
+        return os.path.join(self.root, str(number))
+
+    def current(self):
+        if not os.path.islink(self.path):
+            return None
+        number = os.path.basename(os.readlink(self.path))
+        if number.isdigit():
+            return int(number)
+
+    def adopt(self):
+        """
+        Make a tree published by an older version (a plain directory) the
+        first generation
+        """
+        if os.path.isdir(self.path) and not os.path.islink(self.path):
+            number = (self.numbers() or [0])[-1] + 1
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root, 0755)
+            os.rename(self.path, self.generation_path(number))
+            self.switch(number)
+
+    def switch(self, number):
+        if not os.path.isdir(self.generation_path(number)):
+            raise GenerationNotFound(self.path, number, self.numbers())
+        tmp_link = os.path.join(self.parent, '.%s.ice-link' % self.name)
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(self.generation_path(number), self.parent), tmp_link)
+        os.rename(tmp_link, self.path)
+
+    def prune(self):
+        """remove all but the current generation and the ``keep`` newest others"""
+        current = self.current()
+        others = [number for number in self.numbers() if number != current]
+        for number in others[:max(0, len(others) - self.keep)]:
+            shutil.rmtree(self.generation_path(number), ignore_errors=True)
+
+    @contextmanager
+    def new(self, from_current=False):
+        """
+        Yield the path where the next generation is to be put together (as a
+        copy of the current one, hardlinked, if ``from_current`` is set) and
+        switch to it once the block is done. It is removed if the block
+        fails, leaving the current generation in place.
+        """
+        self.adopt()
+        number = (self.numbers() or [0])[-1] + 1
+        path = self.generation_path(number)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, 0755)
+        if from_current and self.current() is not None:
+            link_tree(self.generation_path(self.current()), path)
+        try:
+            yield path
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        self.switch(number)
+        self.prune()
+
+
+def publish_tree(source, destination, store=None):
+    """
+    Publish the files in ``source`` at ``destination`` as a new generation
+    (see :class:`Generations`). When the store is on the same filesystem the
+    tree is made of links into it (see :class:`Store`), otherwise it is
+    copied.
+    """
+    destination = os.path.normpath(destination)
+    store = store or Store()
+    parent = os.path.dirname(destination)
+    if not os.path.isdir(parent):
+        os.makedirs(parent, 0755)
+
+    with repo_lock(destination):
+        with Generations(destination).new() as target:
+            if not store.usable_for(parent):
+                logger.debug('%s is not on the same filesystem as the store, copying', parent)
+                overwrite_dir(source, target)
+            else:
+                with span('publish', 'file', source=source, destination=destination) as publish_span:
+                    with store_publish_lock:
+                        added = store.materialize(source, target, span=publish_span)
+                logger.debug(
+                    'published %s at %s, %s added to the store',
+                    source, destination, format_bytes(added)
+                )
+        record_published(source, destination)
 
 
 def overwrite_dir(source, destination='/opt/ICE/ceph-repo/'):
@@ -1079,8 +3445,16 @@ def overwrite_dir(source, destination='/opt/ICE/ceph-repo/'):
     except OSError:
         pass
 
+    # packages that are already published somewhere else on the same
+    # filesystem are linked rather than copied
+    duplicates = DuplicateIndex()
+    for tree in published_trees():
+        if os.path.abspath(tree) != os.path.abspath(destination):
+            duplicates.add_tree(tree)
+
     # now copy the contents
-    shutil.copytree(source, destination)
+    with span('copy', 'file', source=source, destination=destination) as copy_span:
+        copy_tree(source, destination, span=copy_span, duplicates=duplicates)
     logger.debug('copied contents from: %s to %s' % (source, destination))
 
 
@@ -1152,11 +3526,53 @@ def which(executable):
 # =============================================================================
 
 
+class Answers(object):
+    """
+    Answers to the prompts, read from the ``[ice_setup]`` section of an INI
+    file so that a setup can run unattended, for example::
+
+        [ice_setup]
+        package_path = /home/user/ice-1.3
+        fqdn = ice.example.com
+        protocol = http
+        use_gpg = yes
+
+    Answers that are missing are prompted for. Without a ``path`` there are
+    no answers at all and everything is prompted for.
+    """
+
+    section = 'ice_setup'
+
+    def __init__(self, path=None):
+        self.path = path
+        # no interpolation, paths can have a '%' in them
+        self.parser = RawConfigParser()
+        if path and not self.parser.read([path]):
+            raise ICEError('could not read answers file: %s' % path)
+
+    def get(self, option, default=None):
+        try:
+            return self.parser.get(self.section, option)
+        except (NoSectionError, NoOptionError):
+            return default
+
+    def getboolean(self, option, default=None):
+        try:
+            return self.parser.getboolean(self.section, option)
+        except (NoSectionError, NoOptionError):
+            return default
+        except ValueError:
+            raise ICEError(
+                '%s in %s should be yes or no, not %s' % (option, self.path, self.get(option))
+            )
+
+
 def prompt_bool(question, _raw_input=None):
     input_prompt = _raw_input or raw_input
     prefix = '%s-->%s ' % (COLOR_SEQ % (30 + COLORS['INFO']), RESET_SEQ)
     prompt_format = '{prefix}{question} '.format(prefix=prefix, question=question)
-    response = input_prompt(prompt_format)
+    with holding_output():
+        response = input_prompt(prompt_format)
     try:
         return strtobool(response)
     except ValueError:
@@ -1187,7 +3603,8 @@ def prompt(question, default=None, lowercase=False, _raw_input=None):
         )
     else:
         prompt_format = '{prefix}{question} '.format(prefix=prefix, question=question)
-    response = input_prompt(prompt_format)
+    with holding_output():
+        response = input_prompt(prompt_format)
     if not response:  # e.g. user hit Enter
         return default
     else:
@@ -1219,97 +3636,1750 @@ def strtobool(val):
         raise ValueError("Invalid input value: %s" % val)
 
 
-
 # =============================================================================
-# Actions
+# Steps
 # =============================================================================
 
 
-class Configure(object):
+def fingerprint(**inputs):
+    """
+    Produce a stable digest for the keyword arguments given, which need to be
+    JSON serializable.
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
 
-    _help = dedent("""
-    Configures the ICE node as a repository Host.
 
-    Commands:
+class Journal(object):
+    """
+    Keeps track of the steps that completed in previous runs along with the
+    fingerprint of the inputs they used, so that re-running can skip work
+    that is already done. When ``force`` is set every step is considered
+    dirty, but completed steps are still recorded.
+    """
 
-      all         Configure both local and remote repos
-      local       Configure repos necessary to install calamari and ceph-deploy
-                  on this local host
-      remote      Configure repos necessary to install ceph and calamari
-                  on remote hosts
+    def __init__(self, path=None, force=False):
+        self.path = path or os.path.join(STATE_DIR, 'journal.json')
+        self.force = force
+        self.steps = self._load()
 
-    Details:
-      Each of the commands can optionally be followed by a path to the package
-      files. If no path is given, the current working directory is searched for
-      packages.
-    """)
+    def _load(self):
+        try:
+            with open(self.path) as journal_file:
+                return json.load(journal_file)
+        except (IOError, ValueError):
+            return {}
 
-    def __init__(self, argv):
-        self.argv = argv
+    def is_done(self, step, digest):
+        if self.force:
+            return False
+        return self.steps.get(step) == digest
 
-    def parse_args(self):
-        options = ['all', 'local', 'remote']
-        parser = Transport(self.argv, options=options)
-        parser.catch_help = self._help
-        parser.parse_args()
+    def record(self, step, digest):
+        self.steps[step] = digest
+        self.save()
 
-        sudo_check()
+    def save(self):
+        """write to a temporary file first so a crash never truncates it"""
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0755)
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as journal_file:
+            json.dump(self.steps, journal_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
 
-        if parser.has('all'):
-            package_path = parser.get('all')
-            configure_local('Calamari', package_path)
-            configure_local('Installer', package_path)
-            configure_local('Tools', package_path)
-            configure_remote('ceph-osd', package_path)
-            configure_remote('ceph-mon', package_path)
-            pin_local_repos()
 
-        elif parser.has('local'):
-            package_path = parser.get('local')
-            configure_local('Calamari', package_path)
-            configure_local('Installer', package_path)
-            configure_local('Tools', package_path)
-            pin_local_repos()
+class Step(object):
+    """
+    A named unit of work. ``func`` is called with the run context (a plain
+    dictionary shared by all steps) and ``inputs``, when given, is a callable
+    that receives the same context and returns the (JSON serializable) values
+    the step depends on. Steps without ``inputs`` are not journaled and always
+    run. ``requires`` names the steps that need to complete before this one
+    can start.
+    """
 
-        elif parser.has('remote'):
-            package_path = parser.get('remote')
-            configure_remote('ceph-osd', package_path)
-            configure_remote('ceph-mon', package_path)
+    def __init__(self, name, func, inputs=None, requires=None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.requires = requires or []
 
-        return True
+    def fingerprint(self, context):
+        if self.inputs is None:
+            return None
+        return fingerprint(**self.inputs(context))
 
 
-def fqdn_with_protocol():
+class Scheduler(object):
     """
-    Prompt the user for the FQDN of the current server along with the
-    protocol to be used so that we can configure the repositories.
+    Run steps as a dependency graph: a step starts as soon as every step it
+    requires has completed, with at most ``jobs`` steps running at the same
+    time in their own threads.
+
+    A journaled step is skipped when the journal has it recorded with the
+    same inputs and none of the steps it requires had to run, so work resumes
+    from the first dirty step of every branch of the graph. Steps have to be
+    declared after the steps they require, which rules out cycles.
+
+    If a step fails no new steps are started, the running ones are waited
+    for, and the error is raised again.
+    """
+
+    def __init__(self, steps, journal, jobs=1):
+        self.steps = steps
+        self.journal = journal
+        self.jobs = max(1, jobs)
+        declared = set()
+        for step in steps:
+            for name in step.requires:
+                if name not in declared:
+                    raise ICEError(
+                        'step %s requires %s which is not declared before it' % (step.name, name)
+                    )
+            declared.add(step.name)
+
+    def run(self, context):
+        pending = list(self.steps)
+        running = {}
+        completed = set()
+        dirty = set()
+        finished = Queue.Queue()
+        failure = None
+
+        while running or (pending and failure is None):
+            step = None
+            if failure is None and len(running) < self.jobs:
+                step = self._next_ready(pending, completed)
+
+            if step is not None:
+                pending.remove(step)
+                digest = step.fingerprint(context)
+                skip = (
+                    digest is not None and
+                    not dirty.intersection(step.requires) and
+                    self.journal.is_done(step.name, digest)
+                )
+                if skip:
+                    logger.info('skipping %s, already completed with the same inputs', step.name)
+                    completed.add(step.name)
+                else:
+                    running[step.name] = digest
+                    self._start(step, context, finished)
+                continue
+
+            name, exc_info = self._wait(finished)
+            digest = running.pop(name)
+            if exc_info:
+                failure = failure or exc_info
+                continue
+            completed.add(name)
+            if digest is not None:
+                dirty.add(name)
+                self.journal.record(name, digest)
+
+        if failure:
+            raise failure[0], failure[1], failure[2]
+
+    def _next_ready(self, pending, completed):
+        for step in pending:
+            if completed.issuperset(step.requires):
+                return step
+
+    def _start(self, step, context, finished):
+        def work():
+            try:
+                with span(step.name, 'step'):
+                    profiler.run(step.func, context)
+            except BaseException:
+                finished.put((step.name, sys.exc_info()))
+            else:
+                finished.put((step.name, None))
+
+        worker = threading.Thread(target=work, name=step.name)
+        worker.daemon = True
+        worker.start()
+
+    def _wait(self, finished):
+        # waiting with a timeout keeps the main thread responsive to Ctrl-C
+        while True:
+            try:
+                return finished.get(True, 0.5)
+            except Queue.Empty:
+                pass
+
+
+def run_steps(steps, context, journal, jobs=1):
+    """
+    Convenience to run ``steps`` with a :class:`Scheduler`
+    """
+    Scheduler(steps, journal, jobs=jobs).run(context)
+
+
+# =============================================================================
+# Repo server
+# =============================================================================
+
+
+def load_sendfile():
+    """
+    ``sendfile(2)`` from libc, so that files go from the page cache to the
+    socket without being copied through Python. ``None`` when not on Linux
+    or when it can not be loaded, files are copied with reads and writes
+    then.
+    """
+    if platform.system() != 'Linux':
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (ImportError, OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_long
+
+    def sendfile(out_fd, in_fd, offset, count):
+        position = ctypes.c_int64(offset)
+        sent = func(out_fd, in_fd, ctypes.byref(position), count)
+        if sent < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return sent
+    return sendfile
+
+
+sendfile = load_sendfile()
+
+
+class RepoRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the files of the published repos (``root``) under ``/static/``,
+    the same paths the Calamari web application uses, with keep-alive,
+    ranges and conditional requests. Directory listings are not served,
+    neither are hidden files (like the generations of the repos).
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'ice_setup/%s' % __version__
+    prefix = '/static/'
+    # seconds an idle keep-alive connection is kept around, so that idle
+    # clients do not hold on to the worker threads
+    timeout = 15
+    block_size = 1048576
+    # buffer the headers so they go out in one segment, rather than one per
+    # header line
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # the body follows the headers in a separate write, which Nagle
+        # would hold back until the client acks the headers
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.client_address[0], format % args)
+
+    def do_GET(self):
+        self.send_file(head=False)
+
+    def do_HEAD(self):
+        self.send_file(head=True)
+
+    def translate_path(self):
+        """the file the request is for, or ``None`` if it is not served"""
+        path = urllib.unquote(urlparse.urlsplit(self.path)[2])
+        if not path.startswith(self.prefix):
+            return None
+        parts = [part for part in path[len(self.prefix):].split('/') if part]
+        if any(part.startswith('.') for part in parts):
+            return None
+        root = self.server.root
+        file_path = os.path.realpath(os.path.join(root, *parts))
+        # symlinks are followed, but only to the generations of the repos
+        if not file_path.startswith(os.path.realpath(root) + os.sep):
+            return None
+        return file_path
+
+    def parse_range(self, size):
+        """
+        The ``(start, end)`` of the one range asked for, ``None`` if the
+        whole file is wanted, or ``False`` if the range can not be served.
+        Only single ranges are supported, other requests get the whole file.
+        """
+        header = self.headers.get('Range')
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        start, _, end = header[len('bytes='):].strip().partition('-')
+        try:
+            if not start:
+                # the last ``end`` bytes
+                start, end = max(0, size - int(end)), size - 1
+            else:
+                start, end = int(start), int(end) if end else size - 1
+        except ValueError:
+            return None
+        end = min(end, size - 1)
+        if start > end:
+            return False
+        return start, end
+
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            since = email_utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(mtime) <= email_utils.mktime_tz(since)
+        return False
+
+    def send_file(self, head=False):
+        file_path = self.translate_path()
+        if file_path is None or not os.path.isfile(file_path):
+            self.send_error(404)
+            return
+        try:
+            f = open(file_path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        try:
+            file_stat = os.fstat(f.fileno())
+            size = file_stat.st_size
+            etag = '"%x-%x-%x"' % (file_stat.st_ino, size, int(file_stat.st_mtime))
+            if self.not_modified(etag, file_stat.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            byte_range = None
+            if_range = self.headers.get('If-Range')
+            if not if_range or if_range.strip() == etag:
+                byte_range = self.parse_range(size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))
+            else:
+                start, end = 0, size - 1
+                self.send_response(200)
+            length = end - start + 1
+            content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(length))
+            self.send_header('Last-Modified', self.date_time_string(file_stat.st_mtime))
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if not head:
+                self.copy_range(f, start, length)
+        finally:
+            f.close()
+
+    def copy_range(self, f, offset, length):
+        self.wfile.flush()
+        out_fd = self.connection.fileno()
+        if sendfile is not None:
+            while length > 0:
+                try:
+                    sent = sendfile(out_fd, f.fileno(), offset, min(length, 0x7ffff000))
+                except OSError as exc:
+                    if exc.errno == EINTR:
+                        continue
+                    if exc.errno != EAGAIN:
+                        raise
+                    # the socket has a timeout so it is non-blocking
+                    if not select.select([], [out_fd], [], self.timeout)[1]:
+                        raise socket.timeout('timed out sending %s' % f.name)
+                    continue
+                if sent == 0:
+                    break
+                offset += sent
+                length -= sent
+            return
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(length, self.block_size))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            length -= len(chunk)
+
+
+class RepoServer(BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server that hands connections to a fixed pool of worker
+    threads, with a listen backlog large enough for a few thousand clients
+    connecting at once
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 4096
+    # workers mostly wait on sockets and sendfile, they do not need the
+    # default stack size
+    stack_size = 256 * 1024
+
+    def __init__(self, address, root, threads=256, handler=RepoRequestHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.root = root
+        self.connections = Queue.Queue()
+        self.workers = []
+        old_stack_size = thread.stack_size(self.stack_size)
+        try:
+            for number in range(threads):
+                worker = threading.Thread(target=self.work, name='serve-%s' % number)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        finally:
+            thread.stack_size(old_stack_size)
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.connections.get()
+            if request is None:
+                return
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                getattr(self, 'shutdown_request', self.close_request)(request)
+
+    def handle_error(self, request, client_address):
+        logger.debug('error serving %s', client_address[0], exc_info=True)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        for worker in self.workers:
+            self.connections.put((None, None))
+
+
+def serve(port=8181, bind='', threads=256):
+    """serve the repos for remote hosts until interrupted"""
+    server = RepoServer((bind, port), REMOTE_REPO_DIR, threads=threads)
+    logger.info(
+        'serving %s at http://%s:%s/static/ with %s threads',
+        REMOTE_REPO_DIR, bind or get_fqdn(), port, threads
+    )
+    logger.info('press Ctrl-C to stop')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def repo_base_url(protocol, fqdn, port=None):
+    """where remote hosts find the repos, see ``serve``"""
+    if port:
+        return '%s://%s:%s/static' % (protocol, fqdn, port)
+    return '%s://%s/static' % (protocol, fqdn)
+
+
+def mirror_base_urls(protocol, mirrors):
+    """
+    Base URLs of the replicas of the repos, from a comma separated list of
+    hosts (``host`` or ``host:port``, served at ``/static`` like the ICE
+    node) or of full base URLs
+    """
+    urls = []
+    for mirror in (mirrors or '').split(','):
+        mirror = mirror.strip().rstrip('/')
+        if not mirror:
+            continue
+        if urlparse.urlsplit(mirror).scheme:
+            urls.append(mirror)
+        else:
+            urls.append(repo_base_url(protocol, mirror))
+    return urls
+
+
+def join_mirrors(urls):
+    """a single URL or a whitespace separated list, as yum takes them"""
+    if isinstance(urls, basestring):
+        return urls
+    return ' '.join(urls)
+
+
+def order_mirrors(urls, key=None):
+    """
+    The mirrors in ``urls`` rotated by a stable hash of ``key`` (the host
+    that uses them) so that every host gets the same order every time and
+    hosts are spread evenly across the mirrors, or in a random order when
+    there is no ``key``
+    """
+    urls = list(urls)
+    if key is None:
+        random.shuffle(urls)
+        return urls
+    start = int(hashlib.md5(key).hexdigest(), 16) % len(urls)
+    return urls[start:] + urls[:start]
+
+
+# =============================================================================
+# Load testing
+# =============================================================================
+
+
+def local_name(tag):
+    """the tag of an element without its namespace"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_elements(element):
+    # ``iter`` is not there on python 2.6, ``getiterator`` is deprecated after
+    return getattr(element, 'iter', element.getiterator)()
+
+
+def read_metadata(data, path):
+    if path.endswith('.gz'):
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+    return data
+
+
+def yum_repo_contents(fetch):
+    """
+    The metadata files a yum client fetches from a repo before installing,
+    and the ``(path, size)`` of every package in it, read from the primary
+    metadata
+    """
+    repomd = 'repodata/repomd.xml'
+    metadata = [repomd]
+    primary = None
+    for data in iter_elements(ElementTree.fromstring(fetch(repomd))):
+        if local_name(data.tag) != 'data' or data.get('type') not in ('primary', 'filelists'):
+            continue
+        for child in data:
+            if local_name(child.tag) == 'location':
+                metadata.append(child.get('href'))
+                if data.get('type') == 'primary':
+                    primary = child.get('href')
+    if primary is None:
+        raise ICEError('no primary metadata in %s' % repomd)
+    packages = []
+    for package in iter_elements(ElementTree.fromstring(read_metadata(fetch(primary), primary))):
+        if local_name(package.tag) != 'package':
+            continue
+        path = size = None
+        for child in package:
+            if local_name(child.tag) == 'location':
+                path = child.get('href')
+            elif local_name(child.tag) == 'size':
+                size = int(child.get('package', 0))
+        if path:
+            packages.append((path, size))
+    return metadata, packages
+
+
+def apt_repo_contents(fetch, codename):
+    """
+    The metadata files an apt client fetches from a repo before installing,
+    and the ``(path, size)`` of every package in it, read from the
+    ``Packages`` indexes listed in the ``Release`` file of ``codename``
+    """
+    release = 'dists/%s/Release' % codename
+    indexes = set()
+    for line in fetch(release).splitlines():
+        fields = line.split()
+        if line.startswith(' ') and len(fields) == 3 and fields[2].endswith('/Packages'):
+            indexes.add(fields[2])
+    metadata = [release]
+    packages = []
+    for index in sorted(indexes):
+        path = 'dists/%s/%s' % (codename, index)
+        metadata.append(path)
+        stanza = {}
+        for line in fetch(path).splitlines() + ['']:
+            if not line.strip():
+                if 'Filename' in stanza:
+                    packages.append((stanza['Filename'], int(stanza.get('Size', 0))))
+                stanza = {}
+            elif not line.startswith(' ') and ':' in line:
+                key, value = line.split(':', 1)
+                stanza[key] = value.strip()
+    return metadata, packages
+
+
+def repo_contents(base_url, codename=None, timeout=30):
+    """
+    Read the metadata of the repo at ``base_url``: a yum repo, or an apt
+    one when ``codename`` is given
+    """
+    def fetch(path):
+        url = '%s/%s' % (base_url.rstrip('/'), path)
+        try:
+            url_fd = urllib2.urlopen(url, timeout=timeout)
+        except (urllib2.URLError, socket.error) as exc:
+            raise ICEError('could not fetch %s: %s' % (url, exc))
+        try:
+            return url_fd.read()
+        finally:
+            url_fd.close()
+    if codename:
+        return apt_repo_contents(fetch, codename)
+    return yum_repo_contents(fetch)
+
+
+def percentile(values, fraction):
+    """``values`` should be sorted"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LoadGenerator(object):
+    """
+    ``clients`` simulated hosts installing from the repo at ``base_url`` at
+    the same time. Every client fetches the metadata and then ``packages``
+    packages picked at random, over one keep-alive connection like yum and
+    apt do, ``rounds`` times.
+    """
+
+    block_size = 65536
+    stack_size = 256 * 1024
+
+    def __init__(self, base_url, metadata, packages, clients=50, per_client=20,
+                 rounds=1, timeout=30, seed=None):
+        self.url = urlparse.urlsplit(base_url)
+        self.metadata = metadata
+        self.packages = packages
+        self.clients = clients
+        self.per_client = min(per_client, len(packages))
+        self.rounds = rounds
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # (kind, seconds, bytes, error) of every request
+        self.requests = []
+
+    def connect(self):
+        if self.url.scheme == 'https':
+            return httplib.HTTPSConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def fetch(self, connection, kind, path):
+        start = time.time()
+        received = 0
+        error = None
+        try:
+            connection.request('GET', '%s/%s' % (self.url.path.rstrip('/'), path))
+            response = connection.getresponse()
+            while True:
+                chunk = response.read(self.block_size)
+                if not chunk:
+                    break
+                received += len(chunk)
+            if response.status != 200:
+                error = 'HTTP %s' % response.status
+        except (httplib.HTTPException, socket.error) as exc:
+            error = str(exc) or exc.__class__.__name__
+            connection.close()
+        with self.lock:
+            self.requests.append((kind, time.time() - start, received, error))
+
+    def client(self, start, paths):
+        connection = self.connect()
+        start.wait()
+        try:
+            for kind, path in paths:
+                self.fetch(connection, kind, path)
+        finally:
+            connection.close()
+
+    def run(self):
+        start = threading.Event()
+        threads = []
+        old_stack_size = thread.stack_size(self.stack_size)
+        try:
+            for number in range(self.clients):
+                paths = []
+                for i in range(self.rounds):
+                    paths.extend(('metadata', path) for path in self.metadata)
+                    picked = self.random.sample(self.packages, self.per_client)
+                    paths.extend(('package', path) for path, size in picked)
+                client = threading.Thread(target=self.client, args=(start, paths))
+                client.daemon = True
+                client.start()
+                threads.append(client)
+        finally:
+            thread.stack_size(old_stack_size)
+        started = time.time()
+        # every client starts at once, like hosts being installed together
+        start.set()
+        for client in threads:
+            client.join()
+        return self.results(time.time() - started)
+
+    def results(self, elapsed):
+        results = dict(
+            clients=self.clients,
+            seconds=elapsed,
+            requests=len(self.requests),
+            errors=sum(1 for request in self.requests if request[3]),
+            bytes=sum(request[2] for request in self.requests),
+        )
+        results['requests_per_second'] = results['requests'] / elapsed if elapsed else None
+        results['bytes_per_second'] = results['bytes'] / elapsed if elapsed else None
+        for kind in ['metadata', 'package']:
+            latencies = sorted(r[1] for r in self.requests if r[0] == kind and not r[3])
+            results[kind] = dict(
+                requests=len(latencies),
+                p50=percentile(latencies, 0.5),
+                p90=percentile(latencies, 0.9),
+                p99=percentile(latencies, 0.99),
+                max=latencies[-1] if latencies else None,
+            )
+        errors = {}
+        for request in self.requests:
+            if request[3]:
+                errors[request[3]] = errors.get(request[3], 0) + 1
+        results['error_counts'] = errors
+        return results
+
+
+def report_load_test(results):
+    logger.info('')
+    logger.info('{markup} Load test {markup}'.format(markup='===='))
+    logger.info('')
+    logger.info(
+        '%s clients, %s requests in %s (%s errors)',
+        results['clients'], results['requests'],
+        format_duration(results['seconds']), results['errors'],
+    )
+    logger.info(
+        '%.1f requests/s, %s/s',
+        results['requests_per_second'] or 0, format_bytes(results['bytes_per_second'] or 0),
+    )
+    row_format = '%-10s %8s %10s %10s %10s %10s'
+    logger.info(row_format, 'latency', 'count', 'p50 (s)', 'p90 (s)', 'p99 (s)', 'max (s)')
+    for kind in ['metadata', 'package']:
+        row = results[kind]
+        logger.info(row_format, kind, row['requests'], *[
+            '%.3f' % row[name] if row[name] is not None else '-'
+            for name in ['p50', 'p90', 'p99', 'max']
+        ])
+    for error, count in sorted(results['error_counts'].items()):
+        logger.warning('%s requests failed with: %s', count, error)
+
+
+def load_test(target, clients=50, packages=20, rounds=1, codename=None, timeout=30, threads=256):
+    """
+    Load test the repo at the ``target`` URL, or the published repo named
+    ``target`` behind a local ``RepoServer`` so that no network is needed
+    """
+    server = None
+    if not urlparse.urlsplit(target).scheme:
+        published_repo_path(target)
+        server = RepoServer(('127.0.0.1', 0), REMOTE_REPO_DIR, threads=threads)
+        worker = threading.Thread(target=server.serve_forever)
+        worker.daemon = True
+        worker.start()
+        target = 'http://127.0.0.1:%s/static/%s' % (server.server_address[1], target)
+    try:
+        metadata, repo_packages = repo_contents(target, codename=codename, timeout=timeout)
+        if not repo_packages:
+            raise ICEError('no packages found in the metadata of %s' % target)
+        logger.info(
+            'load testing %s (%s packages) with %s clients', target, len(repo_packages), clients
+        )
+        results = LoadGenerator(
+            target, metadata, repo_packages, clients=clients, per_client=packages,
+            rounds=rounds, timeout=timeout,
+        ).run()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    report_load_test(results)
+    return results
+
+
+# =============================================================================
+# Replication
+# =============================================================================
+
+
+def tree_manifest(path, digests=None):
+    """
+    The ``[size, sha256]`` of every file in the tree at ``path`` by its
+    relative path. Hidden files and directories are left out, they are not
+    served. ``digests`` are known digests by ``(st_dev, st_ino)``, see
+    ``Store.digests``, only the other files are hashed.
+    """
+    digests = digests or {}
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+            file_path = os.path.join(dirpath, name)
+            file_stat = os.stat(file_path)
+            digest = digests.get((file_stat.st_dev, file_stat.st_ino)) or file_digest(file_path)
+            manifest[os.path.relpath(file_path, path)] = [file_stat.st_size, digest]
+    return manifest
+
+
+def diff_manifests(local, remote):
+    """
+    :returns: the paths that are missing or different in ``remote``, and
+              the ones that are only in ``remote``
+    """
+    changed = sorted(
+        path for path, (size, digest) in local.items()
+        if path not in remote or remote[path][1] != digest
+    )
+    removed = sorted(path for path in remote if path not in local)
+    return changed, removed
+
+
+def is_metadata_path(path):
+    """repo metadata has to be replaced after the packages it lists"""
+    return path.split(os.sep, 1)[0] in ('repodata', 'dists')
+
+
+def split_streams(paths, sizes, streams):
+    """spread ``paths`` across ``streams`` batches of about the same size"""
+    batches = [[] for i in range(max(1, min(streams, len(paths))))]
+    totals = [0] * len(batches)
+    for path in sorted(paths, key=lambda path: sizes[path], reverse=True):
+        smallest = totals.index(min(totals))
+        batches[smallest].append(path)
+        totals[smallest] += sizes[path]
+    return [batch for batch in batches if batch]
+
+
+class LocalTarget(object):
+    """
+    A replica in a directory of this host, like a mounted filesystem of the
+    replica host. Every file is written next to where it goes and renamed
+    into place, so clients never see a partial file.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def __str__(self):
+        return self.root
+
+    def manifest_path(self, name):
+        return os.path.join(self.root, '.ice_manifests', '%s.json' % name)
+
+    def read_manifest(self, name):
+        try:
+            with open(self.manifest_path(name)) as f:
+                return json.load(f)
+        except IOError:
+            return None
+        except ValueError:
+            logger.warning('ignoring corrupt manifest %s', self.manifest_path(name))
+            return None
+
+    def write_manifest(self, name, manifest):
+        path = self.manifest_path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.rename(path + '.tmp', path)
+
+    def scan(self, name):
+        return tree_manifest(os.path.join(self.root, name))
+
+    def put(self, source, name, paths, progress):
+        for path in paths:
+            destination = os.path.join(self.root, name, path)
+            if not os.path.isdir(os.path.dirname(destination)):
+                try:
+                    os.makedirs(os.path.dirname(destination))
+                except OSError:
+                    # another stream created it in the meantime
+                    if not os.path.isdir(os.path.dirname(destination)):
+                        raise
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(destination), prefix='.%s.' % os.path.basename(path)
+            )
+            os.close(fd)
+            copy_file(os.path.join(source, path), tmp_path, progress)
+            os.rename(tmp_path, destination)
+
+    def remove(self, name, paths):
+        for path in paths:
+            try:
+                os.remove(os.path.join(self.root, name, path))
+            except OSError:
+                pass
+
+
+class SSHTarget(object):
+    """
+    A replica on another host, reached with ``ssh`` (a command line, so
+    options like ``-i`` or ``-p`` can be added). Files are streamed as a tar
+    archive into a staging directory on the host and then renamed into
+    place one by one.
+    """
+
+    def __init__(self, host, root, ssh='ssh'):
+        self.host = host
+        self.root = root
+        self.ssh = ssh
+
+    def __str__(self):
+        return '%s:%s' % (self.host, self.root)
+
+    def command(self, script):
+        return shlex.split(self.ssh) + [self.host, script]
+
+    def check(self, returncode, stderr, action):
+        if returncode != 0:
+            raise ReplicationError('could not %s on %s: %s' % (
+                action, self, ' '.join(stderr) or 'exit status %s' % returncode
+            ))
+
+    def manifest_path(self, name):
+        return '%s/.ice_manifests/%s.json' % (self.root, name)
+
+    def read_manifest(self, name):
+        stdout, stderr, returncode = run_call(
+            self.command('cat %s 2>/dev/null || true' % pipes.quote(self.manifest_path(name)))
+        )
+        self.check(returncode, stderr, 'read the manifest of %s' % name)
+        if not stdout:
+            return None
+        try:
+            return json.loads('\n'.join(stdout))
+        except ValueError:
+            logger.warning('ignoring corrupt manifest %s on %s', self.manifest_path(name), self.host)
+            return None
+
+    def write_manifest(self, name, manifest):
+        path = pipes.quote(self.manifest_path(name))
+        self.feed(
+            'mkdir -p $(dirname %s) && cat > %s.tmp && mv %s.tmp %s' % (path, path, path, path),
+            json.dumps(manifest),
+            'write the manifest of %s' % name,
+        )
+
+    def feed(self, script, data, action):
+        process = subprocess.Popen(
+            self.command(script),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        out, err = process.communicate(data)
+        self.check(process.returncode, split_lines(err), action)
+
+    def scan(self, name):
+        directory = pipes.quote('%s/%s' % (self.root, name))
+        stdout, stderr, returncode = run_call(self.command(
+            'cd %s 2>/dev/null || exit 0; '
+            'find . -type f ! -path "*/.*" -print0 | xargs -0 -r sha256sum' % directory
+        ))
+        self.check(returncode, stderr, 'scan %s' % name)
+        manifest = {}
+        for line in stdout:
+            digest, path = line.split(None, 1)
+            manifest[os.path.normpath(path.lstrip('*'))] = [None, digest]
+        return manifest
+
+    def put(self, source, name, paths, progress):
+        destination = pipes.quote('%s/%s' % (self.root, name))
+        staging = '%s/.ice_incoming/%s' % (self.root, name)
+        # a staging directory per stream, so streams do not move each
+        # other's files
+        script = (
+            'set -e; mkdir -p %(staging)s; staging=$(mktemp -d %(staging)s/XXXXXX); '
+            'tar -x -C "$staging" -f -; cd "$staging"; '
+            'find . -type f | while read -r path; do '
+            'mkdir -p %(destination)s/"$(dirname "$path")"; mv -f "$path" %(destination)s/"$path"; '
+            'done; cd /; rm -rf "$staging"'
+        ) % dict(staging=pipes.quote(staging), destination=destination)
+        process = subprocess.Popen(
+            self.command(script),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        stderr = []
+        reader = threading.Thread(target=lambda: stderr.extend(split_lines(process.stderr.read())))
+        reader.daemon = True
+        reader.start()
+        try:
+            archive = tarfile.open(fileobj=ProgressFile(process.stdin, progress), mode='w|')
+            archive.dereference = True
+            for path in paths:
+                archive.add(os.path.join(source, path), arcname=path)
+                progress.update(files=1)
+            archive.close()
+        except IOError:
+            # the remote end went away, its error is in stderr
+            pass
+        finally:
+            process.stdin.close()
+        process.stdout.read()
+        process.wait()
+        reader.join()
+        self.check(process.returncode, stderr, 'copy files of %s' % name)
+
+    def remove(self, name, paths):
+        self.feed(
+            'cd %s && xargs -0 -r rm -f --' % pipes.quote('%s/%s' % (self.root, name)),
+            '\0'.join(paths),
+            'remove files of %s' % name,
+        )
+
+
+def replica_target(target, ssh='ssh'):
+    """a local path, or ``[user@]host:/path`` to go through ``ssh``"""
+    if ':' in target and not target.startswith(('/', '.')):
+        host, root = target.split(':', 1)
+        return SSHTarget(host, root.rstrip('/') or '/', ssh=ssh)
+    return LocalTarget(os.path.abspath(target))
+
+
+def replicate_tree(path, target, streams=4, rescan=False, digests=None):
+    """
+    Make the replica of the published tree at ``path`` in ``target`` an
+    exact copy, transferring only the files it does not have. The manifest
+    of the replica from the last run is trusted unless ``rescan`` is set.
+
+    :returns: how many files and bytes were transferred, and how many
+              files were removed
+    """
+    # the tree can not change while it is being replicated
+    with repo_lock(path):
+        return transfer_tree(path, target, streams, rescan, digests)
+
+
+def transfer_tree(path, target, streams, rescan, digests):
+    name = os.path.basename(path)
+    with span('manifest', 'replicate', repo=name):
+        local = tree_manifest(path, digests)
+        remote = None if rescan else target.read_manifest(name)
+        if remote is None:
+            remote = target.scan(name)
+    changed, removed = diff_manifests(local, remote)
+    sizes = dict((changed_path, local[changed_path][0]) for changed_path in changed)
+    total_bytes = sum(sizes.values())
+    if not changed and not removed:
+        logger.info('%s is up to date on %s', name, target)
+        target.write_manifest(name, local)
+        return 0, 0, 0
+
+    progress = Progress(
+        'replicating %s to %s' % (name, target),
+        total_bytes=total_bytes,
+        total_files=len(changed),
+    )
+    with progress:
+        # packages first, then the metadata that lists them, then the
+        # files that nothing lists anymore
+        packages = [p for p in changed if not is_metadata_path(p)]
+        metadata = [p for p in changed if is_metadata_path(p)]
+        for paths in [packages, metadata]:
+            errors = []
+
+            def stream(batch):
+                try:
+                    target.put(path, name, batch, progress)
+                except Exception as exc:
+                    errors.append(exc)
+            workers = [
+                threading.Thread(target=stream, args=(batch,))
+                for batch in split_streams(paths, sizes, streams)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if errors:
+                raise errors[0]
+        if removed:
+            target.remove(name, removed)
+    target.write_manifest(name, local)
+    logger.info(
+        '%s replicated to %s: %s files (%s) transferred, %s removed',
+        name, target, len(changed), format_bytes(total_bytes), len(removed)
+    )
+    return len(changed), total_bytes, len(removed)
+
+
+def replicate(target, names=None, streams=4, rescan=False):
+    """
+    Replicate the repos served to remote hosts (or the ones in ``names``)
+    to ``target``, see ``replica_target``
+    """
+    trees = [path for path in published_trees() if os.path.dirname(path) == REMOTE_REPO_DIR]
+    if names:
+        unknown = set(names) - set(os.path.basename(path) for path in trees)
+        if unknown:
+            raise InvalidRepoName('Unrecognized repo name(s) given: %s' % ', '.join(sorted(unknown)))
+        trees = [path for path in trees if os.path.basename(path) in names]
+    digests = Store().digests()
+    totals = [0, 0, 0]
+    for path in trees:
+        for index, value in enumerate(replicate_tree(path, target, streams, rescan, digests)):
+            totals[index] += value
+    return tuple(totals)
+
+
+# =============================================================================
+# Preflight
+# =============================================================================
+
+
+def existing_ancestor(path):
+    """``path`` or the closest of its parents that exists"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def round_up(nbytes, block_size):
+    return -(-nbytes // block_size) * block_size
+
+
+def sample_throughput(source, directory, limit=32 * 1024 * 1024):
+    """
+    Bytes per second at which ``source`` is copied into ``directory``,
+    measured on its first ``limit`` bytes, written through to the disk
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ice-preflight-')
+    started = time.time()
+    copied = 0
+    try:
+        with open(source, 'rb') as src:
+            while copied < limit:
+                chunk = src.read(min(1048576, limit - copied))
+                if not chunk:
+                    break
+                os.write(fd, chunk)
+                copied += len(chunk)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        os.remove(tmp_path)
+    elapsed = time.time() - started
+    return copied / elapsed if elapsed and copied else None
+
+
+class CapacityPlan(object):
+    """
+    The bytes and inodes that publishing (or syncing) is going to take on
+    every filesystem, checked against what ``statvfs`` says they have before
+    anything is changed. Publishing adds a new generation next to the
+    current one, so the current files are never counted as free.
+    """
+
+    # left free on top of what is needed, for logs, metadata and the like
+    reserve_bytes = 64 * 1024 * 1024
+
+    def __init__(self):
+        # by device: the path it was first seen at, bytes, inodes and the
+        # largest file to copy, for sampling the throughput
+        self.filesystems = {}
+
+    def filesystem(self, path):
+        path = existing_ancestor(path)
+        device = os.stat(path).st_dev
+        if device not in self.filesystems:
+            self.filesystems[device] = dict(
+                path=path, bytes=0, inodes=0, sample=None, sample_size=0,
+                block_size=os.statvfs(path).f_frsize or 4096,
+            )
+        return self.filesystems[device]
+
+    def add(self, path, nbytes, inodes, sample=None):
+        filesystem = self.filesystem(path)
+        filesystem['bytes'] += nbytes
+        filesystem['inodes'] += inodes
+        if sample and os.path.getsize(sample) > filesystem['sample_size']:
+            filesystem['sample'], filesystem['sample_size'] = sample, os.path.getsize(sample)
+
+    def add_publish(self, source, destination, checksum=False):
+        """
+        Account for ``publish_tree(source, destination)``. Files that are in
+        the current generation of ``destination`` with the same size and
+        modification time are linked rather than copied, so they take no
+        space (and no inode). With the store on the same filesystem every
+        other file is one new blob, otherwise it is copied.
+        """
+        if is_up_to_date(source, destination, checksum):
+            return
+        published = {}
+        if os.path.isdir(destination):
+            for dirpath, dirnames, filenames in os.walk(destination, followlinks=True):
+                for name in filenames:
+                    file_stat = os.stat(os.path.join(dirpath, name))
+                    relative = os.path.relpath(os.path.join(dirpath, name), destination)
+                    published[relative] = (file_stat.st_size, int(file_stat.st_mtime))
+        # like ``Store.usable_for``, without creating the store
+        store = Store()
+        same_filesystem = (
+            os.stat(existing_ancestor(store.path)).st_dev ==
+            os.stat(existing_ancestor(os.path.dirname(destination))).st_dev
+        )
+        target = store.path if same_filesystem else destination
+        block_size = self.filesystem(target)['block_size']
+        nbytes = 0
+        inodes = 0
+        largest = None
+        largest_size = -1
+        for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+            inodes += 1
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                file_stat = os.stat(path)
+                relative = os.path.relpath(path, source)
+                if published.get(relative) == (file_stat.st_size, int(file_stat.st_mtime)):
+                    continue
+                nbytes += round_up(file_stat.st_size, block_size)
+                inodes += 1
+                if file_stat.st_size > largest_size:
+                    largest, largest_size = path, file_stat.st_size
+        self.add(target, nbytes, inodes, sample=largest)
+
+    def check(self, sample=True):
+        """
+        Log what is needed where, with an estimate of how long copying it
+        takes, and raise ``InsufficientSpace`` if it does not fit
+        """
+        shortfalls = []
+        for filesystem in self.filesystems.values():
+            if not filesystem['bytes'] and not filesystem['inodes']:
+                continue
+            vfs = os.statvfs(filesystem['path'])
+            free_bytes = vfs.f_bavail * vfs.f_frsize
+            estimate = ''
+            if sample and filesystem['sample']:
+                rate = sample_throughput(filesystem['sample'], filesystem['path'])
+                if rate:
+                    estimate = ', about %s at %s/s' % (
+                        format_duration(filesystem['bytes'] / rate), format_bytes(rate)
+                    )
+            logger.info(
+                'publishing needs %s and %s inodes on %s (%s free)%s',
+                format_bytes(filesystem['bytes']), filesystem['inodes'],
+                filesystem['path'], format_bytes(free_bytes), estimate,
+            )
+            if filesystem['bytes'] + self.reserve_bytes > free_bytes:
+                shortfalls.append((
+                    filesystem['path'], 'bytes', filesystem['bytes'] + self.reserve_bytes, free_bytes
+                ))
+            # filesystems without a fixed number of inodes report none
+            if vfs.f_files and filesystem['inodes'] > vfs.f_favail:
+                shortfalls.append((filesystem['path'], 'inodes', filesystem['inodes'], vfs.f_favail))
+        if shortfalls:
+            raise InsufficientSpace(shortfalls)
+
+
+def preflight(trees, checksum=False, sample=True):
+    """
+    Make sure that the ``(source, destination)`` trees about to be
+    published fit, before any of them is touched
+    """
+    plan = CapacityPlan()
+    with span('preflight', 'plan'):
+        for source, destination in trees:
+            plan.add_publish(source, destination, checksum)
+        plan.check(sample=sample)
+    return plan
+
+
+# =============================================================================
+# Verification
+# =============================================================================
+
+
+# tags of the signature header of a package
+RPMSIGTAG_SIZE = 1000
+RPMSIGTAG_MD5 = 1004
+RPMSIGTAG_SHA1 = 269
+RPMSIGTAG_SHA256 = 273
+RPMSIGTAG_SIGNATURES = (267, 268, 1002, 1005, 1006)  # DSA, RSA, PGP, GPG, PGP5
+
+
+def check_rpm(path):
+    """
+    Check the digests a package carries in its signature header against
+    its contents, without ``rpm``. Signatures can not be verified this way,
+    only found.
+
+    :returns: what is wrong with the package (``None`` if nothing is), and
+              whether it is signed
+    """
+    with open(path, 'rb') as f:
+        lead = f.read(96)
+        if len(lead) < 96 or lead[:4] != RPM_LEAD_MAGIC:
+            return 'not an rpm package', False
+        try:
+            raw, signature = read_rpm_header(f)
+            # the header after the signature is aligned to 8 bytes
+            f.read(-len(raw) % 8)
+            header, _ = read_rpm_header(f)
+        except ValueError as error:
+            return str(error), False
+        signed = any(tag in signature for tag in RPMSIGTAG_SIGNATURES)
+        md5 = hashlib.md5(header)
+        size = len(header)
+        while True:
+            block = f.read(1048576)
+            if not block:
+                break
+            md5.update(block)
+            size += len(block)
+    expected = dict(
+        (tag, rpm_header_value(raw, signature[tag]))
+        for tag in [RPMSIGTAG_SIZE, RPMSIGTAG_MD5, RPMSIGTAG_SHA1, RPMSIGTAG_SHA256]
+        if tag in signature
+    )
+    if RPMSIGTAG_SIZE in expected and expected[RPMSIGTAG_SIZE] != size:
+        return 'size is %s, should be %s' % (size, expected[RPMSIGTAG_SIZE]), signed
+    if RPMSIGTAG_SHA256 in expected and hashlib.sha256(header).hexdigest() != expected[RPMSIGTAG_SHA256]:
+        return 'header SHA256 digest does not match', signed
+    if RPMSIGTAG_SHA1 in expected and hashlib.sha1(header).hexdigest() != expected[RPMSIGTAG_SHA1]:
+        return 'header SHA1 digest does not match', signed
+    if RPMSIGTAG_MD5 in expected and md5.digest() != expected[RPMSIGTAG_MD5]:
+        return 'MD5 digest does not match', signed
+    if not expected:
+        return 'no digests to check', signed
+    return None, signed
+
+
+def parse_rpm_checksig(lines):
+    """
+    Read the output of ``rpm -Kv``: a line with the path of each package,
+    followed by an indented line for each digest and signature, like
+    ``Header SHA1 digest: OK``. A package is signed when a signature checks
+    out, and a signature made with a key that is not imported (``NOKEY``)
+    is neither a problem nor makes it signed.
+
+    :returns: ``{path: (problems, signed, keys missing)}``
+    """
+    results = {}
+    path = None
+    for line in lines:
+        if not line.strip():
+            continue
+        if not line[0].isspace():
+            path, _, rest = line.rstrip().rpartition(':')
+            results[path] = (['NOT OK'] if 'NOT OK' in rest else [], False, False)
+            continue
+        if path is None or ':' not in line:
+            continue
+        what, result = line.strip().rsplit(':', 1)
+        result = result.split()[0].rstrip(',') if result.split() else ''
+        problems, signed, nokey = results[path]
+        if result == 'NOKEY':
+            nokey = True
+        elif result != 'OK':
+            # BAD, and NOTTRUSTED or NOTFOUND for a signature that can not
+            # be relied on
+            problems.append('%s: %s' % (what, result))
+        elif 'Signature' in what or 'signature' in what:
+            signed = True
+        results[path] = (problems, signed, nokey)
+    return results
+
+
+def deb_packages_index(source):
+    """
+    The packages listed in the ``Packages`` indexes of the apt repo in
+    ``source``, as ``{path: (size, algorithm, digest)}``
+
+    :returns: the packages, and the problems with the indexes themselves,
+              checked against the digests in the ``Release`` files
+    """
+    packages = {}
+    problems = []
+    dists = os.path.join(source, 'dists')
+    if not os.path.isdir(dists):
+        return packages, problems
+    for codename in sorted(os.listdir(dists)):
+        release = os.path.join(dists, codename, 'Release')
+        if not os.path.isfile(release):
+            continue
+        listed = {}
+        in_sha256 = False
+        with open(release) as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            if not line.startswith(' '):
+                in_sha256 = line.startswith('SHA256:')
+                continue
+            fields = line.split()
+            if in_sha256 and len(fields) == 3:
+                listed[fields[2]] = (int(fields[1]), fields[0])
+        for name, (size, digest) in sorted(listed.items()):
+            index = os.path.join(dists, codename, name)
+            if not os.path.isfile(index):
+                continue
+            if os.path.getsize(index) != size or file_digest(index) != digest:
+                problems.append((os.path.relpath(index, source), 'does not match its Release file'))
+            elif name.endswith('/Packages'):
+                with open(index) as f:
+                    packages.update(parse_packages_index(f.read()))
+    return packages, problems
+
+
+def parse_packages_index(contents):
+    """``{path: (size, algorithm, digest)}`` of the packages in ``contents``"""
+    packages = {}
+    stanza = {}
+    for line in contents.splitlines() + ['']:
+        if not line.strip():
+            if 'Filename' in stanza:
+                if 'SHA256' in stanza:
+                    digest = ('sha256', stanza['SHA256'])
+                else:
+                    digest = ('md5', stanza.get('MD5sum'))
+                packages[os.path.normpath(stanza['Filename'])] = (int(stanza.get('Size', -1)),) + digest
+            stanza = {}
+        elif not line.startswith(' ') and ':' in line:
+            key, value = line.split(':', 1)
+            stanza[key] = value.strip()
+    return packages
+
+
+def check_ar_archive(path):
+    """
+    Make sure that a ``.deb`` that no index lists is a whole ``ar`` archive
+    with the members a package has, since there is no digest to check it
+    against
+
+    :returns: what is wrong with it, if anything
+    """
+    size = os.path.getsize(path)
+    members = []
+    with open(path, 'rb') as f:
+        if f.read(8) != '!<arch>\n':
+            return 'not a deb package'
+        position = 8
+        while position < size:
+            header = f.read(60)
+            if len(header) < 60 or header[58:60] != '`\n' or not header[48:58].strip().isdigit():
+                return 'truncated or corrupt archive'
+            member_size = int(header[48:58])
+            members.append(header[:16].strip().rstrip('/'))
+            position += 60 + member_size + member_size % 2
+            f.seek(position)
+    if position != size:
+        return 'truncated archive'
+    if members[:1] != ['debian-binary'] or not any(m.startswith('data.tar') for m in members):
+        return 'missing package members'
+    return None
+
+
+class PackageVerifier(object):
+    """
+    Checks the digests (and, with ``use_gpg``, the signatures) of every
+    package in a tree before it is published, so that a corrupt or unsigned
+    package is found here rather than on every host that installs it.
+
+    rpms are checked with ``rpm -K`` in batches, or against the digests in
+    their headers when ``rpm`` is not installed. debs are checked against
+    the digests in the ``Packages`` index of their repo, and the indexes
+    against the ``Release`` files. The batches are spread over ``jobs``
+    threads, and no more are started after the first failure.
+    """
+
+    # verify before publishing, see ``--no-verify``
+    enabled = True
+    batch_size = 50
+
+    def __init__(self, source, use_gpg=True, jobs=None):
+        self.source = source
+        self.use_gpg = use_gpg
+        self.jobs = jobs or min(8, (multiprocessing.cpu_count() or 1))
+        self.lock = threading.Lock()
+        self.failures = []
+        self.nokey = []
+        self.failed = threading.Event()
+
+    def verify(self):
+        """
+        :returns: how many packages were checked
+        :raises: ``VerificationFailed`` with every failure found
+        """
+        rpms = []
+        debs = []
+        for dirpath, dirnames, filenames in os.walk(self.source, followlinks=True):
+            for name in sorted(filenames):
+                if name.endswith('.rpm'):
+                    rpms.append(os.path.join(dirpath, name))
+                elif name.endswith('.deb'):
+                    debs.append(os.path.join(dirpath, name))
+        if not rpms and not debs:
+            return 0
+        index, problems = deb_packages_index(self.source) if debs else ({}, [])
+        for path, problem in problems:
+            self.fail(path, problem)
+
+        check_rpms = self.rpm_batch if which('rpm') else self.rpm_files
+        batches = Queue.Queue()
+        for start in range(0, len(rpms), self.batch_size):
+            batches.put((check_rpms, rpms[start:start + self.batch_size]))
+        for start in range(0, len(debs), self.batch_size):
+            batches.put((lambda paths: self.deb_files(paths, index), debs[start:start + self.batch_size]))
+
+        progress = Progress('verifying %s' % self.source, total_files=len(rpms) + len(debs))
+
+        def work():
+            while not self.failed.is_set():
+                try:
+                    check, paths = batches.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    check(paths)
+                except Exception as error:
+                    logger.debug('checking %s packages failed', len(paths), exc_info=True)
+                    for path in paths:
+                        self.fail(os.path.relpath(path, self.source), 'could not be checked: %s' % error)
+                progress.update(files=len(paths))
+        with span('verify', 'file', source=self.source):
+            with progress:
+                workers = [threading.Thread(target=work) for number in range(self.jobs)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+
+        if self.nokey:
+            logger.warning(
+                'the signatures of %s packages in %s could not be checked, their keys are not imported: %s',
+                len(self.nokey), self.source, ', '.join(sorted(self.nokey)),
+            )
+        if self.failures:
+            for path, problem in sorted(self.failures):
+                logger.error('%s: %s', path, problem)
+            raise VerificationFailed(self.source, sorted(self.failures))
+        logger.info('verified %s packages in %s', len(rpms) + len(debs), self.source)
+        return len(rpms) + len(debs)
+
+    def fail(self, path, problem):
+        with self.lock:
+            self.failures.append((path, problem))
+        self.failed.set()
+
+    def check_signed(self, path, signed):
+        if self.use_gpg and not signed:
+            self.fail(os.path.relpath(path, self.source), 'not signed')
+
+    def rpm_batch(self, paths):
+        cmd = ['rpm', '-Kv']
+        if not self.use_gpg:
+            cmd.append('--nosignature')
+        stdout, stderr, returncode = run_call(cmd + paths)
+        results = parse_rpm_checksig(stdout)
+        for path in paths:
+            if path not in results:
+                # rpm could not read it at all, and said why on stderr
+                problem = ' '.join(line for line in stderr if path in line) or 'could not be read'
+                self.fail(os.path.relpath(path, self.source), problem)
+                continue
+            problems, signed, nokey = results[path]
+            if problems:
+                self.fail(os.path.relpath(path, self.source), ', '.join(problems))
+            elif nokey and not signed:
+                with self.lock:
+                    self.nokey.append(os.path.relpath(path, self.source))
+            else:
+                self.check_signed(path, signed)
+
+    def rpm_files(self, paths):
+        for path in paths:
+            problem, signed = check_rpm(path)
+            if problem:
+                self.fail(os.path.relpath(path, self.source), problem)
+            else:
+                self.check_signed(path, signed)
+
+    def deb_files(self, paths, index):
+        for path in paths:
+            relative = os.path.relpath(path, self.source)
+            if relative not in index:
+                problem = check_ar_archive(path)
+                if problem:
+                    self.fail(relative, problem)
+                continue
+            size, algorithm, digest = index[relative]
+            if os.path.getsize(path) != size:
+                self.fail(relative, 'size is %s, should be %s' % (os.path.getsize(path), size))
+            elif file_digest(path, algorithm) != digest:
+                self.fail(relative, '%s digest does not match' % algorithm.upper())
+
+
+def verify_packages(source, use_gpg=True):
+    """check the packages in ``source`` before publishing, see ``PackageVerifier``"""
+    if not PackageVerifier.enabled:
+        logger.debug('not verifying the packages in %s', source)
+        return 0
+    return PackageVerifier(source, use_gpg=use_gpg).verify()
+
+
+# =============================================================================
+# Actions
+# =============================================================================
+
+
+class Configure(object):
+
+    _help = dedent("""
+    Configures the ICE node as a repository Host.
+
+    Commands:
+
+      all         Configure both local and remote repos
+      local       Configure repos necessary to install calamari and ceph-deploy
+                  on this local host
+      remote      Configure repos necessary to install ceph and calamari
+                  on remote hosts
+
+    Options:
+
+      --checksum  Compare the full contents of the packages, not just their
+                  sizes and modification times, to decide if a repository is
+                  already up to date
+
+    Details:
+      Each of the commands can optionally be followed by a path to the package
+      files. If no path is given, the current working directory is searched for
+      packages.
+
+      Repositories that are already up to date are not copied again.
+    """)
+
+    def __init__(self, argv):
+        self.argv = argv
+
+    def package_path(self, parser, command):
+        # flags that come after the command are not a package path
+        value = parser.get(command)
+        if value and value.startswith('-'):
+            return None
+        return value
+
+    def parse_args(self):
+        options = ['all', 'local', 'remote', '--checksum']
+        parser = Transport(self.argv, options=options)
+        parser.catch_help = self._help
+        parser.parse_args()
+
+        sudo_check()
+        checksum = parser.has('--checksum')
+        # a global flag, so it is not one of our options
+        use_gpg = not parser.has('--no-gpg')
+
+        if parser.has('all'):
+            package_path = self.package_path(parser, 'all')
+            preflight(
+                local_publish_trees(package_path) + remote_publish_trees(package_path),
+                checksum=checksum,
+            )
+            configure_local('Calamari', package_path, use_gpg=use_gpg, checksum=checksum)
+            configure_local('Installer', package_path, use_gpg=use_gpg, checksum=checksum)
+            configure_local('Tools', package_path, use_gpg=use_gpg, checksum=checksum)
+            configure_remote('ceph-osd', package_path, use_gpg=use_gpg, checksum=checksum)
+            configure_remote('ceph-mon', package_path, use_gpg=use_gpg, checksum=checksum)
+            pin_local_repos()
+            after_publishing()
+
+        elif parser.has('local'):
+            package_path = self.package_path(parser, 'local')
+            preflight(local_publish_trees(package_path), checksum=checksum)
+            configure_local('Calamari', package_path, use_gpg=use_gpg, checksum=checksum)
+            configure_local('Installer', package_path, use_gpg=use_gpg, checksum=checksum)
+            configure_local('Tools', package_path, use_gpg=use_gpg, checksum=checksum)
+            pin_local_repos()
+
+        elif parser.has('remote'):
+            package_path = self.package_path(parser, 'remote')
+            preflight(remote_publish_trees(package_path), checksum=checksum)
+            configure_remote('ceph-osd', package_path, use_gpg=use_gpg, checksum=checksum)
+            configure_remote('ceph-mon', package_path, use_gpg=use_gpg, checksum=checksum)
+            after_publishing()
+
+        return True
+
+
+def local_publish_trees(package_path, names=('Calamari', 'Installer', 'Tools')):
+    """the ``(source, destination)`` of the local repos, see ``preflight``"""
+    return [
+        (get_package_source(package_path, name), os.path.join(LOCAL_REPO_DIR, name))
+        for name in names
+    ]
+
+
+def remote_publish_trees(package_path, names=('ceph-osd', 'ceph-mon')):
+    """the ``(source, destination)`` of the remote repos, see ``preflight``"""
+    return [
+        (get_package_source(package_path, name), os.path.join(REMOTE_REPO_DIR, name))
+        for name in names
+    ]
+
+
+def fqdn_with_protocol(answers=None):
+    """
+    Prompt the user for the FQDN of the current server along with the
+    protocol to be used so that we can configure the repositories. Values
+    found in ``answers`` are used instead of prompting.
     """
-    fallback_fqdn = get_fqdn()
-    logger.info('this host will be used to host packages')
-    logger.info('and will act as a repository for other nodes')
-    if fallback_fqdn is None:
-        logger.warning('no FQDN could be detected for current host')
-    fqdn = prompt('provide the FQDN for this host:', default=fallback_fqdn)
+    answers = answers or Answers()
+    with holding_output():
+        return _fqdn_with_protocol(answers)
+
+
+def _fqdn_with_protocol(answers):
+    fqdn = answers.get('fqdn')
+    if fqdn is not None and not fqdn.strip():
+        # asking again would get the same answer from the file
+        raise ICEError('fqdn in %s is empty' % answers.path)
+    if fqdn is None:
+        fallback_fqdn = get_fqdn()
+        logger.info('this host will be used to host packages')
+        logger.info('and will act as a repository for other nodes')
+        if fallback_fqdn is None:
+            logger.warning('no FQDN could be detected for current host')
+        fqdn = prompt('provide the FQDN for this host:', default=fallback_fqdn)
 
     # make sure we do have a FQDN of some sort, complain otherwise
     if not fqdn:
         logger.error('a FQDN is required and was not provided, please try again')
-        return fqdn_with_protocol()
-
-    protocol = prompt(
-        'If you have manually configured your Calamari web server for HTTPS, select \'https\', otherwise select the default \'http\'',
-        default='http',
-        lowercase=True,
-    )
+        return _fqdn_with_protocol(answers)
+
+    protocol = answers.get('protocol')
+    if protocol is None:
+        protocol = prompt(
+            'If you have manually configured your Calamari web server for HTTPS, select \'https\', otherwise select the default \'http\'',
+            default='http',
+            lowercase=True,
+        )
+    elif protocol.lower() not in ('http', 'https'):
+        raise ICEError('protocol in %s should be http or https, not %s' % (answers.path, protocol))
 
-    return protocol, fqdn
+    return protocol.lower(), fqdn
 
 
-def get_package_path(package_path):
+def get_package_path(package_path, answers=None):
     """
     Prompt the user for the path to the packages to be place in
-    locally hosted repos.
+    locally hosted repos, unless ``answers`` has it.
     """
+    answers = answers or Answers()
+    if answers.get('package_path') is not None:
+        return answers.get('package_path')
     package_path = prompt(
         'provide the path to packages to place in the repo',
         default=package_path
@@ -1320,7 +5390,9 @@ def get_package_path(package_path):
 def configure_remote(
         name,
         package_path,
-        destination_name=None):
+        destination_name=None,
+        checksum=False,
+        use_gpg=True):
     """
     Configure the current host so that Calamari can serve as a repo server for
     remote hosts. Some abstraction here allows us to configure any number of
@@ -1336,20 +5408,29 @@ def configure_remote(
 
     :param destination_name: defaults to ``name``, used to use a new
     destination name, e.g. 'ceph0.80' to help with versioning.
+
+    :param checksum: compare the full contents of the files, rather than their
+    sizes and modification times, to decide if the repo is up to date.
+
+    :param use_gpg: require the packages to be signed, see ``verify_packages``.
     """
     destination_name = destination_name or name
-    repo_dest_prefix = '/opt/calamari/webapp/content'
+    repo_dest_prefix = REMOTE_REPO_DIR
+    repo_dest_dir = os.path.join(repo_dest_prefix, destination_name)
 
     package_source = get_package_source(package_path, name)
 
+    if is_up_to_date(package_source, repo_dest_dir, checksum):
+        logger.info('the remote repository for %s is up to date', destination_name)
+        return destination_name
+
+    # nothing is published if a package is corrupt or not signed
+    verify_packages(package_source, use_gpg=use_gpg)
+
     # overwrite the repo with the new packages
-    overwrite_dir(
+    publish_tree(
         package_source,
-        destination=os.path.join(
-            repo_dest_prefix,
-            destination_name,
-        )
-
+        destination=repo_dest_dir,
     )
 
     return destination_name
@@ -1366,7 +5447,8 @@ def configure_ceph_deploy(master,
                           use_gpg=True):
     """
     Write the ceph-deploy conf to automagically tell ceph-deploy to use
-    the right repositories and flags without making the user specify them
+    the right repositories and flags without making the user specify them.
+    The repo URLs can be lists of mirrors.
     """
     # ensure we write the config file in all these places because the $HOME
     # location might not be what the user expected to be
@@ -1383,9 +5465,9 @@ def configure_ceph_deploy(master,
         with open(cephdeploy_conf, 'w') as rc_file:
             contents = ceph_deploy_rc.format(
                 master=master,
-                ceph_mon_url=ceph_mon_url,
+                ceph_mon_url=join_mirrors(ceph_mon_url),
                 ceph_mon_gpg_url=ceph_mon_gpg_url,
-                ceph_osd_url=ceph_osd_url,
+                ceph_osd_url=join_mirrors(ceph_osd_url),
                 ceph_osd_gpg_url=ceph_osd_gpg_url,
                 gpg_check=1 if use_gpg else 0,
             )
@@ -1393,17 +5475,24 @@ def configure_ceph_deploy(master,
             rc_file.write(contents)
 
 
-def configure_local(name, package_path, use_gpg=True):
+def configure_local(name, package_path, use_gpg=True, checksum=False, refresh=True):
     """
     Configure the current host so that it can serve as a *local* repo server
-    and we can then install Calamari and ceph-deploy.
+    and we can then install Calamari and ceph-deploy. Nothing is done if the
+    repository and its repo file are already up to date.
 
     :param name: The name of the repository to be configured, e.g. calamari-server
                  or ceph-deploy
     :param package_path: Base directory that should be searched for 'name' and
                          should contain the packages to add to the repo
+    :param checksum: compare the full contents of the files, rather than their
+                     sizes and modification times, to decide if the repo is
+                     up to date
+    :param refresh: call update on the package manager once the repo is in
+                    place, callers configuring several repos can do it once
+                    at the end instead
     """
-    repo_dest_prefix = '/opt/ICE'
+    repo_dest_prefix = LOCAL_REPO_DIR
     repo_dest_dir = os.path.join(repo_dest_prefix, name)
 
     package_source = get_package_source(package_path, name)
@@ -1421,13 +5510,26 @@ def configure_local(name, package_path, use_gpg=True):
         name,
     )
 
+    repo_file_is_written = repo_file_is_current(
+        distro.pkg_manager,
+        name,
+        repo_url_path,
+        gpg_url_path,
+        file_name=name,
+        codename=distro.codename,
+        use_gpg=use_gpg,
+    )
+    if repo_file_is_written and is_up_to_date(package_source, repo_dest_dir, checksum):
+        logger.info('the local repository for %s is up to date', name)
+        return
+
+    # nothing is published if a package is corrupt or not signed
+    verify_packages(package_source, use_gpg=use_gpg)
+
     # overwrite the repo with the new packages
-    overwrite_dir(
+    publish_tree(
         package_source,
-        destination=os.path.join(
-            repo_dest_prefix,
-            name,
-        )
+        destination=repo_dest_dir,
     )
 
     distro.pkg_manager.create_repo_file(
@@ -1444,8 +5546,13 @@ def configure_local(name, package_path, use_gpg=True):
             gpg_path,
         )
 
+    # the tree and repo file are in place, get the package manager going on
+    # the metadata while the rest of the work happens
+    distro.pkg_manager.prefetch(name)
+
     # call update on the package manager
-    distro.pkg_manager.update()
+    if refresh:
+        distro.pkg_manager.update()
     logger.info('this host now has a local repository for %s' % name)
     logger.info('you can install those packages with your package manager')
 
@@ -1454,7 +5561,7 @@ def install_calamari(distro=None):
     """ Installs the Calamari web application """
     distro = distro or get_distro()
     logger.debug('installing Calamari...')
-    pkgs = distro.pkg_manager.enumerate_repo('/opt/ICE/Calamari').split()
+    pkgs = distro.pkg_manager.enumerate_repo(os.path.join(LOCAL_REPO_DIR, 'Calamari')).split()
     distro.pkg_manager.install(pkgs)
 
 
@@ -1465,14 +5572,131 @@ def install_ceph_deploy(distro=None):
     distro.pkg_manager.install('ceph-deploy')
 
 
-def default(package_path, use_gpg):
+def step_banner(title):
+    logger.info('')
+    logger.info('{markup} {title} {markup}'.format(markup='====', title=title))
+    logger.info('')
+
+
+def package_tree(context, name):
+    """fingerprint of the package tree for ``name`` in the package path of a run"""
+    return tree_fingerprint(os.path.join(context['package_path'] or CWD, name))
+
+
+def local_repo_step(name):
+    def configure(context):
+        configure_local(
+            name,
+            context['package_path'],
+            use_gpg=context['use_gpg'],
+            refresh=False,
+        )
+    return configure
+
+
+def refresh_local_repos_step(context):
+    # step one, we can have lots of fun
+    # configure local repos for calamari and ceph-deploy
+    step_banner('Step 1: Calamari & ceph-deploy repo setup')
+    pin_local_repos()
+    get_distro().pkg_manager.update()
+
+
+def install_calamari_step(context):
+    # step two, there's so much we can do
+    # install calamari
+    step_banner('Step 2: Calamari installation')
+    install_calamari()
+
+
+def install_ceph_deploy_step(context):
+    # step three, it's just you for me
+    # install ceph-deploy
+    step_banner('Step 3: ceph-deploy installation')
+    install_ceph_deploy()
+
+
+def remote_repo_step(name):
+    # step four, I can give you more
+    # configure current host to serve ceph packages
+    def configure(context):
+        logger.info('configuring the %s repository for remote hosts', name)
+        configure_remote(name, context['package_path'], use_gpg=context['use_gpg'])
+    return configure
+
+
+def default_steps():
+    """
+    The steps of the default routine as a dependency graph, along with the
+    inputs that decide if a step needs to run again. Copying the repos for
+    remote hosts does not depend on anything, so it overlaps with setting up
+    the local repos and installing Calamari and ceph-deploy.
+    """
+    steps = []
+    for name in ['Calamari', 'Installer', 'Tools']:
+        steps.append(Step(
+            'local-%s' % name,
+            local_repo_step(name),
+            inputs=lambda c, name=name: dict(
+                tree=package_tree(c, name),
+                use_gpg=c['use_gpg'],
+            ),
+        ))
+    steps.extend([
+        Step(
+            'refresh-local-repos',
+            refresh_local_repos_step,
+            inputs=lambda c: dict(),
+            requires=['local-Calamari', 'local-Installer', 'local-Tools'],
+        ),
+        Step(
+            'install-calamari',
+            install_calamari_step,
+            inputs=lambda c: dict(calamari=package_tree(c, 'Calamari')),
+            requires=['refresh-local-repos'],
+        ),
+        Step(
+            'install-ceph-deploy',
+            install_ceph_deploy_step,
+            inputs=lambda c: dict(installer=package_tree(c, 'Installer')),
+            requires=['refresh-local-repos'],
+        ),
+    ])
+    for name in ['MON', 'OSD']:
+        steps.append(Step(
+            'remote-%s' % name,
+            remote_repo_step(name),
+            inputs=lambda c, name=name: dict(
+                tree=package_tree(c, name),
+                use_gpg=c['use_gpg'],
+            ),
+        ))
+    return steps
+
+
+def default(package_path, use_gpg, force=False, journal=None, jobs=4, answers=None, repo_port=None,
+            mirrors=None):
     """
     This action is the default entry point for a generic ICE setup. It goes
     through all the common questions and prompts for a user and initiates the
     configuration and setup. It does not offer granular support for given
     actions, e.g. "just install Calamari".
+
+    Completed steps are recorded in a journal so that a re-run skips them if
+    their inputs did not change, unless ``force`` is set. Up to ``jobs`` steps
+    that do not depend on each other run at the same time.
+
+    Every question is asked up front, before any long-running step starts,
+    and the ones that ``answers`` has are not asked at all. Disabling GPG
+    checks with ``use_gpg`` takes precedence over the answers file.
+
+    The repo URLs given to ceph-deploy point at ``repo_port`` when the repos
+    are served by ``ice_setup serve`` rather than by the web server, and at
+    the replicas in ``mirrors`` as well as this host, see
+    ``mirror_base_urls``.
     """
-    interactive_help()
+    answers = answers or Answers()
+    interactive_help(answers=answers)
     configure_steps = [
         '1. Configure the ICE Node (current host) as a repository Host',
         '2. Install Calamari web application on the ICE Node (current host)',
@@ -1485,65 +5709,39 @@ def default(package_path, use_gpg):
     for step in configure_steps:
         logger.info(step)
 
-    package_path = get_package_path(package_path)
-
-    # step one, we can have lots of fun
-    # configure local repos for calamari and ceph-deploy
-    logger.info('')
-    logger.info('{markup} Step 1: Calamari & ceph-deploy repo setup {markup}'.format(markup='===='))
-    logger.info('')
-    configure_local('Calamari', package_path, use_gpg=use_gpg)
-    configure_local('Installer', package_path, use_gpg=use_gpg)
-    configure_local('Tools', package_path, use_gpg=use_gpg)
-    pin_local_repos()
-
-    # step two, there's so much we can do
-    # install calamari
-    logger.info('')
-    logger.info('{markup} Step 2: Calamari installation {markup}'.format(markup='===='))
-    logger.info('')
-    install_calamari()
-
-    # step three, it's just you for me
-    # install ceph-deploy
-    logger.info('')
-    logger.info('{markup} Step 3: ceph-deploy installation {markup}'.format(markup='===='))
-    logger.info('')
-    install_ceph_deploy()
+    if use_gpg:
+        use_gpg = answers.getboolean('use_gpg', True)
+    context = dict(use_gpg=use_gpg)
+    with span('questions', 'prompt'):
+        context['package_path'] = get_package_path(package_path, answers)
+        # confirm the right protocol and fqdn for this host
+        context['protocol'], context['fqdn'] = fqdn_with_protocol(answers)
+
+    # nothing is touched if the repos would not fit
+    preflight(
+        local_publish_trees(context['package_path']) +
+        remote_publish_trees(context['package_path'], names=('MON', 'OSD'))
+    )
 
-    # confirm the right protocol and fqdn for this host
-    protocol, fqdn = fqdn_with_protocol()
+    journal = journal or Journal(force=force)
+    run_steps(default_steps(), context, journal, jobs=jobs)
+    after_publishing()
 
-    # step four, I can give you more
-    # configure current host to serve ceph packages
-    logger.info('')
-    logger.info('\
-        {markup} \
-        Step 4: ceph repositories setup \
-        {markup}'.format(markup='===='))
-    logger.info('')
-    # configure both the MON and OSD repos
-    ceph_mon_destination_name = configure_remote('MON', package_path)
-    ceph_osd_destination_name = configure_remote('OSD', package_path)
+    protocol, fqdn = context['protocol'], context['fqdn']
+    ceph_mon_destination_name, ceph_osd_destination_name = 'MON', 'OSD'
 
     distro = get_distro()
     # create the proper URLs for the repos
-    ceph_mon_url = '%s://%s/static/%s' % (protocol, fqdn, ceph_mon_destination_name)
-    ceph_osd_url = '%s://%s/static/%s' % (protocol, fqdn, ceph_osd_destination_name)
+    base_url = repo_base_url(protocol, fqdn, repo_port or answers.get('repo_port'))
+    base_urls = [base_url] + mirror_base_urls(protocol, mirrors or answers.get('mirrors'))
+    ceph_mon_url = ['%s/%s' % (url, ceph_mon_destination_name) for url in base_urls]
+    ceph_osd_url = ['%s/%s' % (url, ceph_osd_destination_name) for url in base_urls]
 
     if distro.name == "redhat":
         ceph_mon_gpg_url = ceph_osd_gpg_url = get_rhel_gpg_path()
     else:
-        ceph_mon_gpg_url = '%s://%s/static/%s/release.asc' % (
-            protocol,
-            fqdn,
-            ceph_mon_destination_name
-        )
-        ceph_osd_gpg_url = '%s://%s/static/%s/release.asc' % (
-            protocol,
-            fqdn,
-            ceph_osd_destination_name
-        )
+        ceph_mon_gpg_url = '%s/%s/release.asc' % (base_url, ceph_mon_destination_name)
+        ceph_osd_gpg_url = '%s/%s/release.asc' % (base_url, ceph_osd_destination_name)
 
     # write the ceph-deploy configuration file with the new repo info
     configure_ceph_deploy(
@@ -1595,12 +5793,17 @@ def default(package_path, use_gpg):
     logger.info('')
 
 
-def interactive_help(mode='interactive mode'):
+def interactive_help(mode='interactive mode', answers=None):
     """
     Display a re-usable set of instructions before entering a given action,
     like setting up the repository for remote nodes, that will provide the same
     information when the interactive mode is running.
+
+    Nothing is asked when running unattended with an answers file.
     """
+    if answers and answers.path:
+        logger.info('running unattended with answers from %s', answers.path)
+        return
     logger.info('')
     logger.info('{markup} {mode} {markup}'.format(markup='====', mode=mode))
     logger.info('')
@@ -1626,6 +5829,8 @@ class UpdateRepo(object):
 
       ceph-mon              Update the ceph-mon repo
       ceph-osd              Update the ceph-osd repo
+      --keep                Number of versions of each package to keep,
+                            older ones are removed (defaults to 2)
 
     Examples:
 
@@ -1643,23 +5848,33 @@ class UpdateRepo(object):
         self.optional_arguments = frozenset(['ceph-mon', 'ceph-osd'])
 
     def parse_args(self):
-        options = ['all']
+        options = ['all', '--keep']
         parser = Transport(self.argv, options=options)
         parser.catch_help = self._help
         parser.parse_args()
 
         sudo_check()
 
+        keep = parser.get('--keep', '2')
+        if not keep.isdigit() or int(keep) < 1:
+            raise ICEError('--keep should be a positive number, not: %s' % keep)
+        keep = int(keep)
+
+        arguments = strip_global_options(parser.arguments)
+        if '--keep' in arguments:
+            index = arguments.index('--keep')
+            del arguments[index:index + 2]
         if parser.has('all'):
-            update_repo(self.optional_arguments)
+            update_repo(self.optional_arguments, keep=keep)
         else:
-            if parser.arguments:
-                if frozenset(parser.arguments).issubset(self.optional_arguments):
+            if arguments:
+                if frozenset(arguments).issubset(self.optional_arguments):
                     update_repo(
-                        [i for i in parser.arguments if i in self.optional_arguments]
+                        [i for i in arguments if i in self.optional_arguments],
+                        keep=keep,
                     )
                 else:
-                    error_msg = "Unrecognized repo name(s) given: %s" % (", ".join(frozenset(parser.arguments).difference(self.optional_arguments)))
+                    error_msg = "Unrecognized repo name(s) given: %s" % (", ".join(frozenset(arguments).difference(self.optional_arguments)))
                     raise InvalidRepoName(error_msg)
             else:
                 parser.print_help()
@@ -1667,14 +5882,305 @@ class UpdateRepo(object):
         return True
 
 
-def update_repo(repos):
+class Dedup(object):
+
+    _help = dedent("""
+    Hardlinks identical packages across the published repositories (the
+    local repos and the ones served to remote hosts), and reports how much
+    space that saved. Files are only linked when their contents, size,
+    modification time and permissions all match.
+
+    This already happens after configuring or updating repositories, this
+    command is for trees that were published by older versions.
+
+    Examples:
+
+      ice_setup dedup
+    """)
+
+    def __init__(self, argv):
+        self.argv = argv
+
+    def parse_args(self):
+        parser = Transport(self.argv)
+        parser.catch_help = self._help
+        parser.parse_args()
+
+        sudo_check()
+        linked, freed = dedup_published()
+        if not linked:
+            logger.info('no duplicate packages found')
+
+        return True
+
+
+class Rollback(object):
+
+    _help = dedent("""
+    Switches a published repository back to one of its previous generations,
+    for when an update or a new bundle turns out to be bad. The switch is
+    atomic and immediate regardless of the size of the repository.
+
+    Usage:
+
+      ice_setup rollback <repo> [generation]
+
+    Arguments:
+
+      repo          Name of the repository, e.g. MON, OSD or Calamari
+      generation    Number of the generation to switch to, defaults to the
+                    one before the current one. Newer generations are kept,
+                    so a rollback can be undone by switching to them.
+
+    The previous %s generations of every repository are kept.
+
+    Examples:
+
+      ice_setup rollback OSD
+      ice_setup rollback OSD 4
+    """ % Generations.keep)
+
+    def __init__(self, argv):
+        self.argv = argv
+
+    def parse_args(self):
+        parser = Transport(self.argv)
+        parser.catch_help = self._help
+        parser.parse_args()
+
+        arguments = strip_global_options(parser.arguments)
+        if not arguments or len(arguments) > 2:
+            parser.print_help()
+            return True
+
+        sudo_check()
+        if len(arguments) == 2 and not arguments[1].isdigit():
+            raise ICEError('generation should be a number, not: %s' % arguments[1])
+        rollback(arguments[0], int(arguments[1]) if len(arguments) == 2 else None)
+
+        return True
+
+
+class Serve(object):
+
+    _help = dedent("""
+    Serves the repositories for remote hosts over HTTP, from the same paths
+    the Calamari web application uses (``/static/<repo>``), for when that
+    is not running or can not keep up with many hosts installing at once.
+    Files are sent with sendfile, and ranges, keep-alive and conditional
+    requests are supported. Runs until interrupted.
+
+    Pass the same port to the setup with ``--repo-port`` (or ``repo_port``
+    in the answers file) so that ceph-deploy uses it.
+
+    Options:
+
+      --port        Port to listen on, defaults to 8181
+      --bind        Address to listen on, defaults to all of them
+      --threads     Number of requests served at the same time, defaults
+                    to 256. Connections beyond that wait in the queue.
+
+    Examples:
+
+      ice_setup serve
+      ice_setup serve --port 80 --threads 1024
+    """)
+
+    def __init__(self, argv):
+        self.argv = argv
+
+    def parse_args(self):
+        parser = Transport(self.argv, options=['--port', '--bind', '--threads'])
+        parser.catch_help = self._help
+        parser.parse_args()
+
+        for option in ['--port', '--threads']:
+            value = parser.get(option)
+            if value is not None and (not value.isdigit() or int(value) < 1):
+                raise ICEError('%s should be a positive number, not: %s' % (option, value))
+        serve(
+            port=int(parser.get('--port', 8181)),
+            bind=parser.get('--bind', ''),
+            threads=int(parser.get('--threads', 256)),
+        )
+
+        return True
+
+
+class LoadTest(object):
+
+    _help = dedent("""
+    Simulates many hosts installing from a repository at the same time, to
+    find out how many an ICE node can serve. Every client fetches the repo
+    metadata and then a random set of packages, and the requests per second,
+    throughput and latency percentiles are reported.
+
+    Usage:
+
+      ice_setup loadtest <repo or url>
+
+    Arguments:
+
+      repo          Name of a published repository (e.g. OSD), served by a
+                    local server for the test, so no network is needed
+      url           URL of a repository, e.g. http://ice.example.com/static/OSD
+
+    Options:
+
+      --clients     Number of simulated hosts, defaults to 50
+      --packages    Packages every host fetches, defaults to 20
+      --rounds      Times every host fetches the metadata and packages,
+                    defaults to 1
+      --codename    Codename of an apt repository, yum is assumed otherwise
+      --timeout     Seconds before a request fails, defaults to 30
+      --output      Path to write the results to, as JSON
+
+    Examples:
+
+      ice_setup loadtest OSD --clients 200
+      ice_setup loadtest http://ice.example.com:8181/static/MON --codename trusty
+    """)
+
+    options = ['--clients', '--packages', '--rounds', '--codename', '--timeout', '--output']
+
+    def __init__(self, argv):
+        self.argv = argv
+
+    def parse_args(self):
+        parser = Transport(self.argv, options=self.options)
+        parser.catch_help = self._help
+        parser.parse_args()
+
+        arguments = strip_global_options(parser.arguments)
+        for option in self.options:
+            if option in arguments:
+                index = arguments.index(option)
+                del arguments[index:index + 2]
+        if len(arguments) != 1:
+            parser.print_help()
+            return True
+
+        numbers = {}
+        for option, default in [('--clients', 50), ('--packages', 20), ('--rounds', 1), ('--timeout', 30)]:
+            value = parser.get(option, str(default))
+            if not value.isdigit() or int(value) < 1:
+                raise ICEError('%s should be a positive number, not: %s' % (option, value))
+            numbers[option.lstrip('-')] = int(value)
+        results = load_test(arguments[0], codename=parser.get('--codename'), **numbers)
+        if parser.get('--output'):
+            with open(parser.get('--output'), 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        return True
+
+
+class Replicate(object):
+
+    _help = dedent("""
+    Copies the repositories served to remote hosts to a replica host, so
+    that more hosts can install at once (see --mirrors). Only the files the
+    replica does not have, or has a different version of, are transferred,
+    in parallel streams, and the repo metadata is replaced after the
+    packages it lists. Files that are gone from the repositories are
+    removed from the replica.
+
+    Usage:
+
+      ice_setup replicate <target> [repo ...]
+
+    Arguments:
+
+      target        Directory to replicate to, or [user@]host:/path to
+                    replicate to another host through ssh. It should be the
+                    directory the replica serves as /static.
+      repo          Names of the repositories to replicate, e.g. MON, OSD,
+                    defaults to all of them
+
+    Options:
+
+      --streams     Number of files transferred at the same time, defaults
+                    to 4
+      --ssh         Command used to reach the host, defaults to ssh
+      --rescan      Hash the files of the replica rather than trusting the
+                    manifest written by the last run
+
+    Examples:
+
+      ice_setup replicate ice2.example.com:/opt/calamari/webapp/content
+      ice_setup replicate /mnt/replica MON OSD --streams 8
+      ice_setup replicate ice2:/srv/ice --ssh "ssh -p 2222 -i ~/.ssh/ice"
+    """)
+
+    options = ['--streams', '--ssh', '--rescan']
+
+    def __init__(self, argv):
+        self.argv = argv
+
+    def parse_args(self):
+        parser = Transport(self.argv, options=self.options)
+        parser.catch_help = self._help
+        parser.parse_args()
+
+        arguments = strip_global_options(parser.arguments)
+        for option in ['--streams', '--ssh']:
+            if option in arguments:
+                index = arguments.index(option)
+                del arguments[index:index + 2]
+        arguments = [argument for argument in arguments if argument != '--rescan']
+        if not arguments:
+            parser.print_help()
+            return True
+
+        streams = parser.get('--streams', '4')
+        if not streams.isdigit() or int(streams) < 1:
+            raise ICEError('--streams should be a positive number, not: %s' % streams)
+        replicate(
+            replica_target(arguments[0], ssh=parser.get('--ssh', 'ssh')),
+            names=arguments[1:],
+            streams=int(streams),
+            rescan=parser.has('--rescan'),
+        )
+
+        return True
+
+
+def published_repo_path(name):
+    for parent in [REMOTE_REPO_DIR, LOCAL_REPO_DIR]:
+        path = os.path.join(parent, name)
+        if path in published_trees():
+            return path
+    error_msg = 'Unrecognized repo name given: %s (published repos: %s)' % (
+        name, ', '.join(os.path.basename(path) for path in published_trees())
+    )
+    raise InvalidRepoName(error_msg)
+
+
+def rollback(name, number=None):
+    """
+    Switch the repo ``name`` to generation ``number``, or to the one before
+    the current one
+    """
+    generations = Generations(published_repo_path(name))
+    with repo_lock(generations.path):
+        current = generations.current()
+        if number is None:
+            previous = [n for n in generations.numbers() if current is None or n < current]
+            if not previous:
+                raise GenerationNotFound(generations.path, 'before %s' % current, generations.numbers())
+            number = previous[-1]
+        generations.switch(number)
+    logger.info('%s now serves generation %s (was %s)', generations.path, number, current)
+
+
+def update_repo(repos, keep=2):
     distro = get_distro()
     logger.debug('updating repo%s: %s' % (
         's' if len(repos) > 1 else '',
         ' '.join(repos)
         )
     )
-    distro.pkg_manager.sync(repos, distro)
+    distro.pkg_manager.sync(repos, distro, keep=keep)
+    after_publishing()
 
 # =============================================================================
 # Main
@@ -1682,6 +6188,11 @@ def update_repo(repos):
 
 command_map = {
     'configure': Configure,
+    'dedup': Dedup,
+    'loadtest': LoadTest,
+    'replicate': Replicate,
+    'rollback': Rollback,
+    'serve': Serve,
     'update': UpdateRepo,
 }
 
@@ -1696,10 +6207,46 @@ def ice_help():
       -d / --dir        Override path to package files (defaults to
                         current working directory)
       --no-gpg          Disable GPG checking in repo files
+      --force           Run every setup step, even the ones that completed
+                        in a previous run with the same inputs
+      -j / --jobs       Number of setup steps that can run at the same time
+                        (defaults to 4)
+      --answers         Path to an INI file with answers to the prompts, to
+                        run unattended
+      --profile         Profile the run with cProfile and write the stats to
+                        /var/lib/ice_setup/profile.pstats
+      --events          File descriptor number or path to write a stream of
+                        JSON events (one per line) to, for orchestration tools
+      --trace           Path to write a Chrome trace of the run to, which can
+                        be loaded in about:tracing or perfetto
+      --log-file        Path to a (rotated) log file that gets the full
+                        output, the console then shows a summary of the
+                        output of commands
+      --repo-port       Port the repositories are served on, when they are
+                        served by `ice_setup serve`
+      --mirrors         Comma separated hosts (or base URLs) that have
+                        replicas of the repositories, for remote hosts to
+                        spread across
+      --no-wait         Fail right away when another run is working on the
+                        same repository (or the package manager), rather
+                        than waiting for it to finish
+      --throttle        Bytes per second to copy, download and extract at
+                        (e.g. 20M), can be changed while running by writing
+                        a new rate to /var/lib/ice_setup/throttle
+      --nice            Niceness increment for the commands that are run
+      --ionice          I/O priority of the commands that are run, `idle`
+                        or a best-effort level from 0 to 7
+      --no-verify       Publish the packages without checking their digests
+                        and signatures first
 
     Subcommands:
 
       configure         Configuration of the ICE node
+      dedup             Hardlink identical packages across repositories
+      loadtest          Measure how many hosts a repository can serve
+      replicate         Copy the repositories to a replica host
+      rollback          Switch a repository back to a previous generation
+      serve             Serve the repositories to remote hosts over HTTP
       update            Update local repositories from hosted repos.
     """
     return '%s\n%s\n%s\n%s' % (
@@ -1720,32 +6267,150 @@ def sudo_check():
         raise ICEError(msg)
 
 
-@catches(ICEError)
-def _main(argv=None):
-    options = [['-v', '--verbose'], ['-d', '--dir'], ['--no-gpg']]
-    argv = argv or sys.argv
-    parser = Transport(argv, mapper=command_map, options=options)
-    parser.parse_args()
+# options that apply to every subcommand, the ones in ``global_flags`` do not
+# take a value
+global_options = [
+    ['-v', '--verbose'],
+    ['-d', '--dir'],
+    ['--no-gpg'],
+    ['--force'],
+    ['-j', '--jobs'],
+    ['--answers'],
+    ['--profile'],
+    ['--events'],
+    ['--trace'],
+    ['--log-file'],
+    ['--repo-port'],
+    ['--mirrors'],
+    ['--no-wait'],
+    ['--throttle'],
+    ['--nice'],
+    ['--ionice'],
+    ['--no-verify'],
+]
+
+global_flags = ['-v', '--verbose', '--no-gpg', '--force', '--profile', '--no-wait', '--no-verify']
+
+
+def strip_global_options(arguments):
+    """
+    Remove the global options (and their values) from the arguments a
+    subcommand gets, so that they are not mistaken for its own arguments
+    """
+    valued = [o for opts in global_options for o in opts if o not in global_flags]
+    stripped = []
+    skip_value = False
+    for argument in arguments:
+        if skip_value:
+            skip_value = False
+        elif argument in global_flags:
+            continue
+        elif argument in valued:
+            skip_value = True
+        else:
+            stripped.append(argument)
+    return stripped
+
 
-    # Console Logger
-    terminal_log = logging.StreamHandler()
+def start_logging(parser):
+    """
+    Set up the console logger, and the full log file if one was requested,
+    behind the background log writer. The output of commands is rate
+    limited on the console when it all goes to the log file.
+    """
+    log_file = parser.get('--log-file')
+    terminal_log = ConsoleHandler(
+        output_rate=20 if log_file else None,
+        full_log=log_file,
+    )
     terminal_log.setFormatter(
         color_format(
             verbose=parser.has(('-v', '--verbose'))
         )
     )
-    logger.addHandler(terminal_log)
+    handlers = [terminal_log]
+    if log_file:
+        file_log = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=10 * 1024 * 1024, backupCount=5
+        )
+        file_log.setFormatter(logging.Formatter(FILE_FORMAT))
+        handlers.append(file_log)
     logger.setLevel(logging.DEBUG)
+    log_writer.start(handlers)
+
+
+@catches(ICEError)
+def _main(argv=None):
+    argv = argv or sys.argv
+    parser = Transport(argv, mapper=command_map, options=global_options)
+    parser.parse_args()
+
+    start_logging(parser)
+    try:
+        _dispatch(parser, argv)
+    finally:
+        log_writer.stop()
+
 
+def _dispatch(parser, argv):
     # parse first with no help; set defaults later
     parser.catch_version = __version__
     parser.catch_help = ice_help()
-    subcmds = parser.dispatch()
+    profiler.enabled = parser.has('--profile')
+    FileLock.wait = not parser.has('--no-wait')
+    PackageVerifier.enabled = not parser.has('--no-verify')
+    jobs = parser.get('-j', '4')
+    if not jobs.isdigit() or int(jobs) < 1:
+        raise ICEError('--jobs should be a positive number, not: %s' % jobs)
+    throttle.configure(
+        rate=parser.get('--throttle'),
+        nice=parser.get('--nice'),
+        ionice=parser.get('--ionice'),
+    )
+
+    events = None
+    if parser.get('--events'):
+        events = EventStream.open(parser.get('--events'))
+        recorder.listeners.append(events)
+        events.emit('run_start', argv=argv[1:], version=__version__)
+
+    trace = None
+    if parser.get('--trace'):
+        trace = TraceExporter(parser.get('--trace'), started=recorder.started)
+        recorder.listeners.append(trace)
+
+    status = 'error'
+    try:
+        subcmds = profiler.run(parser.dispatch)
+
+        # when no subcommands are passed in, just use our default routine
+        if not subcmds:
+            sudo_check()
+            profiler.run(
+                default,
+                parser.get('-d', CWD),
+                not parser.has(('--no-gpg')),
+                force=parser.has('--force'),
+                jobs=int(jobs),
+                answers=Answers(parser.get('--answers')),
+                repo_port=parser.get('--repo-port'),
+                mirrors=parser.get('--mirrors'),
+            )
+        status = 'ok'
+    except SystemExit as exc:
+        # help and version output exit cleanly
+        if not exc.code:
+            status = 'ok'
+        raise
+    finally:
+        if events:
+            events.emit('run_end', status=status, duration=time.time() - recorder.started)
+        report_timings()
+        if trace:
+            trace.write()
+        if profiler.enabled:
+            profiler.report(os.path.join(STATE_DIR, 'profile.pstats'))
 
-    # when no subcommands are passed in, just use our default routine
-    if not subcmds:
-        sudo_check()
-        default(parser.get('-d', CWD), not parser.has(('--no-gpg')))
 
 def main():
     # This try/except dance *just* for KeyboardInterrupt is horrible but there
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmpdir, monkeypatch):
+    """keep journals, lock files and caches of the tests out of the system"""
+    monkeypatch.setattr('ice_setup.ice.STATE_DIR', str(tmpdir.join('var-lib-ice_setup')))
+    monkeypatch.setattr('ice_setup.ice.DOWNLOAD_DIR', str(tmpdir.join('opt-ice-tmp')))
+    monkeypatch.setattr('ice_setup.ice.EXTRACT_CACHE_DIR', str(tmpdir.join('opt-ice-cache')))
@@ -0,0 +1,126 @@
+from textwrap import dedent
+
+import pytest
+
+from ice_setup.ice import (
+    Answers, ICEError, fqdn_with_protocol, get_package_path, interactive_help
+)
+
+
+def no_prompt(*a, **kw):
+    raise AssertionError('should not prompt')
+
+
+@pytest.fixture
+def answers_file(tmpdir):
+    def write(contents):
+        path = tmpdir.join('answers.ini')
+        path.write(dedent(contents))
+        return str(path)
+    return write
+
+
+class TestAnswers(object):
+
+    def test_missing_file(self, tmpdir):
+        with pytest.raises(ICEError):
+            Answers(str(tmpdir.join('missing.ini')))
+
+    def test_no_path_has_no_answers(self):
+        assert Answers().get('fqdn') is None
+
+    def test_get(self, answers_file):
+        answers = Answers(answers_file("""
+            [ice_setup]
+            fqdn = ice.example.com
+            """))
+        assert answers.get('fqdn') == 'ice.example.com'
+        assert answers.get('protocol') is None
+
+    def test_percent_sign(self, answers_file):
+        answers = Answers(answers_file("""
+            [ice_setup]
+            package_path = /opt/ice-100%
+            """))
+        assert answers.get('package_path') == '/opt/ice-100%'
+
+    def test_missing_section(self, answers_file):
+        answers = Answers(answers_file("""
+            [other]
+            fqdn = ice.example.com
+            """))
+        assert answers.get('fqdn') is None
+
+    @pytest.mark.parametrize('value,expected', [('yes', True), ('no', False), ('0', False)])
+    def test_getboolean(self, answers_file, value, expected):
+        answers = Answers(answers_file("""
+            [ice_setup]
+            use_gpg = %s
+            """ % value))
+        assert answers.getboolean('use_gpg', True) is expected
+
+    def test_invalid_boolean(self, answers_file):
+        answers = Answers(answers_file("""
+            [ice_setup]
+            use_gpg = maybe
+            """))
+        with pytest.raises(ICEError):
+            answers.getboolean('use_gpg', True)
+
+
+class TestUnattendedPrompts(object):
+
+    def test_package_path(self, answers_file, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.prompt', no_prompt)
+        answers = Answers(answers_file("""
+            [ice_setup]
+            package_path = /opt/bundle
+            """))
+        assert get_package_path('/cwd', answers) == '/opt/bundle'
+
+    def test_fqdn_and_protocol(self, answers_file, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.prompt', no_prompt)
+        answers = Answers(answers_file("""
+            [ice_setup]
+            fqdn = ice.example.com
+            protocol = HTTPS
+            """))
+        assert fqdn_with_protocol(answers) == ('https', 'ice.example.com')
+
+    def test_missing_protocol_is_prompted(self, answers_file, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.prompt', lambda *a, **kw: 'http')
+        answers = Answers(answers_file("""
+            [ice_setup]
+            fqdn = ice.example.com
+            """))
+        assert fqdn_with_protocol(answers) == ('http', 'ice.example.com')
+
+    def test_empty_fqdn(self, answers_file, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.prompt', no_prompt)
+        path = answers_file("""
+            [ice_setup]
+            fqdn =
+            protocol = http
+            """)
+        with pytest.raises(ICEError) as exc:
+            fqdn_with_protocol(Answers(path))
+        assert str(exc.value) == 'fqdn in %s is empty' % path
+
+    def test_empty_fqdn_prompted_again(self, monkeypatch):
+        replies = ['', 'ice.example.com', 'http']
+        monkeypatch.setattr('ice_setup.ice.get_fqdn', lambda: None)
+        monkeypatch.setattr('ice_setup.ice.prompt', lambda *a, **kw: replies.pop(0))
+        assert fqdn_with_protocol(Answers()) == ('http', 'ice.example.com')
+
+    def test_invalid_protocol(self, answers_file):
+        answers = Answers(answers_file("""
+            [ice_setup]
+            fqdn = ice.example.com
+            protocol = ftp
+            """))
+        with pytest.raises(ICEError):
+            fqdn_with_protocol(answers)
+
+    def test_interactive_help_does_not_prompt(self, answers_file, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.prompt_continue', no_prompt)
+        interactive_help(answers=Answers(answers_file("[ice_setup]\n")))
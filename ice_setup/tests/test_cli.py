@@ -0,0 +1,45 @@
+import pytest
+
+from ice_setup.ice import (
+    ICEError, Transport, _dispatch, command_map, global_options, strip_global_options,
+)
+
+
+class TestStripGlobalOptions(object):
+
+    def test_flags(self):
+        assert strip_global_options(['ceph-mon', '-v', '--force']) == ['ceph-mon']
+
+    def test_options_with_values(self):
+        arguments = ['ceph-mon', '--log-file', '/var/log/ice.log', 'ceph-osd']
+        assert strip_global_options(arguments) == ['ceph-mon', 'ceph-osd']
+
+
+class TestDispatch(object):
+
+    def test_subcommand_gets_arguments_from_its_name(self):
+        seen = []
+
+        class Subcommand(object):
+            def __init__(self, argv):
+                seen.append(argv)
+
+            def parse_args(self):
+                return True
+
+        parser = Transport(['ice_setup', '-v', 'sub', 'all'], mapper={'sub': Subcommand})
+        parser.dispatch()
+        assert seen == [['sub', 'all']]
+
+
+class TestGlobalOptions(object):
+
+    @pytest.mark.parametrize('jobs', ['x', '0', '-2'])
+    def test_invalid_jobs(self, jobs, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.default', pytest.fail)
+        argv = ['ice_setup', '--jobs', jobs]
+        parser = Transport(argv, mapper=command_map, options=global_options)
+        parser.parse_args()
+        with pytest.raises(ICEError) as exc:
+            _dispatch(parser, argv)
+        assert str(exc.value) == '--jobs should be a positive number, not: %s' % jobs
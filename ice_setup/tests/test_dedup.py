@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from ice_setup.ice import dedup_trees, overwrite_dir, published_trees, tree_fingerprint
+
+
+@pytest.fixture
+def repos(tmpdir, monkeypatch):
+    local = tmpdir.mkdir('ICE')
+    remote = tmpdir.mkdir('content')
+    monkeypatch.setattr('ice_setup.ice.LOCAL_REPO_DIR', str(local))
+    monkeypatch.setattr('ice_setup.ice.REMOTE_REPO_DIR', str(remote))
+    return local, remote
+
+
+def package(directory, name, contents, mtime=1000000000):
+    path = directory.join(name)
+    path.write(contents, ensure=True)
+    os.utime(str(path), (mtime, mtime))
+    return str(path)
+
+
+def inode(path):
+    return os.stat(str(path)).st_ino
+
+
+class TestDedupTrees(object):
+
+    def test_links_identical_packages(self, repos):
+        local, remote = repos
+        one = package(remote.join('MON'), 'librados2.rpm', 'rados' * 100)
+        other = package(remote.join('OSD'), 'librados2.rpm', 'rados' * 100)
+        assert dedup_trees([str(remote.join('MON')), str(remote.join('OSD'))]) == (1, 500)
+        assert inode(one) == inode(other)
+
+    def test_different_contents_are_left_alone(self, repos):
+        local, remote = repos
+        one = package(remote.join('MON'), 'ceph.rpm', 'a' * 100)
+        other = package(remote.join('OSD'), 'ceph.rpm', 'b' * 100)
+        assert dedup_trees([str(remote)]) == (0, 0)
+        assert inode(one) != inode(other)
+
+    def test_different_mtimes_are_left_alone(self, repos):
+        local, remote = repos
+        package(remote.join('MON'), 'ceph.rpm', 'a' * 100, mtime=1000000000)
+        package(remote.join('OSD'), 'ceph.rpm', 'a' * 100, mtime=1100000000)
+        assert dedup_trees([str(remote)]) == (0, 0)
+
+    def test_second_pass_finds_nothing(self, repos):
+        local, remote = repos
+        package(remote.join('MON'), 'ceph.rpm', 'a' * 100)
+        package(remote.join('OSD'), 'ceph.rpm', 'a' * 100)
+        dedup_trees([str(remote)])
+        assert dedup_trees([str(remote)]) == (0, 0)
+
+
+class TestPublishedTrees(object):
+
+    def test_skips_webapp_content(self, repos):
+        local, remote = repos
+        package(local.join('Tools'), 'tools.rpm', 'x')
+        package(remote.join('MON'), 'ceph.rpm', 'x')
+        package(remote.join('dashboard'), 'index.html', 'x')
+        assert published_trees() == [str(local.join('Tools')), str(remote.join('MON'))]
+
+
+class TestOverwriteDirLinks(object):
+
+    def test_links_already_published_packages(self, repos, tmpdir):
+        local, remote = repos
+        published = package(remote.join('MON'), 'librados2.rpm', 'rados' * 100)
+        source = tmpdir.mkdir('bundle').mkdir('OSD')
+        package(source, 'librados2.rpm', 'rados' * 100)
+        package(source, 'ceph-osd.rpm', 'osd' * 100)
+        overwrite_dir(str(source), destination=str(remote.join('OSD')))
+        assert inode(remote.join('OSD', 'librados2.rpm')) == inode(published)
+        assert remote.join('OSD', 'ceph-osd.rpm').read() == 'osd' * 100
+        assert tree_fingerprint(str(source)) == tree_fingerprint(str(remote.join('OSD')))
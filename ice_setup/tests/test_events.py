@@ -0,0 +1,69 @@
+import json
+import os
+from StringIO import StringIO
+
+import pytest
+
+from ice_setup.ice import EventStream, Recorder, ICEError, run, overwrite_dir
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr('ice_setup.ice.recorder', recorder)
+    output = StringIO()
+    recorder.listeners.append(EventStream(output, interval=60))
+    output.events = lambda: [json.loads(line) for line in output.getvalue().splitlines()]
+    output.recorder = recorder
+    return output
+
+
+class TestEventStream(object):
+
+    def test_command_events(self, stream):
+        run(['true'])
+        start, end = stream.events()
+        assert start['event'] == 'command_start'
+        assert start['cmd'] == 'true'
+        assert end['event'] == 'command_end'
+        assert end['returncode'] == 0
+        assert end['duration'] >= 0
+
+    def test_errors_are_reported(self, stream):
+        with pytest.raises(ValueError):
+            with stream.recorder.span('local-Tools', 'step'):
+                raise ValueError('no space left')
+        end = stream.events()[-1]
+        assert end['event'] == 'step_end'
+        assert end['error'] == 'ValueError: no space left'
+
+    def test_bytes_are_rate_limited(self, stream):
+        with stream.recorder.span('download', 'file') as span:
+            for i in range(10):
+                stream.recorder.transferred(span, 100)
+        events = stream.events()
+        assert [e['event'] for e in events] == ['file_start', 'bytes', 'file_end']
+        assert events[-1]['bytes'] == 1000
+
+    def test_copy_reports_bytes(self, stream, tmpdir):
+        tmpdir.join('source', 'foo.rpm').write('x' * 10, ensure=True)
+        overwrite_dir(str(tmpdir.join('source')), str(tmpdir.join('published')))
+        assert stream.events()[-1]['bytes'] == 10
+
+    def test_open_path(self, tmpdir):
+        path = str(tmpdir.join('events.jsonl'))
+        events = EventStream.open(path)
+        events.emit('run_start', argv=[])
+        events.stream.close()
+        assert json.loads(open(path).read())['event'] == 'run_start'
+
+    def test_open_fd(self, tmpdir):
+        read_fd, write_fd = os.pipe()
+        events = EventStream.open(str(write_fd))
+        events.emit('run_end', status='ok')
+        events.stream.close()
+        assert json.loads(os.fdopen(read_fd).read())['status'] == 'ok'
+
+    def test_open_bad_target(self, tmpdir):
+        with pytest.raises(ICEError):
+            EventStream.open(str(tmpdir.join('missing', 'events.jsonl')))
@@ -0,0 +1,118 @@
+import os
+import tarfile
+import time
+
+import pytest
+
+from ice_setup import ice
+from ice_setup.ice import ExtractionCache, extract_file
+
+
+def make_archive(tmpdir, name, contents):
+    source = tmpdir.mkdir('source-%s' % name)
+    source.join('ceph.rpm').write(contents)
+    archive = str(tmpdir.join('%s.tar.gz' % name))
+    tar = tarfile.open(archive, 'w:gz')
+    tar.add(str(source), arcname='ICE')
+    tar.close()
+    return archive
+
+
+def age(path, seconds):
+    when = time.time() - seconds
+    os.utime(path, (when, when))
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    """archives that were actually extracted"""
+    extracted = []
+    extract_archive = ice.extract_archive
+
+    def counting(file_path, destination):
+        extracted.append(file_path)
+        extract_archive(file_path, destination)
+    monkeypatch.setattr('ice_setup.ice.extract_archive', counting)
+    return extracted
+
+
+class TestExtractionCache(object):
+
+    def test_reuses_extracted_archive(self, tmpdir, extractions):
+        archive = make_archive(tmpdir, 'ice-1.3', 'rpm')
+        first = extract_file(archive)
+        assert extract_file(archive) == first
+        assert open(os.path.join(first, 'ICE', 'ceph.rpm')).read() == 'rpm'
+        assert extractions == [archive]
+
+    def test_keyed_by_contents(self, tmpdir, extractions):
+        archive = make_archive(tmpdir, 'ice-1.3', 'rpm')
+        copy = str(tmpdir.join('copy.tar.gz'))
+        with open(copy, 'wb') as f:
+            f.write(open(archive, 'rb').read())
+        assert extract_file(archive) == extract_file(copy)
+        assert len(extractions) == 1
+
+    def test_lru_over_the_limit(self, tmpdir):
+        cache = ExtractionCache()
+        old = cache.get(make_archive(tmpdir, 'old', 'o' * 1000))
+        age(os.path.join(os.path.dirname(old), '.complete'), 3 * cache.in_use_window)
+        recent = cache.get(make_archive(tmpdir, 'recent', 'r' * 1000))
+        age(os.path.join(os.path.dirname(recent), '.complete'), 2 * cache.in_use_window)
+        removed, freed = cache.gc(max_bytes=1500)
+        assert (removed, freed) == (1, 1000)
+        assert not os.path.exists(old)
+        assert os.path.exists(recent)
+
+    def test_entries_in_use_are_kept(self, tmpdir):
+        cache = ExtractionCache()
+        in_use = cache.get(make_archive(tmpdir, 'in-use', 'u' * 1000))
+        old = cache.get(make_archive(tmpdir, 'old', 'o' * 1000))
+        age(os.path.join(os.path.dirname(old), '.complete'), 2 * cache.in_use_window)
+        # another run collecting the cache while the first one reads it
+        assert ExtractionCache().gc(max_bytes=0) == (1, 1000)
+        assert open(os.path.join(in_use, 'ICE', 'ceph.rpm')).read() == 'u' * 1000
+        assert not os.path.exists(old)
+
+    def test_using_an_entry_makes_it_recent(self, tmpdir):
+        cache = ExtractionCache()
+        first_archive = make_archive(tmpdir, 'first', 'f' * 1000)
+        first = cache.get(first_archive)
+        age(os.path.join(os.path.dirname(first), '.complete'), 3 * cache.in_use_window)
+        second = cache.get(make_archive(tmpdir, 'second', 's' * 1000))
+        age(os.path.join(os.path.dirname(second), '.complete'), 2 * cache.in_use_window)
+        cache.get(first_archive)
+        cache.gc(max_bytes=1500)
+        assert os.path.exists(first)
+        assert not os.path.exists(second)
+
+    def test_removes_old_downloads_and_leftovers(self, tmpdir):
+        cache = ExtractionCache()
+        os.makedirs(cache.download_dir)
+        os.makedirs(cache.path)
+        download = os.path.join(cache.download_dir, 'ice-1.2.tar.gz')
+        with open(download, 'w') as f:
+            f.write('x' * 2000)
+        partial = os.path.join(cache.download_dir, 'ice-1.3.tar.gz.part')
+        open(partial, 'w').close()
+        age(partial, 2 * cache.stale_after)
+        leftover = os.path.join(cache.path, '.extract-abcdef')
+        os.makedirs(leftover)
+        age(leftover, 2 * cache.stale_after)
+        in_progress = os.path.join(cache.path, '.extract-ghijkl')
+        os.makedirs(in_progress)
+        assert cache.gc(max_bytes=1000) == (3, 2000)
+        assert os.listdir(cache.download_dir) == []
+        assert os.listdir(cache.path) == ['.extract-ghijkl']
+
+    def test_failed_extraction_leaves_nothing(self, tmpdir):
+        cache = ExtractionCache()
+        archive = str(tmpdir.join('broken.tar.gz'))
+        tar = tarfile.open(archive, 'w:gz')
+        tar.close()
+        with open(archive, 'r+b') as f:
+            f.seek(20)
+            f.write('garbage')
+        with pytest.raises(Exception):
+            cache.get(archive)
+        assert [name for name in os.listdir(cache.path) if name != 'index.json'] == []
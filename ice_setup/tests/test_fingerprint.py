@@ -0,0 +1,83 @@
+import os
+import shutil
+
+import pytest
+
+from ice_setup.ice import tree_fingerprint, is_up_to_date, repo_file_is_current, Yum, Apt
+
+
+@pytest.fixture
+def source(tmpdir):
+    tmpdir.join('repo', 'sub').ensure(dir=True)
+    tmpdir.join('repo', 'foo.rpm').write('foo')
+    tmpdir.join('repo', 'sub', 'bar.rpm').write('bar')
+    return str(tmpdir.join('repo'))
+
+
+class TestTreeFingerprint(object):
+
+    def test_missing_path(self, tmpdir):
+        assert tree_fingerprint(str(tmpdir.join('missing'))) is None
+
+    def test_copy_matches_source(self, source, tmpdir):
+        destination = str(tmpdir.join('published'))
+        shutil.copytree(source, destination)
+        assert tree_fingerprint(source) == tree_fingerprint(destination)
+
+    def test_new_file_changes_fingerprint(self, source):
+        before = tree_fingerprint(source)
+        with open(os.path.join(source, 'sub', 'baz.rpm'), 'w') as f:
+            f.write('baz')
+        assert tree_fingerprint(source) != before
+
+    def test_size_changes_fingerprint(self, source):
+        before = tree_fingerprint(source)
+        stat = os.stat(os.path.join(source, 'foo.rpm'))
+        with open(os.path.join(source, 'foo.rpm'), 'w') as f:
+            f.write('foo-1.1')
+        os.utime(os.path.join(source, 'foo.rpm'), (stat.st_atime, stat.st_mtime))
+        assert tree_fingerprint(source) != before
+
+    def test_checksum_ignores_mtime(self, source, tmpdir):
+        destination = str(tmpdir.join('published'))
+        shutil.copytree(source, destination)
+        os.utime(os.path.join(destination, 'foo.rpm'), (0, 0))
+        assert tree_fingerprint(source) != tree_fingerprint(destination)
+        assert tree_fingerprint(source, True) == tree_fingerprint(destination, True)
+
+
+class TestIsUpToDate(object):
+
+    def test_missing_destination(self, source, tmpdir):
+        assert is_up_to_date(source, str(tmpdir.join('published'))) is False
+
+    def test_identical_copy(self, source, tmpdir):
+        destination = str(tmpdir.join('published'))
+        shutil.copytree(source, destination)
+        assert is_up_to_date(source, destination) is True
+
+
+class TestRepoFileIsCurrent(object):
+
+    def test_missing_file(self, tmpdir):
+        assert repo_file_is_current(
+            Yum, 'Tools', 'file:///opt/ICE/Tools', 'gpg_url',
+            file_name='Tools', etc_path=str(tmpdir)) is False
+
+    def test_yum_same_contents(self, tmpdir):
+        args = ('Tools', 'file:///opt/ICE/Tools', 'gpg_url')
+        Yum.create_repo_file(*args, file_name='Tools', etc_path=str(tmpdir))
+        assert repo_file_is_current(
+            Yum, *args, file_name='Tools', etc_path=str(tmpdir)) is True
+
+    def test_yum_gpg_change(self, tmpdir):
+        args = ('Tools', 'file:///opt/ICE/Tools', 'gpg_url')
+        Yum.create_repo_file(*args, file_name='Tools', etc_path=str(tmpdir))
+        assert repo_file_is_current(
+            Yum, *args, file_name='Tools', etc_path=str(tmpdir), use_gpg=False) is False
+
+    def test_apt_same_contents(self, tmpdir):
+        args = ('Tools', 'file:///opt/ICE/Tools', 'gpg_url')
+        Apt.create_repo_file(*args, file_name='Tools', etc_path=str(tmpdir), codename='trusty')
+        assert repo_file_is_current(
+            Apt, *args, file_name='Tools', etc_path=str(tmpdir), codename='trusty') is True
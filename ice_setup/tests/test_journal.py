@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from ice_setup.ice import Journal, Step, run_steps
+
+
+@pytest.fixture
+def journal_path(tmpdir):
+    return str(tmpdir.join('state', 'journal.json'))
+
+
+def make_steps(calls, inputs):
+    def func(name):
+        return lambda context: calls.append(name)
+    return [
+        Step('one', func('one'), inputs=lambda c: dict(value=inputs['one'])),
+        Step('prompt', func('prompt')),
+        Step('two', func('two'), inputs=lambda c: dict(value=inputs['two']), requires=['one']),
+    ]
+
+
+class TestJournal(object):
+
+    def test_persists_records(self, journal_path):
+        Journal(path=journal_path).record('one', 'abc')
+        assert Journal(path=journal_path).is_done('one', 'abc') is True
+
+    def test_different_digest_is_not_done(self, journal_path):
+        Journal(path=journal_path).record('one', 'abc')
+        assert Journal(path=journal_path).is_done('one', 'def') is False
+
+    def test_force_is_never_done(self, journal_path):
+        Journal(path=journal_path).record('one', 'abc')
+        assert Journal(path=journal_path, force=True).is_done('one', 'abc') is False
+
+    def test_corrupt_journal_is_empty(self, journal_path):
+        os.makedirs(os.path.dirname(journal_path))
+        with open(journal_path, 'w') as f:
+            f.write('{not json')
+        assert Journal(path=journal_path).steps == {}
+
+
+class TestRunSteps(object):
+
+    def test_runs_everything_the_first_time(self, journal_path):
+        calls = []
+        inputs = dict(one=1, two=2)
+        run_steps(make_steps(calls, inputs), {}, Journal(path=journal_path))
+        assert calls == ['one', 'prompt', 'two']
+
+    def test_skips_completed_steps(self, journal_path):
+        inputs = dict(one=1, two=2)
+        run_steps(make_steps([], inputs), {}, Journal(path=journal_path))
+        calls = []
+        run_steps(make_steps(calls, inputs), {}, Journal(path=journal_path))
+        assert calls == ['prompt']
+
+    def test_resumes_from_first_dirty_step(self, journal_path):
+        inputs = dict(one=1, two=2)
+        run_steps(make_steps([], inputs), {}, Journal(path=journal_path))
+        inputs['two'] = 3
+        calls = []
+        run_steps(make_steps(calls, inputs), {}, Journal(path=journal_path))
+        assert calls == ['prompt', 'two']
+
+    def test_later_steps_rerun_after_dirty_step(self, journal_path):
+        inputs = dict(one=1, two=2)
+        run_steps(make_steps([], inputs), {}, Journal(path=journal_path))
+        inputs['one'] = 3
+        calls = []
+        run_steps(make_steps(calls, inputs), {}, Journal(path=journal_path))
+        assert calls == ['one', 'prompt', 'two']
+
+    def test_force_runs_everything(self, journal_path):
+        inputs = dict(one=1, two=2)
+        run_steps(make_steps([], inputs), {}, Journal(path=journal_path))
+        calls = []
+        run_steps(make_steps(calls, inputs), {}, Journal(path=journal_path, force=True))
+        assert calls == ['one', 'prompt', 'two']
+
+    def test_failed_step_is_not_recorded(self, journal_path):
+        def fail(context):
+            raise RuntimeError('network hiccup')
+        journal = Journal(path=journal_path)
+        steps = [Step('one', fail, inputs=lambda c: dict(value=1))]
+        with pytest.raises(RuntimeError):
+            run_steps(steps, {}, journal)
+        assert Journal(path=journal_path).steps == {}
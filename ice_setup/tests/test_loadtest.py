@@ -0,0 +1,130 @@
+import gzip
+from StringIO import StringIO
+
+import pytest
+
+from ice_setup.ice import ICEError, apt_repo_contents, load_test, yum_repo_contents
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary">
+    <location href="repodata/abc-primary.xml.gz"/>
+  </data>
+  <data type="filelists">
+    <location href="repodata/def-filelists.xml.gz"/>
+  </data>
+  <data type="other">
+    <location href="repodata/ghi-other.xml.gz"/>
+  </data>
+</repomd>
+"""
+
+PRIMARY = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common" packages="2">
+  <package type="rpm">
+    <name>ceph-osd</name>
+    <size package="1000" installed="3000" archive="3100"/>
+    <location href="ceph-osd-0.94-1.el7.x86_64.rpm"/>
+  </package>
+  <package type="rpm">
+    <name>librados2</name>
+    <size package="500" installed="1500" archive="1600"/>
+    <location href="librados2-0.94-1.el7.x86_64.rpm"/>
+  </package>
+</metadata>
+"""
+
+RELEASE = """Codename: trusty
+Components: main
+SHA256:
+ 0123 100 main/binary-amd64/Packages
+ 4567 50 main/binary-amd64/Packages.gz
+"""
+
+PACKAGES = """Package: ceph-osd
+Version: 0.94-1trusty
+Filename: pool/main/c/ceph/ceph-osd_0.94-1trusty_amd64.deb
+Size: 1000
+Description: OSD
+ multi line
+
+Package: librados2
+Filename: pool/main/c/ceph/librados2_0.94-1trusty_amd64.deb
+Size: 500
+"""
+
+
+def gzipped(contents):
+    data = StringIO()
+    f = gzip.GzipFile(fileobj=data, mode='wb')
+    f.write(contents)
+    f.close()
+    return data.getvalue()
+
+
+@pytest.fixture
+def yum_repo(tmpdir, monkeypatch):
+    monkeypatch.setattr('ice_setup.ice.LOCAL_REPO_DIR', str(tmpdir.mkdir('ICE')))
+    monkeypatch.setattr('ice_setup.ice.REMOTE_REPO_DIR', str(tmpdir.mkdir('content')))
+    repo = tmpdir.join('content', 'OSD')
+    repo.join('repodata', 'repomd.xml').write(REPOMD, ensure=True)
+    repo.join('repodata', 'abc-primary.xml.gz').write(gzipped(PRIMARY), 'wb')
+    repo.join('repodata', 'def-filelists.xml.gz').write(gzipped('<filelists/>'), 'wb')
+    repo.join('ceph-osd-0.94-1.el7.x86_64.rpm').write('o' * 1000)
+    repo.join('librados2-0.94-1.el7.x86_64.rpm').write('r' * 500)
+    return repo
+
+
+def fetch_from(files):
+    return lambda path: files[path]
+
+
+class TestRepoContents(object):
+
+    def test_yum(self):
+        metadata, packages = yum_repo_contents(fetch_from({
+            'repodata/repomd.xml': REPOMD,
+            'repodata/abc-primary.xml.gz': gzipped(PRIMARY),
+        }))
+        assert metadata == [
+            'repodata/repomd.xml', 'repodata/abc-primary.xml.gz', 'repodata/def-filelists.xml.gz'
+        ]
+        assert packages == [
+            ('ceph-osd-0.94-1.el7.x86_64.rpm', 1000), ('librados2-0.94-1.el7.x86_64.rpm', 500)
+        ]
+
+    def test_yum_without_primary(self):
+        with pytest.raises(ICEError):
+            yum_repo_contents(fetch_from({'repodata/repomd.xml': '<repomd/>'}))
+
+    def test_apt(self):
+        metadata, packages = apt_repo_contents(fetch_from({
+            'dists/trusty/Release': RELEASE,
+            'dists/trusty/main/binary-amd64/Packages': PACKAGES,
+        }), 'trusty')
+        assert metadata == ['dists/trusty/Release', 'dists/trusty/main/binary-amd64/Packages']
+        assert packages == [
+            ('pool/main/c/ceph/ceph-osd_0.94-1trusty_amd64.deb', 1000),
+            ('pool/main/c/ceph/librados2_0.94-1trusty_amd64.deb', 500),
+        ]
+
+
+class TestLoadTest(object):
+
+    def test_published_repo(self, yum_repo):
+        results = load_test('OSD', clients=5, packages=2, rounds=2, timeout=5, threads=4)
+        assert results['errors'] == 0
+        # 3 metadata files and 2 packages, twice, for every client
+        assert results['requests'] == 5 * 2 * 5
+        assert results['metadata']['requests'] == 5 * 2 * 3
+        assert results['bytes'] >= 5 * 2 * 1500
+        assert results['package']['p50'] <= results['package']['max']
+
+    def test_missing_packages_are_errors(self, yum_repo):
+        yum_repo.join('librados2-0.94-1.el7.x86_64.rpm').remove()
+        results = load_test('OSD', clients=2, packages=2, timeout=5, threads=2)
+        assert results['error_counts'] == {'HTTP 404': 2}
+
+    def test_unknown_repo(self, yum_repo):
+        with pytest.raises(ICEError):
+            load_test('NOPE')
@@ -0,0 +1,124 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from ice_setup import ice
+from ice_setup.ice import FileLock, LockHeld, Store, dedup_trees, repo_lock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOLDER = """
+import sys, time
+sys.path.insert(0, %(root)r)
+from ice_setup import ice
+ice.STATE_DIR = %(state_dir)r
+with ice.FileLock(%(name)r):
+    sys.stdout.write('locked\\n')
+    sys.stdout.flush()
+    sys.stdin.readline()
+"""
+
+
+@pytest.fixture
+def other_run(tmpdir):
+    """a process that holds a lock until the test is done"""
+    processes = []
+
+    def hold(name):
+        process = subprocess.Popen(
+            [sys.executable, '-c', HOLDER % dict(root=ROOT, state_dir=ice.STATE_DIR, name=name)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+        assert process.stdout.readline() == 'locked\n'
+        processes.append(process)
+        return process
+    yield hold
+    for process in processes:
+        process.stdin.close()
+        process.wait()
+
+
+class TestFileLock(object):
+
+    def test_reentrant(self):
+        lock = FileLock('test')
+        with lock:
+            with lock:
+                pass
+            assert lock.local.depth == 1
+        with FileLock('test'):
+            pass
+
+    def test_fails_fast_with_holder(self, other_run):
+        process = other_run('test')
+        with pytest.raises(LockHeld) as exc:
+            FileLock('test', description='the test repo').acquire(wait=False)
+        assert 'the test repo is in use by pid %s' % process.pid in str(exc.value)
+
+    def test_waits_for_other_run(self, other_run):
+        process = other_run('test')
+        threading.Timer(0.3, process.stdin.close).start()
+        start = time.time()
+        with FileLock('test'):
+            assert time.time() - start >= 0.2
+
+    def test_other_threads_wait(self):
+        lock = FileLock('test')
+        held = []
+
+        def hold():
+            with lock:
+                held.append(True)
+                time.sleep(0.3)
+        holder = threading.Thread(target=hold)
+        holder.start()
+        while not held:
+            time.sleep(0.01)
+        with pytest.raises(LockHeld):
+            lock.acquire(wait=False)
+        holder.join()
+        with lock:
+            pass
+
+    def test_shared(self):
+        readers = [FileLock('test', shared=True) for i in range(2)]
+        for reader in readers:
+            reader.acquire(wait=False)
+        with pytest.raises(LockHeld):
+            FileLock('test').acquire(wait=False)
+        for reader in readers:
+            reader.release()
+        with FileLock('test'):
+            pass
+
+
+class TestRepoLocks(object):
+
+    @pytest.fixture
+    def trees(self, tmpdir, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.LOCAL_REPO_DIR', str(tmpdir.mkdir('ICE')))
+        for name in ['MON', 'OSD']:
+            path = tmpdir.join('content', name, 'librados2.rpm')
+            path.write('rados' * 100, ensure=True)
+            os.utime(str(path), (1000000000, 1000000000))
+        return [str(tmpdir.join('content', 'MON')), str(tmpdir.join('content', 'OSD'))]
+
+    def test_same_lock_for_a_repo(self, trees):
+        assert repo_lock(trees[0]) is repo_lock(trees[0] + '/')
+        assert repo_lock(trees[0]) is not repo_lock(trees[1])
+
+    def test_dedup_skips_busy_repos(self, trees, other_run):
+        other_run(repo_lock(trees[1]).name)
+        assert dedup_trees(trees) == (0, 0)
+
+    def test_gc_skipped_while_publishing(self, trees):
+        store = Store()
+        os.makedirs(os.path.dirname(store.blob_path('0' * 64)))
+        open(store.blob_path('0' * 64), 'w').close()
+        with ice.store_publish_lock:
+            assert store.gc() == (0, 0)
+        assert store.gc() == (1, 0)
@@ -0,0 +1,94 @@
+import logging
+import threading
+from StringIO import StringIO
+
+import pytest
+
+from ice_setup.ice import ConsoleHandler, LogWriter, holding_output, logger, run
+
+
+def console(**kw):
+    stream = StringIO()
+    handler = ConsoleHandler(stream, **kw)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.lines = lambda: stream.getvalue().splitlines()
+    return handler
+
+
+@pytest.fixture
+def writer(request, monkeypatch):
+    writer = LogWriter()
+    monkeypatch.setattr('ice_setup.ice.log_writer', writer)
+    level = logger.level
+    logger.setLevel(logging.DEBUG)
+
+    def fin():
+        writer.stop()
+        for handler in writer.handlers:
+            logger.removeHandler(handler)
+        logger.setLevel(level)
+    request.addfinalizer(fin)
+    return writer
+
+
+class TestLogWriter(object):
+
+    def test_records_are_written_in_the_background(self, writer):
+        handler = console()
+        writer.start([handler])
+        logger.info('from %s', 'worker')
+        writer.flush()
+        assert handler.lines() == ['from worker']
+        assert writer.worker is not None
+
+    def test_stop_puts_handlers_back(self, writer):
+        handler = console()
+        writer.start([handler])
+        writer.stop()
+        assert handler in logger.handlers
+        logger.info('after stop')
+        assert handler.lines() == ['after stop']
+
+    def test_handler_levels_are_honored(self, writer):
+        handler = console()
+        handler.setLevel(logging.INFO)
+        writer.start([handler])
+        logger.debug('hidden')
+        logger.info('shown')
+        writer.flush()
+        assert handler.lines() == ['shown']
+
+    def test_holding_output_writes_queued_records_first(self, writer):
+        handler = console()
+        writer.start([handler])
+        logger.info('before the question')
+        with holding_output():
+            assert handler.lines() == ['before the question']
+            background = threading.Thread(target=logger.info, args=('background',))
+            background.start()
+            background.join()
+            writer.flush()
+            assert handler.lines() == ['before the question']
+        assert handler.lines() == ['before the question', 'background']
+
+
+class TestRateLimit(object):
+
+    def test_command_output_is_limited(self, writer):
+        handler = console(output_rate=5, full_log='/var/log/ice.log')
+        writer.start([handler])
+        run(['sh', '-c', 'for i in $(seq 100); do echo line $i; done'])
+        logger.info('done')
+        writer.flush()
+        lines = handler.lines()
+        assert 'line 100' not in lines
+        assert lines[-1] == 'done'
+        assert lines[-2].endswith('lines of command output not shown, see /var/log/ice.log')
+
+    def test_other_records_are_not_limited(self, writer):
+        handler = console(output_rate=1)
+        writer.start([handler])
+        for i in range(10):
+            logger.info('message %s', i)
+        writer.flush()
+        assert len(handler.lines()) == 10
@@ -0,0 +1,65 @@
+from ice_setup.ice import Apt, Yum, configure_ceph_deploy, mirror_base_urls, order_mirrors
+
+MIRRORS = [
+    'http://ice.example.com/static/OSD',
+    'http://ice2.example.com/static/OSD',
+    'http://ice3.example.com/static/OSD',
+]
+
+
+class TestMirrorBaseURLs(object):
+
+    def test_hosts_and_urls(self):
+        mirrors = 'ice2.example.com, ice3.example.com:8181,https://repo.example.com/ceph/'
+        assert mirror_base_urls('http', mirrors) == [
+            'http://ice2.example.com/static',
+            'http://ice3.example.com:8181/static',
+            'https://repo.example.com/ceph',
+        ]
+
+    def test_no_mirrors(self):
+        assert mirror_base_urls('http', None) == []
+        assert mirror_base_urls('http', '') == []
+
+
+class TestOrderMirrors(object):
+
+    def test_same_order_for_a_host(self):
+        assert order_mirrors(MIRRORS, key='node1') == order_mirrors(MIRRORS, key='node1')
+
+    def test_hosts_spread_evenly(self):
+        firsts = {}
+        for number in range(300):
+            first = order_mirrors(MIRRORS, key='node%s.example.com' % number)[0]
+            firsts[first] = firsts.get(first, 0) + 1
+        assert sorted(firsts) == sorted(MIRRORS)
+        assert min(firsts.values()) > 70
+
+    def test_keeps_every_mirror(self):
+        assert sorted(order_mirrors(MIRRORS)) == sorted(MIRRORS)
+        assert sorted(order_mirrors(MIRRORS, key='node1')) == sorted(MIRRORS)
+
+
+class TestRepoFiles(object):
+
+    def test_yum_single_baseurl(self):
+        contents = Yum.repo_file_contents('ceph-osd', MIRRORS, 'gpg_url')
+        assert 'baseurl=%s\n' % ' '.join(MIRRORS) in contents
+
+    def test_apt_source_per_mirror(self):
+        contents = Apt.repo_file_contents('ceph-osd', MIRRORS, 'gpg_url', codename='trusty', hostname='node1')
+        lines = contents.splitlines()
+        assert sorted(lines) == sorted('deb %s trusty main' % url for url in MIRRORS)
+        assert lines[0] == 'deb %s trusty main' % order_mirrors(MIRRORS, key='node1')[0]
+
+    def test_apt_single_url(self):
+        contents = Apt.repo_file_contents('ceph-osd', MIRRORS[0], 'gpg_url', codename='trusty')
+        assert contents == 'deb %s trusty main\n' % MIRRORS[0]
+
+    def test_ceph_deploy_conf(self, tmpdir, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.CWD', str(tmpdir))
+        monkeypatch.setenv('HOME', str(tmpdir))
+        monkeypatch.delenv('SUDO_USER', raising=False)
+        configure_ceph_deploy('ice.example.com', MIRRORS, 'gpg_url', MIRRORS, 'gpg_url')
+        contents = tmpdir.join('cephdeploy.conf').read()
+        assert contents.count('baseurl=%s\n' % ' '.join(MIRRORS)) == 2
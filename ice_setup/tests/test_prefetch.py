@@ -0,0 +1,48 @@
+import os
+
+from ice_setup.ice import MetadataPrefetcher, Apt, Yum
+
+
+class TestMetadataPrefetcher(object):
+
+    def test_wait_for_background_commands(self, tmpdir):
+        marker = str(tmpdir.join('makecache'))
+        prefetcher = MetadataPrefetcher()
+        prefetcher.start(['sh', '-c', 'sleep 0.1; touch %s' % marker])
+        prefetcher.wait()
+        assert os.path.exists(marker)
+
+    def test_commands_run_in_order(self, tmpdir):
+        log = str(tmpdir.join('log'))
+        prefetcher = MetadataPrefetcher()
+        for name in ['one', 'two', 'three']:
+            prefetcher.start(['sh', '-c', 'echo %s >> %s' % (name, log)])
+        prefetcher.wait()
+        assert open(log).read().split() == ['one', 'two', 'three']
+
+    def test_failures_are_not_fatal(self):
+        prefetcher = MetadataPrefetcher()
+        prefetcher.start(['false'])
+        prefetcher.start(['/nonexistent/apt-get'])
+        prefetcher.wait()
+        assert prefetcher.pending == 0
+
+    def test_wait_without_commands(self):
+        MetadataPrefetcher().wait()
+
+
+class TestPrefetchCommands(object):
+
+    def test_yum_enables_only_the_repo(self, monkeypatch):
+        started = []
+        monkeypatch.setattr('ice_setup.ice.metadata_prefetcher.start', started.append)
+        Yum.prefetch('Installer')
+        assert '--disablerepo=*' in started[0]
+        assert '--enablerepo=ceph_deploy' in started[0]
+
+    def test_apt_uses_only_the_repo_list(self, monkeypatch):
+        started = []
+        monkeypatch.setattr('ice_setup.ice.metadata_prefetcher.start', started.append)
+        Apt.prefetch('Calamari')
+        assert 'Dir::Etc::sourcelist=/etc/apt/sources.list.d/Calamari.list' in started[0]
+        assert 'Dir::Etc::sourceparts=-' in started[0]
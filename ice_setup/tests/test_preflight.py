@@ -0,0 +1,96 @@
+import os
+import posix
+
+import pytest
+
+from ice_setup import ice
+from ice_setup.ice import CapacityPlan, InsufficientSpace, preflight, publish_tree
+
+
+@pytest.fixture
+def repos(tmpdir, monkeypatch):
+    monkeypatch.setattr('ice_setup.ice.LOCAL_REPO_DIR', str(tmpdir.mkdir('ICE')))
+    monkeypatch.setattr('ice_setup.ice.REMOTE_REPO_DIR', str(tmpdir.mkdir('content')))
+    source = tmpdir.join('packages', 'OSD')
+    source.join('ceph-osd.rpm').write('o' * 10000, ensure=True)
+    source.join('repodata', 'repomd.xml').write('<repomd/>', ensure=True)
+    return str(source), str(tmpdir.join('content', 'OSD'))
+
+
+def free(monkeypatch, blocks, inodes=1000, block_size=4096):
+    """
+    make every filesystem look like it has ``blocks`` and ``inodes`` free, no
+    inodes meaning that there is no fixed number of them
+    """
+    def statvfs(path):
+        return posix.statvfs_result((
+            block_size, block_size, 1000000, blocks, blocks, inodes and 100000, inodes, inodes, 0, 255
+        ))
+    monkeypatch.setattr('os.statvfs', statvfs)
+
+
+class TestCapacityPlan(object):
+
+    def test_counts_blocks_and_inodes(self, repos, monkeypatch):
+        free(monkeypatch, 1000000)
+        plan = CapacityPlan()
+        plan.add_publish(*repos)
+        filesystem, = plan.filesystems.values()
+        # two files rounded up to whole blocks, and two directories
+        assert filesystem['bytes'] == 3 * 4096 + 4096
+        assert filesystem['inodes'] == 4
+        assert filesystem['sample'] == os.path.join(repos[0], 'ceph-osd.rpm')
+
+    def test_up_to_date_tree_needs_nothing(self, repos):
+        publish_tree(*repos)
+        plan = CapacityPlan()
+        plan.add_publish(*repos)
+        assert all(
+            filesystem['bytes'] == filesystem['inodes'] == 0
+            for filesystem in plan.filesystems.values()
+        )
+
+    def test_only_changed_files_count(self, repos, monkeypatch):
+        publish_tree(*repos)
+        with open(os.path.join(repos[0], 'repodata', 'repomd.xml'), 'w') as f:
+            f.write('<repomd new/>')
+        free(monkeypatch, 1000000)
+        plan = CapacityPlan()
+        plan.add_publish(*repos)
+        filesystem, = plan.filesystems.values()
+        assert filesystem['bytes'] == 4096
+
+    def test_inodes_not_checked_without_a_limit(self, repos, monkeypatch):
+        free(monkeypatch, 1000000, inodes=0)
+        preflight([repos], sample=False)
+
+
+class TestPreflight(object):
+
+    def test_not_enough_space(self, repos, monkeypatch):
+        free(monkeypatch, 10)
+        with pytest.raises(InsufficientSpace) as exc:
+            preflight([repos])
+        assert 'needs' in str(exc.value)
+        assert not os.path.exists(repos[1])
+
+    def test_not_enough_inodes(self, repos, monkeypatch):
+        free(monkeypatch, 1000000, inodes=2)
+        with pytest.raises(InsufficientSpace) as exc:
+            preflight([repos])
+        assert '4 inodes' in str(exc.value)
+
+    def test_enough_space(self, repos, monkeypatch):
+        free(monkeypatch, 1000000)
+        plan = preflight([repos])
+        assert plan.filesystems
+        assert os.listdir(os.path.dirname(repos[1])) == []
+
+    def test_abort_before_configuring(self, repos, tmpdir, monkeypatch):
+        free(monkeypatch, 10)
+        monkeypatch.setattr('ice_setup.ice.sudo_check', lambda: None)
+        monkeypatch.setattr('ice_setup.ice.configure_remote', pytest.fail)
+        for name in ['ceph-osd', 'ceph-mon']:
+            tmpdir.join('packages', name, 'ceph.rpm').write('c' * 10000, ensure=True)
+        with pytest.raises(InsufficientSpace):
+            ice.Configure(['configure', 'remote', str(tmpdir.join('packages'))]).parse_args()
@@ -0,0 +1,143 @@
+import logging
+import os
+import shutil
+import tarfile
+import threading
+from StringIO import StringIO
+
+import pytest
+
+from ice_setup.ice import (
+    ConsoleHandler, Progress, copy_tree, extract_file, format_bytes,
+    format_duration, logger, run, run_call
+)
+
+
+class TTY(StringIO):
+
+    def isatty(self):
+        return True
+
+
+@pytest.fixture
+def console(request):
+    handler = ConsoleHandler(TTY())
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    request.addfinalizer(lambda: logger.removeHandler(handler))
+    return handler
+
+
+@pytest.fixture
+def records(request):
+    stream = StringIO()
+    handler = logging.StreamHandler(stream)
+    level = logger.level
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+    def fin():
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+    request.addfinalizer(fin)
+    return lambda: stream.getvalue().splitlines()
+
+
+class TestFormatting(object):
+
+    def test_bytes(self):
+        assert format_bytes(512) == '512 B'
+        assert format_bytes(1536) == '1.5 KB'
+        assert format_bytes(3 * 1024 ** 3) == '3.0 GB'
+
+    def test_duration(self):
+        assert format_duration(3725) == '1:02:05'
+
+
+class TestProgress(object):
+
+    def test_status_with_totals(self):
+        progress = Progress('copying MON', total_bytes=4096, total_files=4)
+        progress.started -= 2
+        progress.update(1024, files=1)
+        status = progress.status()
+        assert status.startswith('copying MON: 1.0 KB/4.0 KB (25%), 1/4 files, ')
+        assert 'ETA 0:00:0' in status
+
+    def test_status_without_totals(self):
+        progress = Progress('syncing ceph-mon')
+        progress.update(files=3)
+        assert progress.status() == 'syncing ceph-mon: 3 files, elapsed 0:00:00'
+
+    def test_logs_periodically_when_not_a_tty(self, records):
+        progress = Progress('copying OSD', total_bytes=10, interval=0)
+        progress.update(5)
+        assert len(records()) == 1
+        assert records()[0].startswith('copying OSD: 5 B/10 B (50%)')
+
+    def test_updates_a_status_line_on_a_tty(self, console):
+        with Progress('copying OSD', total_bytes=10, interval=0) as progress:
+            progress.update(5)
+            assert console.stream.getvalue().startswith('copying OSD: 5 B/10 B (50%)')
+            logger.warning('a record')
+        output = console.stream.getvalue()
+        # the status line is cleared before the record and drawn again after it
+        assert '\r\033[Ka record\ncopying OSD: 5 B/10 B' in output
+        assert output.endswith('\r\033[K')
+
+    def test_status_line_is_hidden_while_holding(self, console):
+        console.hold()
+        worker = threading.Thread(target=console.status, args=('copy', 'copying'))
+        worker.start()
+        worker.join()
+        assert console.stream.getvalue() == ''
+        console.unhold()
+        assert console.stream.getvalue() == 'copying'
+
+
+class TestCopyTree(object):
+
+    def test_copies_contents_and_times(self, tmpdir):
+        source = tmpdir.mkdir('source')
+        source.mkdir('repodata').join('repomd.xml').write('<repomd/>')
+        source.join('ceph.rpm').write('x' * 3000)
+        os.utime(str(source.join('ceph.rpm')), (1000000000, 1000000000))
+        destination = tmpdir.join('destination')
+        copy_tree(str(source), str(destination))
+        assert destination.join('repodata', 'repomd.xml').read() == '<repomd/>'
+        assert destination.join('ceph.rpm').read() == 'x' * 3000
+        assert os.path.getmtime(str(destination.join('ceph.rpm'))) == 1000000000
+
+
+class TestExtractFile(object):
+
+    def test_extracts_as_a_stream(self, tmpdir):
+        tmpdir.mkdir('repo').join('ceph.rpm').write('rpm')
+        archive = str(tmpdir.join('repo.tar.gz'))
+        tar = tarfile.open(archive, 'w:gz')
+        tar.add(str(tmpdir.join('repo')), arcname='ICE')
+        tar.close()
+        destination = extract_file(archive)
+        try:
+            assert open(os.path.join(destination, 'ICE', 'ceph.rpm')).read() == 'rpm'
+        finally:
+            shutil.rmtree(os.path.dirname(destination))
+
+
+class TestRun(object):
+
+    def test_output_is_followed(self):
+        lines = []
+        run(['sh', '-c', 'echo one; echo two'], on_output=lines.append)
+        assert lines == ['one', 'two']
+
+    def test_does_not_block_on_a_full_pipe(self):
+        # more output than a pipe holds on either stream
+        run(['sh', '-c', 'head -c 200000 /dev/zero; head -c 200000 /dev/zero >&2'])
+
+    def test_run_call_does_not_block_on_a_full_pipe(self):
+        stdout, stderr, returncode = run_call(
+            ['sh', '-c', 'head -c 200000 /dev/zero | tr "\\0" "x" >&2; echo done']
+        )
+        assert stdout == ['done']
+        assert len(stderr[0]) == 200000
@@ -0,0 +1,110 @@
+import os
+import struct
+
+import pytest
+
+from ice_setup.ice import (
+    UpdateRepo, parse_rpm_file_name, prune_packages, read_rpm_epoch, rpmvercmp
+)
+
+
+def rpm_with_epoch(path, epoch=None):
+    """a package whose header has nothing but its epoch"""
+    entries = data = ''
+    if epoch is not None:
+        entries = struct.pack('>IIII', 1003, 4, 0, 1)
+        data = struct.pack('>I', epoch)
+    header = '\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('>II', len(entries) // 16, len(data))
+    signature = '\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('>II', 0, 0)
+    path.write('\xed\xab\xee\xdb' + '\0' * 92 + signature + header + entries + data, 'wb')
+
+
+class TestRpmvercmp(object):
+
+    @pytest.mark.parametrize('one, two, result', [
+        ('1.0', '1.0', 0),
+        ('1.0', '2.0', -1),
+        ('2.0.1', '2.0', 1),
+        ('1.10', '1.9', 1),
+        ('1.010', '1.10', 0),
+        ('1.0a', '1.0', 1),
+        ('1a', '1.1', -1),
+        ('1.0.a', '1.0.1', -1),
+        ('1.0~rc1', '1.0', -1),
+        ('1.0~rc1', '1.0~rc2', -1),
+        ('1.0^git1', '1.0', 1),
+        ('1.0^git1', '1.0.1', -1),
+        ('1_0', '1.0', 0),
+        ('0.94.1', '0.94.1-2', -1),
+    ])
+    def test_compare(self, one, two, result):
+        assert rpmvercmp(one, two) == result
+        assert rpmvercmp(two, one) == -result
+
+
+class TestParseRpmFileName(object):
+
+    def test_nevra(self):
+        assert parse_rpm_file_name('ceph-common-0.94.1-13.el7cp.x86_64.rpm') == (
+            'ceph-common', '0', '0.94.1', '13.el7cp', 'x86_64'
+        )
+
+    def test_not_an_rpm(self):
+        assert parse_rpm_file_name('repomd.xml') is None
+        assert parse_rpm_file_name('ceph.rpm') is None
+
+
+class TestReadRpmEpoch(object):
+
+    def test_epoch(self, tmpdir):
+        path = tmpdir.join('ceph.rpm')
+        rpm_with_epoch(path, 2)
+        assert read_rpm_epoch(str(path)) == '2'
+
+    def test_no_epoch(self, tmpdir):
+        path = tmpdir.join('ceph.rpm')
+        rpm_with_epoch(path)
+        assert read_rpm_epoch(str(path)) == '0'
+
+    def test_not_a_package(self, tmpdir):
+        path = tmpdir.join('ceph.rpm')
+        path.write('rpm')
+        assert read_rpm_epoch(str(path)) is None
+
+
+class TestPrunePackages(object):
+
+    def test_keeps_newest_versions(self, tmpdir):
+        for name in [
+            'ceph-0.94.1-13.el7cp.x86_64.rpm',
+            'ceph-0.94.10-1.el7cp.x86_64.rpm',
+            'ceph-0.94.9-1.el7cp.x86_64.rpm',
+            'ceph-0.94.9-1.el7cp.src.rpm',
+            'librados2-0.94.1-13.el7cp.x86_64.rpm',
+        ]:
+            tmpdir.join(name).write('rpm')
+        tmpdir.mkdir('repodata').join('repomd.xml').write('xml')
+        removed, kept = prune_packages(str(tmpdir), 2)
+        assert [os.path.basename(path) for path, size in removed] == [
+            'ceph-0.94.1-13.el7cp.x86_64.rpm'
+        ]
+        assert kept == 4
+        assert tmpdir.join('repodata', 'repomd.xml').check()
+
+    def test_epoch_wins_over_version(self, tmpdir):
+        rpm_with_epoch(tmpdir.join('ceph-0.94.1-1.el7cp.x86_64.rpm'), 1)
+        rpm_with_epoch(tmpdir.join('ceph-10.2.0-1.el7cp.x86_64.rpm'))
+        removed, kept = prune_packages(str(tmpdir), 1)
+        assert [os.path.basename(path) for path, size in removed] == [
+            'ceph-10.2.0-1.el7cp.x86_64.rpm'
+        ]
+
+
+class TestUpdateRepoKeep(object):
+
+    def test_keep_is_not_a_repo_name(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr('ice_setup.ice.sudo_check', lambda: None)
+        monkeypatch.setattr('ice_setup.ice.update_repo', lambda repos, keep: calls.append((repos, keep)))
+        UpdateRepo(['update', 'ceph-osd', '--keep', '3']).parse_args()
+        assert calls == [(['ceph-osd'], 3)]
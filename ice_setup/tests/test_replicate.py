@@ -0,0 +1,116 @@
+import os
+import stat
+
+import pytest
+
+from ice_setup.ice import (
+    InvalidRepoName, LocalTarget, SSHTarget, replica_target, replicate, split_streams,
+    tree_manifest,
+)
+
+
+@pytest.fixture
+def repos(tmpdir, monkeypatch):
+    monkeypatch.setattr('ice_setup.ice.LOCAL_REPO_DIR', str(tmpdir.mkdir('ICE')))
+    monkeypatch.setattr('ice_setup.ice.REMOTE_REPO_DIR', str(tmpdir.mkdir('content')))
+    content = tmpdir.join('content')
+    content.join('OSD', 'ceph-osd.rpm').write('osd' * 1000, ensure=True)
+    content.join('OSD', 'librados2.rpm').write('rados' * 100)
+    content.join('OSD', 'repodata', 'repomd.xml').write('<repomd/>', ensure=True)
+    content.join('MON', 'ceph-mon.rpm').write('mon' * 1000, ensure=True)
+    content.join('dashboard', 'index.html').write('<html/>', ensure=True)
+    return content
+
+
+@pytest.fixture
+def fake_ssh(tmpdir):
+    """runs the remote script locally, ignoring the host"""
+    path = tmpdir.join('fake-ssh')
+    path.write('#!/bin/sh\nshift\nexec sh -c "$1"\n')
+    os.chmod(str(path), os.stat(str(path)).st_mode | stat.S_IXUSR)
+    return str(path)
+
+
+def replica_manifest(path):
+    return tree_manifest(str(path))
+
+
+class TestReplicate(object):
+
+    def test_copies_repos(self, repos, tmpdir):
+        replica = tmpdir.join('replica')
+        assert replicate(LocalTarget(str(replica))) == (4, 3000 + 500 + 9 + 3000, 0)
+        assert replica_manifest(replica.join('OSD')) == tree_manifest(str(repos.join('OSD')))
+        assert replica.join('MON', 'ceph-mon.rpm').read() == 'mon' * 1000
+        assert not replica.join('dashboard').check()
+
+    def test_second_run_transfers_nothing(self, repos, tmpdir):
+        target = LocalTarget(str(tmpdir.join('replica')))
+        replicate(target)
+        assert replicate(target) == (0, 0, 0)
+
+    def test_changed_and_removed_files(self, repos, tmpdir):
+        replica = tmpdir.join('replica')
+        target = LocalTarget(str(replica))
+        replicate(target)
+        repos.join('OSD', 'librados2.rpm').remove()
+        repos.join('OSD', 'repodata', 'repomd.xml').write('<repomd new/>')
+        assert replicate(target) == (1, len('<repomd new/>'), 1)
+        assert replica_manifest(replica.join('OSD')) == tree_manifest(str(repos.join('OSD')))
+
+    def test_rescan_finds_drift(self, repos, tmpdir):
+        replica = tmpdir.join('replica')
+        target = LocalTarget(str(replica))
+        replicate(target)
+        replica.join('OSD', 'ceph-osd.rpm').write('broken')
+        assert replicate(target) == (0, 0, 0)
+        assert replicate(target, rescan=True) == (1, 3000, 0)
+        assert replica.join('OSD', 'ceph-osd.rpm').read() == 'osd' * 1000
+
+    def test_selected_repos(self, repos, tmpdir):
+        replica = tmpdir.join('replica')
+        replicate(LocalTarget(str(replica)), names=['MON'])
+        assert replica.join('MON').check()
+        assert not replica.join('OSD').check()
+
+    def test_unknown_repo(self, repos, tmpdir):
+        with pytest.raises(InvalidRepoName):
+            replicate(LocalTarget(str(tmpdir.join('replica'))), names=['dashboard'])
+
+    def test_over_ssh(self, repos, tmpdir, fake_ssh):
+        replica = tmpdir.join('replica')
+        target = SSHTarget('ice2.example.com', str(replica), ssh=fake_ssh)
+        replicate(target, streams=2)
+        assert replica_manifest(replica.join('OSD')) == tree_manifest(str(repos.join('OSD')))
+        assert not replica.join('.ice_incoming', 'OSD').listdir()
+
+        repos.join('OSD', 'librados2.rpm').remove()
+        assert replicate(target) == (0, 0, 1)
+        replica.join('MON', 'ceph-mon.rpm').write('broken')
+        assert replicate(target, rescan=True) == (1, 3000, 0)
+        assert replica_manifest(replica.join('MON')) == tree_manifest(str(repos.join('MON')))
+
+
+class TestReplicaTarget(object):
+
+    def test_local(self, tmpdir):
+        target = replica_target(str(tmpdir))
+        assert isinstance(target, LocalTarget)
+        assert target.root == str(tmpdir)
+
+    def test_ssh(self):
+        target = replica_target('root@ice2:/opt/calamari/webapp/content/', ssh='ssh -p 2222')
+        assert isinstance(target, SSHTarget)
+        assert (target.host, target.root) == ('root@ice2', '/opt/calamari/webapp/content')
+        assert target.command('true') == ['ssh', '-p', '2222', 'root@ice2', 'true']
+
+
+class TestSplitStreams(object):
+
+    def test_balances_sizes(self):
+        sizes = {'a': 100, 'b': 60, 'c': 50, 'd': 10}
+        batches = split_streams(list(sizes), sizes, 2)
+        assert sorted(sum(sizes[p] for p in batch) for batch in batches) == [110, 110]
+
+    def test_no_more_streams_than_files(self):
+        assert split_streams(['a'], {'a': 1}, 4) == [['a']]
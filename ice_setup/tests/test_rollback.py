@@ -0,0 +1,136 @@
+import os
+import stat
+
+import pytest
+
+from ice_setup.ice import (
+    Generations, GenerationNotFound, InvalidRepoName, Yum, publish_tree, rollback
+)
+
+
+@pytest.fixture
+def repos(tmpdir, monkeypatch):
+    monkeypatch.setattr('ice_setup.ice.LOCAL_REPO_DIR', str(tmpdir.mkdir('ICE')))
+    monkeypatch.setattr('ice_setup.ice.REMOTE_REPO_DIR', str(tmpdir.mkdir('content')))
+    monkeypatch.setattr('ice_setup.ice.STATE_DIR', str(tmpdir.join('state')))
+    return tmpdir
+
+
+def publish(repos, version):
+    source = repos.join('bundle-%s' % version, 'OSD')
+    source.join('ceph-osd-%s.rpm' % version).write(version, ensure=True)
+    destination = str(repos.join('content', 'OSD'))
+    publish_tree(str(source), destination)
+    return destination
+
+
+def served(destination):
+    return sorted(os.listdir(destination))
+
+
+class TestGenerations(object):
+
+    def test_publishing_switches_the_symlink(self, repos):
+        destination = publish(repos, '1')
+        publish(repos, '2')
+        assert os.path.islink(destination)
+        assert Generations(destination).current() == 2
+        assert served(destination) == ['ceph-osd-2.rpm']
+
+    def test_old_generations_are_pruned(self, repos):
+        for version in range(1, 7):
+            destination = publish(repos, str(version))
+        assert Generations(destination).numbers() == [3, 4, 5, 6]
+
+    def test_adopts_a_plain_directory(self, repos):
+        destination = repos.join('content', 'OSD')
+        destination.join('legacy.rpm').write('legacy', ensure=True)
+        publish(repos, '2')
+        rollback('OSD')
+        assert served(str(destination)) == ['legacy.rpm']
+
+    def test_failed_generation_is_discarded(self, repos):
+        destination = publish(repos, '1')
+        with pytest.raises(RuntimeError):
+            with Generations(destination).new(from_current=True) as target:
+                assert os.listdir(target) == ['ceph-osd-1.rpm']
+                raise RuntimeError('reposync failed')
+        assert Generations(destination).numbers() == [1]
+        assert served(destination) == ['ceph-osd-1.rpm']
+
+
+class FakeRelease(object):
+    major = '7'
+
+
+class FakeDistro(object):
+    normalized_release = FakeRelease()
+
+
+@pytest.fixture
+def sync_tools(repos, monkeypatch):
+    """
+    reposync resumes the download of ceph-osd-1.rpm by appending to it, the
+    way it does when the local file is shorter than the one in the repo
+    """
+    bin_dir = repos.mkdir('bin')
+    scripts = {
+        'reposync': 'for target; do :; done\necho resumed >> "$target/ceph-osd-1.rpm"\n',
+        'repoquery': 'echo "8 ceph-osd-1.rpm"\n',
+        'createrepo': 'mkdir -p "$1/repodata"\n',
+        'yum': '',
+    }
+    for name, script in scripts.items():
+        path = bin_dir.join(name)
+        path.write('#!/bin/sh\n' + script)
+        os.chmod(str(path), os.stat(str(path)).st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+    return repos
+
+
+class TestSync(object):
+
+    def sync(self, repos):
+        destination = publish(repos, '1')
+        Yum.sync(['ceph-osd'], FakeDistro())
+        return destination
+
+    def test_changed_package_is_downloaded_again(self, sync_tools):
+        destination = self.sync(sync_tools)
+        assert open(os.path.join(destination, 'ceph-osd-1.rpm')).read() == 'resumed\n'
+        previous = Generations(destination).generation_path(1)
+        assert open(os.path.join(previous, 'ceph-osd-1.rpm')).read() == '1'
+
+    def test_without_sizes_packages_are_copied(self, sync_tools, monkeypatch):
+        monkeypatch.setattr(Yum, 'package_sizes', classmethod(lambda cls, repo_ids: None))
+        destination = self.sync(sync_tools)
+        assert open(os.path.join(destination, 'ceph-osd-1.rpm')).read() == '1resumed\n'
+        previous = Generations(destination).generation_path(1)
+        assert open(os.path.join(previous, 'ceph-osd-1.rpm')).read() == '1'
+
+
+class TestRollback(object):
+
+    def test_rolls_back_to_previous_generation(self, repos):
+        destination = publish(repos, '1')
+        publish(repos, '2')
+        rollback('OSD')
+        assert served(destination) == ['ceph-osd-1.rpm']
+
+    def test_rolls_forward_to_a_given_generation(self, repos):
+        destination = publish(repos, '1')
+        publish(repos, '2')
+        rollback('OSD')
+        rollback('OSD', 2)
+        assert served(destination) == ['ceph-osd-2.rpm']
+
+    def test_missing_generation(self, repos):
+        publish(repos, '1')
+        with pytest.raises(GenerationNotFound) as error:
+            rollback('OSD', 7)
+        assert 'available generations: 1' in str(error.value)
+
+    def test_unknown_repo(self, repos):
+        publish(repos, '1')
+        with pytest.raises(InvalidRepoName):
+            rollback('MON')
@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from ice_setup import ice
+from ice_setup.ice import (
+    Journal, Step, Scheduler, ICEError, ConsoleHandler, holding_output, logger
+)
+
+
+@pytest.fixture
+def journal(tmpdir):
+    return Journal(path=str(tmpdir.join('journal.json')))
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.calls = []
+
+    def step(self, name, delay=0.05):
+        def func(context):
+            with self.lock:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+            time.sleep(delay)
+            with self.lock:
+                self.active -= 1
+                self.calls.append(name)
+        return func
+
+
+class TestScheduler(object):
+
+    def test_undeclared_requirement(self, journal):
+        steps = [Step('two', lambda c: None, requires=['one'])]
+        with pytest.raises(ICEError):
+            Scheduler(steps, journal)
+
+    def test_independent_steps_overlap(self, journal):
+        recorder = Recorder()
+        steps = [Step(n, recorder.step(n)) for n in ['a', 'b', 'c']]
+        Scheduler(steps, journal, jobs=3).run({})
+        assert recorder.peak == 3
+        assert sorted(recorder.calls) == ['a', 'b', 'c']
+
+    def test_concurrency_limit(self, journal):
+        recorder = Recorder()
+        steps = [Step(n, recorder.step(n)) for n in ['a', 'b', 'c', 'd']]
+        Scheduler(steps, journal, jobs=2).run({})
+        assert recorder.peak == 2
+
+    def test_requirements_run_first(self, journal):
+        recorder = Recorder()
+        steps = [
+            Step('a', recorder.step('a', 0.1)),
+            Step('b', recorder.step('b', 0)),
+            Step('c', recorder.step('c', 0), requires=['a', 'b']),
+        ]
+        Scheduler(steps, journal, jobs=3).run({})
+        assert recorder.calls[-1] == 'c'
+
+    def test_context_is_shared(self, journal):
+        def produce(context):
+            context['fqdn'] = 'ice.example.com'
+        seen = []
+        steps = [
+            Step('produce', produce),
+            Step('consume', lambda c: seen.append(c['fqdn']),
+                 inputs=lambda c: dict(fqdn=c['fqdn']), requires=['produce']),
+        ]
+        Scheduler(steps, journal, jobs=2).run({})
+        assert seen == ['ice.example.com']
+
+    def test_failure_stops_dependents(self, journal):
+        recorder = Recorder()
+
+        def fail(context):
+            raise RuntimeError('network hiccup')
+        steps = [
+            Step('a', fail),
+            Step('b', recorder.step('b'), requires=['a']),
+        ]
+        with pytest.raises(RuntimeError):
+            Scheduler(steps, journal, jobs=2).run({})
+        assert recorder.calls == []
+
+    def test_clean_branch_is_skipped(self, journal):
+        inputs = dict(a=1, b=1)
+        recorder = Recorder()
+
+        def steps():
+            return [
+                Step('a', recorder.step('a', 0), inputs=lambda c: dict(v=inputs['a'])),
+                Step('b', recorder.step('b', 0), inputs=lambda c: dict(v=inputs['b'])),
+                Step('after-a', recorder.step('after-a', 0), inputs=lambda c: dict(),
+                     requires=['a']),
+            ]
+        Scheduler(steps(), journal, jobs=2).run({})
+        recorder.calls = []
+        inputs['a'] = 2
+        Scheduler(steps(), journal, jobs=2).run({})
+        assert sorted(recorder.calls) == ['a', 'after-a']
+
+
+class TestHoldingOutput(object):
+
+    def test_other_threads_wait_for_the_prompt(self, tmpdir):
+        stream = tmpdir.join('console').open('w')
+        handler = ConsoleHandler(stream)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        try:
+            with holding_output():
+                background = threading.Thread(target=logger.warning, args=('background',))
+                background.start()
+                background.join()
+                logger.warning('prompting')
+            logger.warning('done')
+        finally:
+            logger.removeHandler(handler)
+            stream.close()
+        lines = tmpdir.join('console').read().splitlines()
+        assert lines == ['prompting', 'background', 'done']
+
+
+class TestDefaultSteps(object):
+
+    def test_gpg_checking_is_an_input_of_every_repo(self, tmpdir):
+        context = dict(package_path=str(tmpdir), use_gpg=True)
+        repos = [step for step in ice.default_steps() if step.name.startswith(('local-', 'remote-'))]
+        assert len(repos) == 5
+        for step in repos:
+            assert step.fingerprint(context) != step.fingerprint(dict(context, use_gpg=False))
@@ -0,0 +1,105 @@
+import httplib
+import os
+import threading
+
+import pytest
+
+from ice_setup.ice import RepoServer, repo_base_url
+
+
+@pytest.fixture
+def server(tmpdir):
+    root = tmpdir.mkdir('content')
+    root.join('OSD', 'ceph.rpm').write('0123456789' * 10, ensure=True)
+    os.utime(str(root.join('OSD', 'ceph.rpm')), (1000000000, 1000000000))
+    root.join('OSD', '.hidden').write('secret')
+    tmpdir.join('outside').write('secret')
+    server = RepoServer(('127.0.0.1', 0), str(root), threads=4)
+    worker = threading.Thread(target=server.serve_forever)
+    worker.daemon = True
+    worker.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, path, method='GET', headers=None):
+    connection = httplib.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+    connection.request(method, path, headers=headers or {})
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+
+class TestRepoServer(object):
+
+    def test_serves_file(self, server):
+        response, body = request(server, '/static/OSD/ceph.rpm')
+        assert response.status == 200
+        assert body == '0123456789' * 10
+        assert response.getheader('Content-Length') == '100'
+        assert response.getheader('Accept-Ranges') == 'bytes'
+
+    def test_head_has_no_body(self, server):
+        response, body = request(server, '/static/OSD/ceph.rpm', method='HEAD')
+        assert response.status == 200
+        assert body == ''
+
+    def test_range(self, server):
+        response, body = request(server, '/static/OSD/ceph.rpm', headers={'Range': 'bytes=10-19'})
+        assert response.status == 206
+        assert body == '0123456789'
+        assert response.getheader('Content-Range') == 'bytes 10-19/100'
+
+    def test_suffix_range(self, server):
+        response, body = request(server, '/static/OSD/ceph.rpm', headers={'Range': 'bytes=-5'})
+        assert response.status == 206
+        assert body == '56789'
+
+    def test_unsatisfiable_range(self, server):
+        response, body = request(server, '/static/OSD/ceph.rpm', headers={'Range': 'bytes=200-'})
+        assert response.status == 416
+
+    def test_etag_not_modified(self, server):
+        response, body = request(server, '/static/OSD/ceph.rpm')
+        etag = response.getheader('ETag')
+        response, body = request(server, '/static/OSD/ceph.rpm', headers={'If-None-Match': etag})
+        assert response.status == 304
+        assert body == ''
+
+    def test_if_modified_since(self, server):
+        response, body = request(server, '/static/OSD/ceph.rpm')
+        last_modified = response.getheader('Last-Modified')
+        response, body = request(
+            server, '/static/OSD/ceph.rpm', headers={'If-Modified-Since': last_modified}
+        )
+        assert response.status == 304
+
+    def test_keep_alive(self, server):
+        connection = httplib.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+        for i in range(3):
+            connection.request('GET', '/static/OSD/ceph.rpm')
+            assert connection.getresponse().read() == '0123456789' * 10
+        connection.close()
+
+    @pytest.mark.parametrize('path', [
+        '/static/../outside',
+        '/static/OSD/../../outside',
+        '/static/%2e%2e/outside',
+        '/static/OSD/.hidden',
+        '/static/OSD',
+        '/OSD/ceph.rpm',
+    ])
+    def test_not_served(self, server, path):
+        response, body = request(server, path)
+        assert response.status == 404
+
+
+class TestRepoBaseURL(object):
+
+    def test_web_server(self):
+        assert repo_base_url('http', 'ice.example.com') == 'http://ice.example.com/static'
+
+    def test_port(self):
+        assert repo_base_url('http', 'ice.example.com', '8181') == 'http://ice.example.com:8181/static'
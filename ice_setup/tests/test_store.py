@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+import pytest
+
+from ice_setup.ice import Store, is_up_to_date, publish_tree
+
+
+@pytest.fixture
+def repos(tmpdir, monkeypatch):
+    monkeypatch.setattr('ice_setup.ice.LOCAL_REPO_DIR', str(tmpdir.mkdir('ICE')))
+    monkeypatch.setattr('ice_setup.ice.REMOTE_REPO_DIR', str(tmpdir.mkdir('content')))
+    monkeypatch.setattr('ice_setup.ice.STATE_DIR', str(tmpdir.join('state')))
+    return tmpdir
+
+
+def bundle(tmpdir, version, packages, mtime=1000000000):
+    source = tmpdir.join('bundle-%s' % version, 'MON')
+    for name, contents in packages.items():
+        path = source.join(name)
+        path.write(contents, ensure=True)
+        os.utime(str(path), (mtime, mtime))
+    return str(source)
+
+
+def store_size(store):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(store.path):
+        size += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+    return size
+
+
+class TestPublishTree(object):
+
+    def test_tree_links_to_blobs(self, repos):
+        source = bundle(repos, '0.80', {'ceph.rpm': 'ceph 0.80'})
+        destination = repos.join('content', 'ceph0.80')
+        publish_tree(source, str(destination))
+        blob = Store().blob_path(hashlib.sha256('ceph 0.80').hexdigest())
+        assert destination.join('ceph.rpm').read() == 'ceph 0.80'
+        assert os.stat(blob).st_ino == os.stat(str(destination.join('ceph.rpm'))).st_ino
+
+    def test_new_version_only_stores_new_packages(self, repos):
+        shared = 'x' * 1000
+        publish_tree(
+            bundle(repos, '0.80', {'librados2.rpm': shared, 'ceph.rpm': 'ceph 0.80'}),
+            str(repos.join('content', 'ceph0.80')),
+        )
+        before = store_size(Store())
+        publish_tree(
+            bundle(repos, '0.94', {'librados2.rpm': shared, 'ceph.rpm': 'ceph 0.94'}),
+            str(repos.join('content', 'ceph0.94')),
+        )
+        assert store_size(Store()) - before == len('ceph 0.94')
+
+    def test_republished_tree_is_up_to_date(self, repos):
+        shared = {'librados2.rpm': 'x' * 1000}
+        publish_tree(bundle(repos, '0.80', shared), str(repos.join('content', 'ceph0.80')))
+        # same contents with a different time, linked to the blob of 0.80
+        source = bundle(repos, '0.94', shared, mtime=1100000000)
+        destination = str(repos.join('content', 'ceph0.94'))
+        assert is_up_to_date(source, destination) is False
+        publish_tree(source, destination)
+        assert is_up_to_date(source, destination) is True
+
+    def test_replaces_existing_tree(self, repos):
+        destination = str(repos.join('content', 'MON'))
+        publish_tree(bundle(repos, '0.80', {'ceph.rpm': 'old'}), destination)
+        publish_tree(bundle(repos, '0.94', {'ceph-mon.rpm': 'new'}), destination)
+        assert os.listdir(destination) == ['ceph-mon.rpm']
+
+
+class TestGC(object):
+
+    def test_removes_unused_blobs(self, repos, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.Generations.keep', 0)
+        destination = str(repos.join('content', 'MON'))
+        publish_tree(bundle(repos, '0.80', {'ceph.rpm': 'old'}), destination)
+        publish_tree(bundle(repos, '0.94', {'ceph.rpm': 'new'}), destination)
+        assert Store().gc() == (1, 3)
+        assert not os.path.exists(Store().blob_path(hashlib.sha256('old').hexdigest()))
+        assert os.path.exists(Store().blob_path(hashlib.sha256('new').hexdigest()))
+
+    def test_previous_generations_keep_their_blobs(self, repos):
+        destination = str(repos.join('content', 'MON'))
+        publish_tree(bundle(repos, '0.80', {'ceph.rpm': 'old'}), destination)
+        publish_tree(bundle(repos, '0.94', {'ceph.rpm': 'new'}), destination)
+        assert Store().gc() == (0, 0)
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+
+import pytest
+
+from ice_setup import ice
+from ice_setup.ice import ICEError, Throttle, parse_ionice, parse_rate, run_call
+
+
+class TestParseRate(object):
+
+    def test_units(self):
+        assert parse_rate('512') == 512
+        assert parse_rate('512K') == 512 * 1024
+        assert parse_rate('20MB/s') == 20 * 1024 * 1024
+        assert parse_rate('1.5g') == int(1.5 * 1024 ** 3)
+
+    def test_no_limit(self):
+        for value in ['', '0', 'off', 'off\n']:
+            assert parse_rate(value) is None
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            parse_rate('fast')
+
+
+class TestThrottle(object):
+
+    def test_unlimited_by_default(self):
+        throttle = Throttle()
+        start = time.time()
+        throttle.consume(1024 ** 3)
+        throttle.consume(1024 ** 3)
+        assert time.time() - start < 0.1
+
+    def test_limits_rate(self):
+        throttle = Throttle()
+        throttle.configure(rate='100K')
+        start = time.time()
+        for i in range(6):
+            throttle.consume(10 * 1024)
+        assert 0.5 <= time.time() - start < 1
+
+    def test_shared_by_threads(self):
+        throttle = Throttle()
+        throttle.configure(rate='100K')
+
+        def copy():
+            for i in range(3):
+                throttle.consume(10 * 1024)
+        threads = [threading.Thread(target=copy) for i in range(2)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert 0.5 <= time.time() - start < 1
+
+    def test_control_file(self):
+        throttle = Throttle()
+        throttle.configure(rate='100K')
+        os.makedirs(ice.STATE_DIR)
+        with open(throttle.path, 'w') as f:
+            f.write('off\n')
+        start = time.time()
+        throttle.consume(1024 ** 2)
+        assert time.time() - start < 0.1
+
+        with open(throttle.path, 'w') as f:
+            f.write('1M\n')
+        os.utime(throttle.path, (0, 0))
+        throttle.checked = 0
+        assert throttle.current_rate() == 1024 ** 2
+
+        os.remove(throttle.path)
+        throttle.checked = 0
+        assert throttle.current_rate() == 100 * 1024
+
+    def test_broken_control_file_keeps_rate(self):
+        throttle = Throttle()
+        throttle.configure(rate='100K')
+        os.makedirs(ice.STATE_DIR)
+        with open(throttle.path, 'w') as f:
+            f.write('fast\n')
+        assert throttle.current_rate() == 100 * 1024
+
+    def test_invalid_options(self):
+        with pytest.raises(ICEError):
+            Throttle().configure(rate='fast')
+        with pytest.raises(ICEError):
+            Throttle().configure(ionice='8')
+
+
+class TestPriority(object):
+
+    def test_ionice_levels(self):
+        assert parse_ionice('idle') == (3, 0)
+        assert parse_ionice('7') == (2, 7)
+
+    def test_commands_run_niced(self, monkeypatch):
+        throttle = Throttle()
+        throttle.configure(nice='5')
+        monkeypatch.setattr('ice_setup.ice.throttle', throttle)
+        stdout, stderr, returncode = run_call(['sh', '-c', 'cut -d " " -f 19 /proc/self/stat'])
+        assert int(stdout[0]) == os.nice(0) + 5
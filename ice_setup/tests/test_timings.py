@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from ice_setup.ice import Recorder, Profiler, run, run_call, run_get_stdout, NonZeroExit
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr('ice_setup.ice.recorder', recorder)
+    return recorder
+
+
+class TestRecorder(object):
+
+    def test_span_times_the_block(self, recorder):
+        with recorder.span('copy', 'file', source='/src'):
+            pass
+        span = recorder.spans[0]
+        assert span.name == 'copy'
+        assert span.args == dict(source='/src')
+        assert span.wall >= 0
+        assert span.cpu >= 0
+
+    def test_span_is_recorded_on_errors(self, recorder):
+        with pytest.raises(ValueError):
+            with recorder.span('copy', 'file'):
+                raise ValueError()
+        assert len(recorder.spans) == 1
+
+    def test_listeners(self, recorder):
+        events = []
+        recorder.listeners.append(lambda event, span: events.append((event, span.name)))
+        with recorder.span('copy', 'file'):
+            pass
+        assert events == [('start', 'copy'), ('end', 'copy')]
+
+    def test_summary_aggregates(self, recorder):
+        for i in range(3):
+            with recorder.span('rpm', 'command'):
+                pass
+        with recorder.span('copy', 'file'):
+            pass
+        rows = dict(((row[0], row[1]), row[2]) for row in recorder.summary())
+        assert rows == {('command', 'rpm'): 3, ('file', 'copy'): 1}
+
+
+class TestCommandSpans(object):
+
+    def test_run(self, recorder):
+        run(['true'])
+        span = recorder.spans[0]
+        assert (span.category, span.name) == ('command', 'true')
+        assert span.args['returncode'] == 0
+
+    def test_run_failure(self, recorder):
+        with pytest.raises(NonZeroExit):
+            run(['false'])
+        assert recorder.spans[0].args['returncode'] == 1
+
+    def test_run_get_stdout(self, recorder):
+        assert run_get_stdout(['echo', 'hi']) == 'hi\n'
+        assert recorder.spans[0].args['cmd'] == 'echo hi'
+
+    def test_run_call(self, recorder):
+        assert run_call(['false'])[2] == 1
+        assert recorder.spans[0].args['returncode'] == 1
+
+
+class TestProfiler(object):
+
+    def test_disabled_does_not_profile(self):
+        profiler = Profiler()
+        assert profiler.run(sum, [1, 2]) == 3
+        assert profiler.profiles == []
+
+    def test_report(self, tmpdir):
+        profiler = Profiler()
+        profiler.enabled = True
+        assert profiler.run(sum, [1, 2]) == 3
+        path = str(tmpdir.join('state', 'profile.pstats'))
+        profiler.report(path)
+        assert os.path.isfile(path)
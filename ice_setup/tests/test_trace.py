@@ -0,0 +1,57 @@
+import json
+import threading
+
+import pytest
+
+from ice_setup.ice import Recorder, TraceExporter
+
+
+@pytest.fixture
+def exporter(tmpdir):
+    recorder = Recorder()
+    exporter = TraceExporter(str(tmpdir.join('trace.json')), started=recorder.started)
+    recorder.listeners.append(exporter)
+    exporter.recorder = recorder
+    return exporter
+
+
+def read_trace(exporter):
+    exporter.write()
+    with open(exporter.path) as trace_file:
+        return json.load(trace_file)['traceEvents']
+
+
+class TestTraceExporter(object):
+
+    def test_complete_events(self, exporter):
+        with exporter.recorder.span('copy', 'file', source='/src'):
+            pass
+        events = [e for e in read_trace(exporter) if e['ph'] == 'X']
+        assert len(events) == 1
+        assert events[0]['name'] == 'copy'
+        assert events[0]['cat'] == 'file'
+        assert events[0]['args'] == dict(source='/src')
+        assert events[0]['dur'] >= 0
+
+    def test_threads_get_their_own_track(self, exporter):
+        def work():
+            with exporter.recorder.span('remote-MON', 'step'):
+                pass
+        worker = threading.Thread(target=work, name='remote-MON')
+        worker.start()
+        worker.join()
+        with exporter.recorder.span('local-Tools', 'step'):
+            pass
+        events = read_trace(exporter)
+        tracks = dict((e['args']['name'], e['tid']) for e in events if e['ph'] == 'M')
+        assert sorted(tracks) == ['MainThread', 'remote-MON']
+        spans = dict((e['name'], e['tid']) for e in events if e['ph'] == 'X')
+        assert spans['remote-MON'] == tracks['remote-MON']
+        assert spans['local-Tools'] == tracks['MainThread']
+
+    def test_bytes_counters(self, exporter):
+        with exporter.recorder.span('download', 'file') as span:
+            exporter.recorder.transferred(span, 1024)
+        counters = [e for e in read_trace(exporter) if e['ph'] == 'C']
+        assert counters[0]['name'] == 'bytes download'
+        assert counters[0]['args'] == dict(bytes=1024)
@@ -0,0 +1,268 @@
+import hashlib
+import os
+import stat
+import struct
+
+import pytest
+
+from ice_setup import ice
+from ice_setup.ice import (
+    PackageVerifier, VerificationFailed, check_ar_archive, check_rpm, configure_remote,
+    parse_rpm_checksig, which,
+)
+
+
+def rpm_header(entries):
+    """a header structure with ``(tag, type, value)`` entries"""
+    index = data = ''
+    for tag, kind, value in entries:
+        if kind == 4:
+            value = struct.pack('>I', value)
+        elif kind == 6:
+            value += '\0'
+        index += struct.pack('>IIII', tag, kind, len(data), 16 if kind == 7 else 1)
+        data += value
+    return '\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('>II', len(entries), len(data)) + index + data
+
+
+def make_rpm(path, payload='payload', signed=False):
+    header = rpm_header([(1000, 6, 'ceph-osd')])
+    entries = [
+        (1000, 4, len(header) + len(payload)),
+        (269, 6, hashlib.sha1(header).hexdigest()),
+        (1004, 7, hashlib.md5(header + payload).digest()),
+    ]
+    if signed:
+        entries.append((268, 7, 'r' * 16))
+    signature = rpm_header(entries)
+    lead = '\xed\xab\xee\xdb' + '\0' * 92
+    with open(path, 'wb') as f:
+        f.write(lead + signature + '\0' * (-len(signature) % 8) + header + payload)
+    return path
+
+
+def make_deb(path, data='data'):
+    members = [('debian-binary', '2.0\n'), ('control.tar.gz', 'control'), ('data.tar.xz', data)]
+    contents = '!<arch>\n'
+    for name, member in members:
+        contents += '%-16s%-12s%-6s%-6s%-8s%-10s`\n' % (name, 0, 0, 0, 100644, len(member))
+        contents += member + ('\n' if len(member) % 2 else '')
+    with open(path, 'wb') as f:
+        f.write(contents)
+    return path
+
+
+@pytest.fixture
+def rpm_tree(tmpdir, monkeypatch):
+    """packages checked in-process, whether ``rpm`` is installed or not"""
+    monkeypatch.setattr('ice_setup.ice.which', lambda executable: None)
+    for number in range(4):
+        make_rpm(str(tmpdir.join('ceph-osd-%s.rpm' % number)), signed=True)
+    return tmpdir
+
+
+@pytest.fixture
+def fake_rpm(tmpdir, monkeypatch):
+    """an ``rpm`` that answers ``-Kv`` for each package with ``result(path)``"""
+    def install(result):
+        script = tmpdir.mkdir('bin').join('rpm')
+        script.write(
+            '#!/bin/sh\nshift\n[ "$1" = --nosignature ] && shift\n'
+            'for path; do\n  echo "$path:"\n  case "$path" in\n%s  esac\ndone\n' % result
+        )
+        os.chmod(str(script), os.stat(str(script)).st_mode | stat.S_IXUSR)
+        monkeypatch.setenv('PATH', '%s:%s' % (tmpdir.join('bin'), os.environ['PATH']))
+        monkeypatch.setattr('ice_setup.ice.which', which)
+    return install
+
+
+@pytest.fixture
+def apt_tree(tmpdir):
+    pool = tmpdir.join('pool', 'main', 'c', 'ceph')
+    pool.ensure(dir=True)
+    deb = make_deb(str(pool.join('ceph-osd_0.94_amd64.deb')))
+    contents = open(deb, 'rb').read()
+    packages = 'Package: ceph-osd\nFilename: pool/main/c/ceph/ceph-osd_0.94_amd64.deb\nSize: %s\nSHA256: %s\n' % (
+        len(contents), hashlib.sha256(contents).hexdigest()
+    )
+    tmpdir.join('dists', 'trusty', 'main', 'binary-amd64', 'Packages').write(packages, ensure=True)
+    tmpdir.join('dists', 'trusty', 'Release').write('Codename: trusty\nSHA256:\n %s %s main/binary-amd64/Packages\n' % (
+        hashlib.sha256(packages).hexdigest(), len(packages)
+    ))
+    return tmpdir
+
+
+class TestCheckRPM(object):
+
+    def test_intact(self, tmpdir):
+        assert check_rpm(make_rpm(str(tmpdir.join('a.rpm')))) == (None, False)
+        assert check_rpm(make_rpm(str(tmpdir.join('b.rpm')), signed=True)) == (None, True)
+
+    def test_corrupt_payload(self, tmpdir):
+        path = make_rpm(str(tmpdir.join('a.rpm')))
+        contents = open(path, 'rb').read()
+        with open(path, 'wb') as f:
+            f.write(contents[:-1] + 'X')
+        assert check_rpm(path)[0] == 'MD5 digest does not match'
+
+    def test_truncated(self, tmpdir):
+        path = make_rpm(str(tmpdir.join('a.rpm')))
+        contents = open(path, 'rb').read()
+        with open(path, 'wb') as f:
+            f.write(contents[:-3])
+        assert check_rpm(path)[0].startswith('size is')
+
+    def test_not_an_rpm(self, tmpdir):
+        path = tmpdir.join('a.rpm')
+        path.write('<html>Not Found</html>')
+        assert check_rpm(str(path)) == ('not an rpm package', False)
+
+
+class TestParseRPMChecksig(object):
+
+    def test_verbose_output(self):
+        results = parse_rpm_checksig([
+            '/repo/a.rpm:',
+            '    Header V3 RSA/SHA256 Signature, key ID fd431d51: NOKEY',
+            '    Header SHA1 digest: OK (5d8e4c4e)',
+            '    V3 RSA/SHA256 Signature, key ID fd431d51: NOKEY',
+            '    MD5 digest: OK (e8b9d2a9)',
+            '/repo/b.rpm:',
+            '    Header SHA1 digest: OK',
+            '    MD5 digest: BAD Expected(e8b9d2a9) != (0c5d3a1b)',
+        ])
+        assert results['/repo/a.rpm'] == ([], False, True)
+        assert results['/repo/b.rpm'] == (['MD5 digest: BAD'], False, False)
+
+    def test_signatures(self):
+        results = parse_rpm_checksig([
+            '/repo/a.rpm:',
+            '    Header V4 RSA/SHA256 Signature, key ID fd431d51: OK',
+            '    MD5 digest: OK',
+            '/repo/b.rpm:',
+            '    Header V4 RSA/SHA256 Signature, key ID fd431d51: NOTTRUSTED',
+            '/repo/c.rpm:',
+            '    V4 RSA/SHA256 Signature, key ID fd431d51: NOTFOUND',
+        ])
+        assert results['/repo/a.rpm'] == ([], True, False)
+        assert results['/repo/b.rpm'] == (
+            ['Header V4 RSA/SHA256 Signature, key ID fd431d51: NOTTRUSTED'], False, False
+        )
+        assert results['/repo/c.rpm'][0] == ['V4 RSA/SHA256 Signature, key ID fd431d51: NOTFOUND']
+
+
+class TestPackageVerifier(object):
+
+    def test_signed_rpms(self, rpm_tree):
+        assert PackageVerifier(str(rpm_tree)).verify() == 4
+
+    def test_unsigned_rpm(self, rpm_tree):
+        make_rpm(str(rpm_tree.join('ceph-osd-0.rpm')))
+        with pytest.raises(VerificationFailed) as exc:
+            PackageVerifier(str(rpm_tree)).verify()
+        assert exc.value.failures == [('ceph-osd-0.rpm', 'not signed')]
+        assert PackageVerifier(str(rpm_tree), use_gpg=False).verify() == 4
+
+    def test_fails_fast(self, rpm_tree, monkeypatch):
+        monkeypatch.setattr(PackageVerifier, 'batch_size', 1)
+        for number in range(4):
+            rpm_tree.join('ceph-osd-%s.rpm' % number).write('broken')
+        with pytest.raises(VerificationFailed) as exc:
+            PackageVerifier(str(rpm_tree), jobs=1).verify()
+        assert len(exc.value.failures) == 1
+
+    def test_with_rpm(self, rpm_tree, fake_rpm):
+        """``rpm -K`` is used when it is installed"""
+        fake_rpm('  *-2.rpm) echo "    MD5 digest: BAD";;\n  *) echo "    MD5 digest: OK";;\n')
+        with pytest.raises(VerificationFailed) as exc:
+            PackageVerifier(str(rpm_tree), use_gpg=False).verify()
+        assert exc.value.failures == [('ceph-osd-2.rpm', 'MD5 digest: BAD')]
+
+    def test_keys_not_imported(self, rpm_tree, fake_rpm, caplog):
+        fake_rpm(
+            '  *-1.rpm) echo "    RSA/SHA256 Signature, key ID fd431d51: NOKEY";;\n'
+            '  *) echo "    RSA/SHA256 Signature, key ID fd431d51: OK";;\n'
+        )
+        assert PackageVerifier(str(rpm_tree)).verify() == 4
+        assert 'not imported: ceph-osd-1.rpm' in caplog.text
+
+    def test_untrusted_signature(self, rpm_tree, fake_rpm):
+        fake_rpm(
+            '  *-1.rpm) echo "    RSA/SHA256 Signature, key ID fd431d51: NOTTRUSTED";;\n'
+            '  *) echo "    RSA/SHA256 Signature, key ID fd431d51: OK";;\n'
+        )
+        with pytest.raises(VerificationFailed) as exc:
+            PackageVerifier(str(rpm_tree)).verify()
+        assert exc.value.failures == [
+            ('ceph-osd-1.rpm', 'RSA/SHA256 Signature, key ID fd431d51: NOTTRUSTED')
+        ]
+
+    def test_check_that_breaks(self, rpm_tree, monkeypatch):
+        def rpm_files(self, paths):
+            raise OSError('Too many open files')
+        monkeypatch.setattr(PackageVerifier, 'rpm_files', rpm_files)
+        with pytest.raises(VerificationFailed) as exc:
+            PackageVerifier(str(rpm_tree)).verify()
+        assert exc.value.failures[0] == ('ceph-osd-0.rpm', 'could not be checked: Too many open files')
+
+    def test_debs(self, apt_tree):
+        assert PackageVerifier(str(apt_tree)).verify() == 1
+
+    def test_corrupt_deb(self, apt_tree):
+        make_deb(str(apt_tree.join('pool', 'main', 'c', 'ceph', 'ceph-osd_0.94_amd64.deb')), data='dato')
+        with pytest.raises(VerificationFailed) as exc:
+            PackageVerifier(str(apt_tree)).verify()
+        assert exc.value.failures == [
+            ('pool/main/c/ceph/ceph-osd_0.94_amd64.deb', 'SHA256 digest does not match')
+        ]
+
+    def test_changed_index(self, apt_tree):
+        apt_tree.join('dists', 'trusty', 'main', 'binary-amd64', 'Packages').write('\n', mode='a')
+        with pytest.raises(VerificationFailed) as exc:
+            PackageVerifier(str(apt_tree)).verify()
+        assert exc.value.failures[0] == (
+            'dists/trusty/main/binary-amd64/Packages', 'does not match its Release file'
+        )
+
+    def test_unlisted_deb(self, tmpdir):
+        path = make_deb(str(tmpdir.join('ceph-osd_0.94_amd64.deb')))
+        assert check_ar_archive(path) is None
+        contents = open(path, 'rb').read()
+        with open(path, 'wb') as f:
+            f.write(contents[:-4])
+        assert check_ar_archive(path) == 'truncated archive'
+
+
+class TestVerifyBeforePublishing(object):
+
+    def test_nothing_published(self, tmpdir, monkeypatch):
+        monkeypatch.setattr('ice_setup.ice.which', lambda executable: None)
+        monkeypatch.setattr('ice_setup.ice.LOCAL_REPO_DIR', str(tmpdir.mkdir('ICE')))
+        monkeypatch.setattr('ice_setup.ice.REMOTE_REPO_DIR', str(tmpdir.mkdir('content')))
+        source = tmpdir.mkdir('packages').mkdir('ceph-osd')
+        make_rpm(str(source.join('ceph-osd.rpm')), signed=True)
+        source.join('librados2.rpm').write('broken')
+        with pytest.raises(VerificationFailed):
+            configure_remote('ceph-osd', str(tmpdir.join('packages')))
+        assert not tmpdir.join('content', 'ceph-osd').check()
+
+    def test_configure_without_gpg(self, tmpdir, monkeypatch):
+        calls = []
+        for name in [
+            'sudo_check', 'local_publish_trees', 'remote_publish_trees', 'preflight',
+            'pin_local_repos', 'after_publishing',
+        ]:
+            monkeypatch.setattr('ice_setup.ice.%s' % name, lambda *a, **kw: [])
+        for name in ['configure_local', 'configure_remote']:
+            monkeypatch.setattr(
+                'ice_setup.ice.%s' % name,
+                lambda repo, package_path, **kw: calls.append((repo, kw['use_gpg']))
+            )
+        ice.Configure(['configure', 'all', str(tmpdir), '--no-gpg']).parse_args()
+        assert len(calls) == 5
+        assert not any(use_gpg for repo, use_gpg in calls)
+
+    def test_disabled(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(PackageVerifier, 'enabled', False)
+        tmpdir.join('broken.rpm').write('broken')
+        assert ice.verify_packages(str(tmpdir)) == 0